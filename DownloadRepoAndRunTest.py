@@ -2,10 +2,41 @@ import subprocess
 import sys
 import os
 import shutil  # Import shutil for file operations
-import matplotlib.pyplot as plt  # Import matplotlib for graphing
+from matplotlib.figure import Figure  # Import matplotlib for graphing
+import numpy as np  # Import numpy for bar positions and heatmaps
 import pandas as pd  # Import pandas for data processing
 import json  # Import json for reading JSON files
 import re
+import hashlib  # Import hashlib for cache checksums
+import time
+import contextlib
+import sqlite3  # Import sqlite3 for the results store
+import heapq  # Import heapq for the top-N method diffs
+import itertools
+import argparse  # Import argparse for command-line options
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor  # Import executors for graph rendering, pipeline stages and asm dumps
+import threading
+import asyncio  # Import asyncio for the pipeline scheduler
+import traceback
+import zlib  # Import zlib for the output archives when zstandard is not installed
+import statistics  # Import statistics for the confidence intervals of preview estimates
+import tempfile  # Import tempfile for the captured output of measured child processes
+try:
+    import fcntl  # Used for copy-on-write reflinks where the platform supports them
+except ImportError:
+    fcntl = None
+try:
+    import tomllib  # Used for TOML run configurations where the Python version has it
+except ImportError:
+    tomllib = None
+try:
+    import zstandard  # Used to compress the output archives where it is installed
+except ImportError:
+    zstandard = None
+try:
+    import resource  # Used for the peak RSS of the phases where the platform supports it
+except ImportError:
+    resource = None
 
 #python C:\deepak\Apx_performance\runtime\src\coreclr\scripts\superpmi.py asmdiffs -details C:\deepak\Apx_performance\runResults\diffAPX_details.csv -base_jit_path C:\deepak\Apx_performance\runResults\base\clrjit.dll -diff_jit_path C:\deepak\Apx_performance\runResults\diffAPX\clrjit.dll -diff_jit_option JitBypassApxCheck=1
 # Define the repository URL and the desired directory name
@@ -14,11 +45,397 @@ DIR_NAME = "runtime"
 BRANCH_NAME = "APX_icount"
 JITUTILS_REPO_URL = "https://github.com/dotnet/jitutils.git"
 JITUTILS_DIR_NAME = "jitutils"
+# Folder (parallel to the 'runtime' repository) holding one persistent git worktree per branch
+WORKTREES_DIR_NAME = "worktrees"
+# Run commands through the shell on Windows, where it resolves the .cmd scripts; on POSIX a shell would only run the first item of a command list
+USE_SHELL = os.name == "nt"
+# Serializes 'git worktree add', which updates the administrative files shared by all worktrees
+WORKTREE_ADD_LOCK = threading.Lock()
+# Name of the folder (inside the results folder) holding the private SPMI locations of parallel runs
+SPMI_WORKSPACES_DIR_NAME = "spmi_workspaces"
+# Target of the SuperPMI collections, as used in the names of the downloaded MCH folders
+SPMI_TARGET = "windows.x64"
+# Shared cache of downloaded MCH collections, kept outside the repository across runs
+MCH_CACHE_PATH = os.environ.get("APX_PERF_MCH_CACHE", os.path.join(os.path.expanduser("~"), ".apx_performance", "mch_cache"))
+MCH_CACHE_MAX_BYTES = 200 * 1024 ** 3
+# A run waiting for another one to download the collections may have to wait for the whole download
+MCH_CACHE_LOCK_TIMEOUT = 6 * 60 * 60
+# Cache of built Core_Root folders, keyed by commit SHA and build steps
+BUILD_CACHE_PATH = os.environ.get("APX_PERF_BUILD_CACHE", os.path.join(os.path.expanduser("~"), ".apx_performance", "build_cache"))
+BUILD_CACHE_MAX_BYTES = 100 * 1024 ** 3
+# Content-addressed store of Core_Root files, materialized with reflinks or hardlinks
+SNAPSHOT_STORE_PATH = os.environ.get("APX_PERF_SNAPSHOT_STORE", os.path.join(os.path.expanduser("~"), ".apx_performance", "snapshots"))
+SNAPSHOT_STORE_KEEP = 20
+SNAPSHOT_STAT_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+# ioctl request that clones a file's extents (Linux FICLONE)
+FICLONE = 0x40049409
+# (source, destination) device pairs on which a reflink failed
+REFLINK_UNSUPPORTED_DEVICES = set()
+# Results of earlier SuperPMI runs, keyed by both JITs, their options and the collections
+RESULT_STORE_PATH = os.environ.get("APX_PERF_RESULT_STORE", os.path.join(os.path.expanduser("~"), ".apx_performance", "results"))
+RESULT_STORE_MAX_BYTES = 50 * 1024 ** 3
+# SQLite store (inside the results folder) of the per-collection results of every run
+RESULTS_DATABASE_PATH = os.environ.get("APX_PERF_RESULTS_DB", os.path.join(os.path.expanduser("~"), ".apx_performance", "results.sqlite"))
+# Columns compared between the details CSVs and their names in the results store
+DETAILS_COLUMNS = [
+    'Collection',
+    'Instruction Count Difference',
+    '% Instruction Count Difference',
+    '% Instruction Count Difference (Ignoring Zero diffs)'
+]
+DETAILS_DB_COLUMNS = {
+    'Collection': "collection",
+    'Instruction Count Difference': "instruction_count_difference",
+    '% Instruction Count Difference': "pct_instruction_count_difference",
+    '% Instruction Count Difference (Ignoring Zero diffs)': "pct_instruction_count_difference_nonzero",
+}
+# Legend text of JIT options when they are on and off; options in HIDDEN_JIT_OPTIONS are left out
+JIT_OPTION_LABELS = {
+    "EnableApxNDD": ("NDD on", "NDD off"),
+    "EnableApxConditionalChaining": ("CCMP On", "CCMP Off"),
+    "EnableApxPPX": ("PPX On", "PPX Off"),
+}
+HIDDEN_JIT_OPTIONS = {"JitBypassApxCheck"}
+# Explanations shown under each graph
+GRAPH_EXPLANATIONS = {
+    'Instruction Count Difference': r"$\bf{Instruction\ Count\ Difference}$ = $\bf{(Diff\ Instr\ Count\ -\ Base\ Instr\ Count)}$",
+    '% Instruction Count Difference': r"$\bf{\% Instruction\ Count\ Difference}$ = $\bf{\frac{(Diff\ Instr\ Count\ -\ Base\ Instr\ Count)\ \times\ 100}{Base\ Instr\ Count}}$",
+    '% Instruction Count Difference (Ignoring Zero diffs)': r"$\bf{\% Instruction\ Count\ Difference\ (Ignoring\ Zero\ Diffs)}$ = $\bf{\frac{(Diff\ Instr\ Count\ -\ Base\ Instr\ Count)\ \times\ 100}{Base\ Instr\ Count}}$ only for methods with diff",
+    '% Throughput Difference': r"$\bf{\%\ Throughput\ Difference}$ = median over the rounds of $\bf{\frac{(Diff\ Replay\ Time\ -\ Base\ Replay\ Time)\ \times\ 100}{Base\ Replay\ Time}}$",
+    '% Throughput Difference MAD': r"$\bf{\%\ Throughput\ Difference\ MAD}$ = median absolute deviation of the per-round $\bf{\%\ Throughput\ Difference}$ (noise of the measurement)"
+}
+BAR_WIDTH = 0.2  # Bar width
+BAR_GROUP_GAP = 0.5  # Gap between collections
+# Graphs with more bars (runs x collections) than this are drawn as heatmaps
+RENDER_DENSE_THRESHOLD = 200
+# Heatmaps with more cells than this are not annotated with their values
+RENDER_HEATMAP_ANNOTATION_LIMIT = 600
+# Lower-case column names accepted for each role in per-method details CSVs
+METHOD_DETAILS_COLUMN_CANDIDATES = {
+    "context": {"context", "method context"},
+    "method": {"method full name", "method name", "method"},
+    "collection": {"collection", "mch file"},
+    "base": {"base instructions", "base instruction count", "base instr count"},
+    "diff": {"diff instructions", "diff instruction count", "diff instr count"},
+}
+METHOD_ANALYSIS_CHUNK_SIZE = 500000
+METHOD_ANALYSIS_TOP_N = 20
+METHOD_SUMMARY_ALL_COLLECTIONS = "(all collections)"
+METHOD_LABEL_MAX_LENGTH = 60
+# Tie breaker for heap items with equal differences
+METHOD_HEAP_SEQUENCE = itertools.count()
+# Archive of the asm dumps in every SuperPMI output folder, and its index
+ARCHIVE_FILE_NAME = "asm_archive.bin"
+ARCHIVE_INDEX_NAME = "asm_archive.json"
+ARCHIVE_FILE_EXTENSIONS = {".dasm", ".asm", ".diff"}
+ARCHIVE_ZSTD_LEVEL = 10
+ARCHIVE_ZLIB_LEVEL = 6
+# Folder (inside the results folder) holding the per-method metrics of base replays shared by the configurations
+BASE_METRICS_DIR_NAME = "base_metrics"
+# Lets the first configuration replay the base while the others wait and reuse its metrics
+BASE_METRICS_LOCK = threading.Lock()
+# Largest number of changed methods per collection whose asm is generated when only the diff JIT is replayed
+BASE_REUSE_ASM_LIMIT = 100
+# Throughput mode: untimed warmup replays and timed rounds (one base and one diff replay each) per collection
+TP_WARMUP = 1
+TP_REPEATS = 5
+TP_NAME_SUFFIX = "_tp"
+TP_GRAPHS_DIR_NAME = "throughput_graphs"
+# Rounds whose difference is farther than this many (normal-scaled) MADs from the median are counted as outliers
+TP_OUTLIER_MADS = 3.0
+TP_MAD_SCALE = 1.4826
+# Columns of the throughput CSVs that are drawn by create_visual_representation
+TP_COLUMNS = [
+    'Collection',
+    '% Throughput Difference',
+    '% Throughput Difference MAD'
+]
+# Preview mode: share of the method contexts replayed, spread over PREVIEW_CLUSTERS blocks of the
+# first PREVIEW_MAX_CONTEXTS contexts of every collection (later contexts are never sampled), and the
+# confidence of the estimates
+PREVIEW_FRACTION = 0.02
+PREVIEW_MAX_CONTEXTS = 2000000
+PREVIEW_CLUSTERS = 256
+PREVIEW_CONFIDENCE = 0.95
+# Previews whose interval straddles zero by more than this many percent are ambiguous and escalate to a full run
+PREVIEW_TOLERANCE = 0.05
+PREVIEW_NAME_SUFFIX = "_preview"
+PREVIEW_LABEL_SUFFIX = " (estimate)"
+# Run configuration (branches and JIT option matrices) used unless -config is given
+RUN_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_config.json")
+# Replay times of earlier jobs, used to start the longest jobs first
+JOB_TIMINGS_PATH = os.environ.get("APX_PERF_TIMINGS", os.path.join(os.path.expanduser("~"), ".apx_performance", "timings"))
+JOB_TIMING_SMOOTHING = 0.5  # Weight of the newest replay time in a job's estimate
+# Jobs of a run (or shard), in matrix order, written to the results folder for merging shards
+MATRIX_MANIFEST_NAME = "matrix.json"
+# Log file of the pipeline stage running on each thread (see run_pipeline), and the folder of the stage logs
+STAGE_OUTPUT = threading.local()
+STAGE_LOGS_DIR_NAME = "logs"
+# Number of stages of each resource class that may run at the same time; the replay limit follows -jobs
+STAGE_RESOURCE_LIMITS = {
+    "network": 2,
+    "disk": 2,
+    "build": 1,
+    "replay": 1,
+    "throughput": 1,
+    "cpu": os.cpu_count() or 1,
+}
+# Phases recorded by profile_phase, and the phases currently active on each thread
+PHASE_TIMELINE = []
+PHASE_STATE = threading.local()
+PHASE_METRICS = ["wall", "self_cpu", "child_cpu", "self_peak_rss", "child_peak_rss", "bytes_copied", "bytes_moved", "bytes_linked"]
+TIMELINE_FILE_NAME = "timeline.json"
+TRACE_FILE_NAME = "trace.json"
+CACHE_INDEX_FILE_NAME = "index.json"
+CACHE_LOCK_TIMEOUT = 600
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+# Build steps run for every branch: (script path relative to the repository, arguments)
+BUILD_STEPS = [
+    (("build.cmd",), ["clr+libs", "-rc", "checked", "-lc", "Release"]),
+    (("src", "tests", "build.cmd"), ["x64", "Checked", "generatelayoutonly"]),
+]
+# Build step rebuilding only the JIT, whose binaries are then patched into the existing Core_Root
+JIT_BUILD_STEPS = [
+    (("build.cmd",), ["clr.jit", "-rc", "checked"]),
+]
+# Changes under these repository paths only need the JIT build (see plan_build)
+JIT_ONLY_PATHS = ("src/coreclr/jit/",)
+# Folder (relative to the repository) the JIT build writes its binaries to, and the prefix of their names
+JIT_BINARIES_PATH_PARTS = ("artifacts", "bin", "coreclr", "windows.x64.Checked")
+JIT_BINARY_PREFIX = "clrjit"
+# Commit and build steps of the last successful build of a checkout, kept in its 'artifacts' folder
+BUILD_STATE_FILE_NAME = "apx_last_build.json"
 
-def clone_repo(repo_url, dir_name):
+def get_resource_usage():
+    """
+    Return CPU times and the peak RSS (in bytes) of this whole process and all its finished child processes.
+
+    The values cover every thread, so profile_phase only takes self_peak_rss from them, as the
+    peak RSS of the whole process at the end of a phase; its CPU times and child values are
+    measured per thread and per child (see run_child). The RSS values come from getrusage. Windows has no totals of the children, so the child
+    values are None there and the peak RSS of this process is its peak working set.
+    """
+    times = os.times()
+    usage = {
+        "self_cpu": times.user + times.system,
+        "child_cpu": None if os.name == "nt" else times.children_user + times.children_system,
+        "self_peak_rss": None,
+        "child_peak_rss": None,
+    }
+    if os.name == "nt":
+        import ctypes  # Only needed for the process handle of GetProcessMemoryInfo on Windows
+        usage["self_peak_rss"] = get_windows_process_usage(ctypes.windll.kernel32.GetCurrentProcess())[1]
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        rss_unit = 1 if sys.platform == "darwin" else 1024
+        usage["self_peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit
+        usage["child_peak_rss"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * rss_unit
+    return usage
+
+def get_windows_process_usage(handle):
+    """Return the CPU seconds (GetProcessTimes) and peak working set in bytes (GetProcessMemoryInfo) of a Windows process handle."""
+    import ctypes  # Only needed for the Windows API calls
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    kernel32 = ctypes.windll.kernel32
+    handle = wintypes.HANDLE(int(handle))
+    cpu_seconds = peak_rss = None
+    creation_time, exit_time, kernel_time, user_time = (wintypes.FILETIME() for _ in range(4))
+    if kernel32.GetProcessTimes(handle, ctypes.byref(creation_time), ctypes.byref(exit_time), ctypes.byref(kernel_time), ctypes.byref(user_time)):
+        # FILETIME counts 100-nanosecond intervals
+        cpu_seconds = sum(filetime.dwHighDateTime << 32 | filetime.dwLowDateTime for filetime in (kernel_time, user_time)) / 1e7
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    if kernel32.K32GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+        peak_rss = counters.PeakWorkingSetSize
+    return cpu_seconds, peak_rss
+
+def wait_for_child(process):
+    """
+    Wait for a child process and return its exit code, CPU seconds and peak RSS in bytes.
+
+    The child is reaped with os.wait4, whose resource usage covers the child and the descendants
+    it waited for. On Windows they are read from the child's process handle once it exited, and
+    only cover the child itself. The CPU time and peak RSS are None where neither is available.
+    """
+    if os.name == "nt":
+        returncode = process.wait()
+        # The handle stays open after the wait until the Popen object is deleted
+        return (returncode,) + get_windows_process_usage(process._handle)
+    if not hasattr(os, "wait4"):
+        return process.wait(), None, None
+    while True:
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+            break
+        except InterruptedError:
+            continue
+    # Popen must not reap the child again
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+    return process.returncode, usage.ru_utime + usage.ru_stime, usage.ru_maxrss * rss_unit
+
+def record_child_usage(cpu_seconds, peak_rss):
+    """Add the CPU time and peak RSS of a finished child process to every phase active on the current thread."""
+    for phase in getattr(PHASE_STATE, "active", []):
+        if cpu_seconds is not None:
+            phase["child_cpu"] = (phase["child_cpu"] or 0.0) + cpu_seconds
+        if peak_rss is not None:
+            phase["child_peak_rss"] = max(phase["child_peak_rss"] or 0, peak_rss)
+
+def run_child(command, check=False, capture_output=False, text=False, **popen_args):
+    """
+    Run a command like subprocess.run and record its CPU time and peak RSS in the phases of the current thread.
+
+    Captured output goes through temporary files instead of pipes, so the child can be reaped
+    by wait_for_child once it exits.
+    """
+    with contextlib.ExitStack() as stack:
+        if capture_output:
+            popen_args["stdout"] = stack.enter_context(tempfile.TemporaryFile())
+            popen_args["stderr"] = stack.enter_context(tempfile.TemporaryFile())
+        process = subprocess.Popen(command, **popen_args)
+        try:
+            returncode, cpu_seconds, peak_rss = wait_for_child(process)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        record_child_usage(cpu_seconds, peak_rss)
+        stdout = stderr = None
+        if capture_output:
+            outputs = []
+            for output_file in (popen_args["stdout"], popen_args["stderr"]):
+                output_file.seek(0)
+                data = output_file.read()
+                outputs.append(data.decode(errors="replace") if text else data)
+            stdout, stderr = outputs
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, stdout, stderr)
+    return subprocess.CompletedProcess(command, returncode, stdout, stderr)
+
+def record_phase_bytes(kind, byte_count):
+    """Add bytes copied, moved or linked to every phase active on the current thread."""
+    for phase in getattr(PHASE_STATE, "active", []):
+        phase[f"bytes_{kind}"] += byte_count
+
+@contextlib.contextmanager
+def profile_phase(name, **tags):
+    """
+    Record the wall time, CPU time, peak RSS and bytes copied or moved of a pipeline phase.
+
+    tags (such as branch and options) are stored with the phase. Phases may be nested; the
+    records are appended to PHASE_TIMELINE when the phase ends. Phases of different stages run
+    at the same time on their own threads, so self_cpu is the CPU time of the phase's thread and
+    child_cpu and child_peak_rss only cover the child processes it ran through run_child (None
+    if it ran none). self_peak_rss is the peak RSS of the whole process so far.
+    """
+    phase = {
+        "name": name,
+        "tags": {key: value for key, value in tags.items() if value is not None},
+        "start": time.time(),
+        "pid": os.getpid(),
+        "thread": threading.get_ident(),
+        "bytes_copied": 0,
+        "bytes_moved": 0,
+        "bytes_linked": 0,
+        "child_cpu": None,
+        "child_peak_rss": None,
+    }
+    active_phases = PHASE_STATE.__dict__.setdefault("active", [])
+    thread_cpu_before = time.thread_time()
+    start = time.perf_counter()
+    active_phases.append(phase)
+    try:
+        yield phase
+    finally:
+        active_phases.remove(phase)
+        phase["wall"] = time.perf_counter() - start
+        phase["self_cpu"] = time.thread_time() - thread_cpu_before
+        phase["self_peak_rss"] = get_resource_usage()["self_peak_rss"]
+        PHASE_TIMELINE.append(phase)
+
+def write_phase_timeline(timeline_path, trace_path):
+    """Write the recorded phases as a JSON timeline and as a Chrome trace-event file (chrome://tracing, Perfetto)."""
+    phases = sorted(PHASE_TIMELINE, key=lambda phase: phase["start"])
+    with open(timeline_path, "w") as timeline_file:
+        json.dump(phases, timeline_file, indent=2)
+
+    origin = phases[0]["start"] if phases else 0
+    events = []
+    for phase in phases:
+        events.append({
+            "name": phase["name"],
+            "cat": "phase",
+            "ph": "X",
+            "ts": int((phase["start"] - origin) * 1e6),
+            "dur": int(phase["wall"] * 1e6),
+            "pid": phase["pid"],
+            "tid": phase["thread"],
+            "args": dict(phase["tags"], **{key: phase[key] for key in PHASE_METRICS}),
+        })
+    with open(trace_path, "w") as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+    print(f"Phase timeline saved at '{timeline_path}' and Chrome trace at '{trace_path}'.")
+
+def print_phase_summary():
+    """
+    Print a table of the recorded phases, grouped by name, in order of total wall time.
+
+    Phases that ran no measured child process, or ran on a platform without the measurements,
+    show '-' instead of a child CPU time or peak RSS.
+    """
+    if not PHASE_TIMELINE:
+        return
+    summary = {}
+    for phase in PHASE_TIMELINE:
+        totals = summary.setdefault(phase["name"], {"count": 0, "wall": 0.0, "child_cpu": None, "bytes_copied": 0, "bytes_moved": 0, "child_peak_rss": None})
+        totals["count"] += 1
+        totals["wall"] += phase["wall"]
+        if phase["child_cpu"] is not None:
+            totals["child_cpu"] = (totals["child_cpu"] or 0.0) + phase["child_cpu"]
+        totals["bytes_copied"] += phase["bytes_copied"]
+        totals["bytes_moved"] += phase["bytes_moved"]
+        if phase["child_peak_rss"] is not None:
+            totals["child_peak_rss"] = max(totals["child_peak_rss"] or 0, phase["child_peak_rss"])
+
+    print("Phase summary:")
+    print(f"{'Phase':<28} {'Count':>5} {'Wall (s)':>10} {'Child CPU (s)':>14} {'Copied (MB)':>12} {'Moved (MB)':>11} {'Child peak RSS (MB)':>20}")
+    for name, totals in sorted(summary.items(), key=lambda item: item[1]["wall"], reverse=True):
+        child_cpu = "-" if totals["child_cpu"] is None else f"{totals['child_cpu']:.1f}"
+        child_peak_rss = "-" if totals["child_peak_rss"] is None else f"{totals['child_peak_rss'] / 1024 ** 2:.1f}"
+        print(
+            f"{name:<28} {totals['count']:>5} {totals['wall']:>10.1f} {child_cpu:>14} "
+            f"{totals['bytes_copied'] / 1024 ** 2:>12.1f} {totals['bytes_moved'] / 1024 ** 2:>11.1f} {child_peak_rss:>20}"
+        )
+
+def get_path_size(path):
+    """Return the size in bytes of a file, or of all the files below a directory."""
+    return get_directory_size(path) if os.path.isdir(path) else os.path.getsize(path)
+
+def get_temp_path(path):
+    """Return a temporary path next to path, unique to this process and thread, to be renamed to path when complete."""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+def clone_repo(repo_url, dir_name, clone_args=None):
     print(f"Cloning repository from '{repo_url}' into directory '{dir_name}'...")
     try:
-        subprocess.run(["git", "clone", repo_url, dir_name], check=True)
+        run_child(["git", "clone"] + (clone_args or []) + [repo_url, dir_name], check=True, **get_stage_output_args())
         print(f"Repository cloned successfully into '{dir_name}'.")
     except subprocess.CalledProcessError:
         print(f"Failed to clone the repository into '{dir_name}'.")
@@ -27,7 +444,7 @@ def clone_repo(repo_url, dir_name):
 def switch_to_main(cwd):
     print("Switching to 'main' branch...")
     try:
-        subprocess.run(["git", "checkout", "main"], cwd=cwd, shell=True, check=True)
+        run_child(["git", "checkout", "main"], cwd=cwd, shell=USE_SHELL, check=True, **get_stage_output_args())
         print("Switched to 'main' branch.")
     except subprocess.CalledProcessError:
         print("Failed to switch to 'main' branch. Ensure the 'main' branch exists.")
@@ -37,12 +454,12 @@ def delete_branch(branch_name, cwd):
     print(f"Checking if branch '{branch_name}' exists locally...")
     try:
         # Check if the branch exists locally
-        result = subprocess.run(["git", "branch", "--list", branch_name], cwd=cwd, shell=True, capture_output=True, text=True)
+        result = run_child(["git", "branch", "--list", branch_name], cwd=cwd, shell=USE_SHELL, capture_output=True, text=True)
         if branch_name in result.stdout:
             print(f"Branch '{branch_name}' exists locally. Deleting it...")
             # Switch to 'main' before deleting the branch
             switch_to_main(cwd)
-            subprocess.run(["git", "branch", "-D", branch_name], cwd=cwd, shell=True, check=True)
+            run_child(["git", "branch", "-D", branch_name], cwd=cwd, shell=USE_SHELL, check=True, **get_stage_output_args())
             print(f"Branch '{branch_name}' deleted successfully.")
         else:
             print(f"Branch '{branch_name}' does not exist locally. Skipping deletion.")
@@ -57,17 +474,70 @@ def checkout_branch(branch_name, cwd):
         delete_branch(branch_name, cwd)
 
         # Fetch all branches and check out the specified remote branch
-        subprocess.run(["git", "fetch", "origin"], check=True, cwd=cwd, shell=True)
-        subprocess.run(["git", "checkout", "-b", branch_name, f"origin/{branch_name}"], check=True, cwd=cwd, shell=True)
+        run_child(["git", "fetch", "origin"], check=True, cwd=cwd, shell=USE_SHELL, **get_stage_output_args())
+        run_child(["git", "checkout", "-b", branch_name, f"origin/{branch_name}"], check=True, cwd=cwd, shell=USE_SHELL, **get_stage_output_args())
         print(f"Checked out remote branch '{branch_name}'.")
     except subprocess.CalledProcessError:
         print(f"Failed to check out remote branch '{branch_name}'.")
         sys.exit(1)
 
+def fetch_branches(branch_names, cwd, depth=None):
+    """
+    Fetch only the given branches from origin, in a single blob-filtered fetch.
+
+    File contents are downloaded on demand when a worktree checks them out. With a depth the
+    fetch is also shallow.
+    """
+    refspecs = [f"+refs/heads/{branch_name}:refs/remotes/origin/{branch_name}" for branch_name in branch_names]
+    command = ["git", "fetch", "--filter=blob:none"]
+    if depth:
+        command.append(f"--depth={depth}")
+    command.extend(["origin"] + refspecs)
+    print(f"Fetching branches {', '.join(branch_names)} in '{cwd}'...")
+    try:
+        run_child(command, check=True, cwd=cwd, shell=USE_SHELL, **get_stage_output_args())
+        print(f"Fetched branches {', '.join(branch_names)}.")
+    except subprocess.CalledProcessError:
+        print(f"Failed to fetch branches {', '.join(branch_names)}.")
+        sys.exit(1)
+
+def prepare_worktree(branch_name, cwd, worktrees_path):
+    """
+    Check out the fetched branch in its own persistent worktree and return the worktree path.
+
+    An existing worktree is moved to the new commit in place. Untracked files such as its
+    'artifacts' folder are kept, so the next build there is incremental.
+    """
+    worktree_path = os.path.join(worktrees_path, branch_name)
+    try:
+        if os.path.exists(os.path.join(worktree_path, ".git")):
+            print(f"Updating worktree '{worktree_path}' to 'origin/{branch_name}'...")
+            run_child(["git", "checkout", "--force", "--detach", f"origin/{branch_name}"], check=True, cwd=worktree_path, shell=USE_SHELL, **get_stage_output_args())
+        else:
+            print(f"Creating worktree '{worktree_path}' for 'origin/{branch_name}'...")
+            with WORKTREE_ADD_LOCK:
+                # Forget worktrees whose folders were deleted
+                run_child(["git", "worktree", "prune"], check=True, cwd=cwd, shell=USE_SHELL, **get_stage_output_args())
+                run_child(["git", "worktree", "add", "--force", "--detach", worktree_path, f"origin/{branch_name}"], check=True, cwd=cwd, shell=USE_SHELL, **get_stage_output_args())
+        print(f"Worktree '{worktree_path}' is at 'origin/{branch_name}'.")
+    except subprocess.CalledProcessError:
+        print(f"Failed to prepare the worktree for branch '{branch_name}'.")
+        sys.exit(1)
+    return worktree_path
+
+def get_stage_output_args():
+    """Return the subprocess.run arguments that send a child's output to the log of the pipeline stage running on this thread, if any."""
+    log_file = getattr(STAGE_OUTPUT, "log_file", None)
+    if log_file is None:
+        return {}
+    # Write out what the stage printed so far before the child appends to the log
+    log_file.flush()
+    return {"stdout": log_file, "stderr": subprocess.STDOUT}
+
 def run_command(command, cwd=None):
     print(f"Running command: {' '.join(command)} in directory '{cwd}'...")
     try:
-        subprocess.run(command, check=True, cwd=cwd, shell=True)
+        run_child(command, check=True, cwd=cwd, shell=USE_SHELL, **get_stage_output_args())
         print(f"Command '{' '.join(command)}' executed successfully.")
     except subprocess.CalledProcessError:
         print(f"Failed to execute command: {' '.join(command)}")
@@ -84,11 +554,22 @@ def delete_directory_if_exists(path):
             print(f"Failed to delete directory '{path}': {e}")
             sys.exit(1)
 
-def copy_core_root(repo_root, destination_root, destination_name):
-    # Define the source and destination paths
-    core_root_path = os.path.join(repo_root, "artifacts", "tests", "coreclr", "windows.x64.Checked", "Tests", "Core_Root")
+def get_core_root_path(repo_root):
+    """Return the Core_Root folder produced by the build in repo_root."""
+    return os.path.join(repo_root, "artifacts", "tests", "coreclr", "windows.x64.Checked", "Tests", "Core_Root")
+
+def copy_core_root(repo_root, destination_root, destination_name, core_root_path=None, snapshot_store_path=None):
+    # Define the source and destination paths; the source defaults to the Core_Root built in repo_root
+    if core_root_path is None:
+        core_root_path = get_core_root_path(repo_root)
     destination_path = os.path.join(destination_root, destination_name)
 
+    # Link the files from the snapshot store instead of copying them
+    if snapshot_store_path:
+        snapshot_id = create_core_root_snapshot(core_root_path, snapshot_store_path)
+        materialize_snapshot(snapshot_id, destination_path, snapshot_store_path)
+        return
+
     # Delete the destination directory if it exists
     delete_directory_if_exists(destination_path)
 
@@ -96,6 +577,7 @@ def copy_core_root(repo_root, destination_root, destination_name):
     try:
         # Copy the directory
         shutil.copytree(core_root_path, destination_path)
+        record_phase_bytes("copied", get_directory_size(destination_path))
         print(f"Copied '{core_root_path}' to '{destination_path}' successfully.")
     except FileNotFoundError:
         print(f"Source directory '{core_root_path}' does not exist. Ensure the build step completed successfully.")
@@ -104,6 +586,187 @@ def copy_core_root(repo_root, destination_root, destination_name):
         print(f"Failed to copy '{core_root_path}' to '{destination_path}': {e}")
         sys.exit(1)
 
+def clone_file(source_path, destination_path, allow_hardlink=True):
+    """
+    Create destination_path with the contents of source_path as cheaply as the filesystem allows.
+
+    Tries a copy-on-write reflink first, then a hardlink (if allowed), and falls back to a copy.
+    Returns the method used: 'reflink', 'hardlink' or 'copy'.
+    """
+    devices = (os.stat(source_path).st_dev, os.stat(os.path.dirname(os.path.abspath(destination_path))).st_dev)
+    if fcntl is not None and devices not in REFLINK_UNSUPPORTED_DEVICES:
+        try:
+            with open(source_path, "rb") as source_file, open(destination_path, "wb") as destination_file:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            shutil.copystat(source_path, destination_path)
+            record_phase_bytes("linked", os.path.getsize(destination_path))
+            return "reflink"
+        except OSError:
+            # Remember that this pair of filesystems cannot reflink so later files skip the attempt
+            REFLINK_UNSUPPORTED_DEVICES.add(devices)
+            if os.path.exists(destination_path):
+                os.remove(destination_path)
+    if allow_hardlink:
+        try:
+            os.link(source_path, destination_path)
+            record_phase_bytes("linked", os.path.getsize(destination_path))
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copy2(source_path, destination_path)
+    record_phase_bytes("copied", os.path.getsize(destination_path))
+    return "copy"
+
+def get_file_identity(stat):
+    """Return a key identifying a file across renames and hardlinks: its device and inode (file index on Windows)."""
+    return f"{stat.st_dev}:{stat.st_ino}"
+
+def remember_file_hash(stat_cache, stat, sha256):
+    """Record the content hash of a file in the snapshot store's hash cache."""
+    stat_cache[get_file_identity(stat)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256, "last_seen": time.time()}
+
+def get_snapshot_object_path(store_path, sha256):
+    """Return the location of a file in the snapshot store's content-addressed object folder."""
+    return os.path.join(store_path, "objects", sha256[:2], sha256)
+
+def create_core_root_snapshot(core_root_path, store_path=SNAPSHOT_STORE_PATH):
+    """
+    Add the files of core_root_path to the snapshot store and record a snapshot manifest.
+
+    Files are deduplicated by content hash, so only content the store has not seen before is
+    written. Hashes are remembered by file identity, size and modification time, so snapshotting
+    an unchanged or materialized folder only reads file metadata. Returns the snapshot id.
+    """
+    if not os.path.isdir(core_root_path):
+        print(f"Source directory '{core_root_path}' does not exist. Ensure the build step completed successfully.")
+        sys.exit(1)
+
+    print(f"Creating snapshot of '{core_root_path}' in '{store_path}'...")
+    # Other runs sharing the store may add snapshots or collect garbage at the same time
+    with cache_lock(store_path):
+        stat_cache = load_cache_index(os.path.join(store_path, "stat_cache"))
+        files = {}
+        directories = []
+        new_objects = 0
+        for dir_path, dir_names, file_names in os.walk(core_root_path):
+            relative_dir_path = os.path.relpath(dir_path, core_root_path)
+            directories.extend(os.path.normpath(os.path.join(relative_dir_path, dir_name)) for dir_name in dir_names)
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                stat = os.stat(file_path)
+                cached_stat = stat_cache.get(get_file_identity(stat))
+                if cached_stat and cached_stat["size"] == stat.st_size and cached_stat["mtime_ns"] == stat.st_mtime_ns:
+                    sha256 = cached_stat["sha256"]
+                    cached_stat["last_seen"] = time.time()
+                else:
+                    sha256 = compute_file_sha256(file_path)
+                    remember_file_hash(stat_cache, stat, sha256)
+
+                object_path = get_snapshot_object_path(store_path, sha256)
+                if not os.path.exists(object_path):
+                    # Never hardlink into the store: a rebuild could overwrite the source file in place
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    temp_object_path = get_temp_path(object_path)
+                    clone_file(file_path, temp_object_path, allow_hardlink=False)
+                    os.replace(temp_object_path, object_path)
+                    new_objects += 1
+                files[os.path.normpath(os.path.join(relative_dir_path, file_name))] = sha256
+
+        manifest = {"files": files, "directories": sorted(directories), "created": time.time()}
+        snapshot_id = hashlib.sha256(json.dumps([files, manifest["directories"]], sort_keys=True).encode("utf-8")).hexdigest()
+        snapshots_path = os.path.join(store_path, "snapshots")
+        os.makedirs(snapshots_path, exist_ok=True)
+        manifest_path = os.path.join(snapshots_path, f"{snapshot_id}.json")
+        temp_manifest_path = get_temp_path(manifest_path)
+        with open(temp_manifest_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(temp_manifest_path, manifest_path)
+        save_cache_index(os.path.join(store_path, "stat_cache"), stat_cache)
+
+    print(f"Snapshot '{snapshot_id[:16]}' has {len(files)} files, {new_objects} of them new to the store.")
+    return snapshot_id
+
+def materialize_snapshot(snapshot_id, destination_path, store_path=SNAPSHOT_STORE_PATH):
+    """
+    Recreate a snapshot at destination_path using reflinks or hardlinks to the stored files.
+
+    Materialized files may share their data with the store and must be replaced, never modified in place.
+    """
+    delete_directory_if_exists(destination_path)
+    print(f"Materializing snapshot '{snapshot_id[:16]}' at '{destination_path}'...")
+    # Keep garbage collection from removing the snapshot's files while they are linked
+    with cache_lock(store_path):
+        manifest_path = os.path.join(store_path, "snapshots", f"{snapshot_id}.json")
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+
+        os.makedirs(destination_path)
+        for relative_dir_path in manifest["directories"]:
+            os.makedirs(os.path.join(destination_path, relative_dir_path), exist_ok=True)
+
+        stat_cache = load_cache_index(os.path.join(store_path, "stat_cache"))
+        methods = {}
+        for relative_file_path, sha256 in manifest["files"].items():
+            file_path = os.path.join(destination_path, relative_file_path)
+            method = clone_file(get_snapshot_object_path(store_path, sha256), file_path)
+            methods[method] = methods.get(method, 0) + 1
+            # Remember the hash so snapshotting the materialized folder does not read it again
+            remember_file_hash(stat_cache, os.stat(file_path), sha256)
+        save_cache_index(os.path.join(store_path, "stat_cache"), stat_cache)
+
+    summary = ", ".join(f"{count} {method}" for method, count in sorted(methods.items()))
+    print(f"Materialized snapshot '{snapshot_id[:16]}' at '{destination_path}' ({summary}).")
+
+def gc_snapshot_store(store_path=SNAPSHOT_STORE_PATH, keep_snapshots=SNAPSHOT_STORE_KEEP):
+    """
+    Remove all but the newest keep_snapshots snapshots and the stored files no remaining snapshot uses.
+
+    Temporary files and files newer than the oldest kept snapshot are left alone: another run may be
+    writing them for a snapshot it has not recorded yet.
+    """
+    snapshots_path = os.path.join(store_path, "snapshots")
+    if not os.path.isdir(snapshots_path):
+        return
+
+    with cache_lock(store_path):
+        manifests = []
+        for manifest_name in os.listdir(snapshots_path):
+            if manifest_name.endswith(".tmp"):
+                continue
+            manifest_path = os.path.join(snapshots_path, manifest_name)
+            with open(manifest_path, "r") as manifest_file:
+                manifests.append((json.load(manifest_file), manifest_path))
+        manifests.sort(key=lambda item: item[0]["created"], reverse=True)
+
+        kept_manifests = manifests[:keep_snapshots]
+        referenced_objects = set()
+        for manifest, _ in kept_manifests:
+            referenced_objects.update(manifest["files"].values())
+        for _, manifest_path in manifests[keep_snapshots:]:
+            os.remove(manifest_path)
+
+        oldest_kept_created = kept_manifests[-1][0]["created"] if kept_manifests else time.time()
+        removed_objects = 0
+        objects_path = os.path.join(store_path, "objects")
+        for dir_path, _, file_names in os.walk(objects_path):
+            for file_name in file_names:
+                if file_name in referenced_objects or file_name.endswith(".tmp"):
+                    continue
+                object_path = os.path.join(dir_path, file_name)
+                # Stored files keep the modification time of their source, so also look at the status change time
+                stat = os.stat(object_path)
+                if max(stat.st_mtime, stat.st_ctime) > oldest_kept_created:
+                    continue
+                os.remove(object_path)
+                removed_objects += 1
+
+        # Forget the hashes of files that have not been seen for a while
+        stat_cache = load_cache_index(os.path.join(store_path, "stat_cache"))
+        oldest_last_seen = time.time() - SNAPSHOT_STAT_CACHE_MAX_AGE
+        stat_cache = {identity: entry for identity, entry in stat_cache.items() if entry["last_seen"] >= oldest_last_seen}
+        save_cache_index(os.path.join(store_path, "stat_cache"), stat_cache)
+    print(f"Snapshot store '{store_path}': removed {max(0, len(manifests) - keep_snapshots)} snapshots and {removed_objects} unused files.")
+
 def setup_jitutils():
     """Clone jitutils repository and run bootstrap.cmd."""
     jitutils_path = os.path.abspath(JITUTILS_DIR_NAME)
@@ -122,348 +785,2612 @@ def setup_jitutils():
         print(f"bootstrap.cmd not found in '{jitutils_path}'. Ensure the repository is cloned correctly.")
         sys.exit(1)
 
-def run_superpmi(repo_root, destination_path, csv_prefix, diff_coreroot_path, diff_jit_options, base_jit_options):
-    """Run the superpmi.py command with specified csv_prefix and diff_jit_options."""
-    # Delete the artifacts\spmi directory if it exists
-    spmi_path = os.path.join(repo_root, "artifacts", "spmi")
-    delete_directory_if_exists(spmi_path)
+def compute_file_sha256(path):
+    """Return the SHA-256 checksum of a file, reading it in chunks."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHECKSUM_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
-    # Create a unique name for the details CSV file based on csv_prefix and diff_jit_options
-    options_suffix = "_".join(option.replace("=", "_") for option in diff_jit_options)
-    details_csv_path = os.path.join(destination_path, f"{csv_prefix}_{options_suffix}.csv")
+def load_cache_index(cache_path):
+    """Load the JSON index of a cache folder. Returns an empty index if there is none yet."""
+    index_path = os.path.join(cache_path, CACHE_INDEX_FILE_NAME)
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, "r") as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError) as e:
+        print(f"Cache index '{index_path}' could not be read ({e}). Starting with an empty index.")
+        return {}
 
-    base_jit_path = os.path.join(destination_path, "base", "clrjit.dll")
-    diff_jit_path = os.path.join(diff_coreroot_path, "clrjit.dll")
-    superpmi_script = os.path.join(repo_root, "src", "coreclr", "scripts", "superpmi.py")
+def save_cache_index(cache_path, index):
+    """Write the JSON index of a cache folder, replacing the old one atomically."""
+    os.makedirs(cache_path, exist_ok=True)
+    index_path = os.path.join(cache_path, CACHE_INDEX_FILE_NAME)
+    temp_index_path = get_temp_path(index_path)
+    with open(temp_index_path, "w") as index_file:
+        json.dump(index, index_file, indent=2, sort_keys=True)
+    os.replace(temp_index_path, index_path)
 
-    # Build the command
-    command = [
-        "python", superpmi_script, "asmdiffs",
-        "-details", details_csv_path,
-        "-base_jit_path", base_jit_path,
-        "-diff_jit_path", diff_jit_path,
-    ]
+def evict_lru_cache_entries(cache_path, index, max_bytes, protected_keys=()):
+    """
+    Remove the least recently used entries of a cache index until its total size fits in max_bytes.
+
+    Every entry must have 'path' (relative to cache_path), 'size' and 'last_used' fields.
+    Entries in protected_keys are never evicted. Returns the list of evicted keys.
+    """
+    total_size = sum(entry["size"] for entry in index.values())
+    evicted_keys = []
+    for key, entry in sorted(index.items(), key=lambda item: item[1]["last_used"]):
+        if total_size <= max_bytes:
+            break
+        if key in protected_keys:
+            continue
+        entry_path = os.path.join(cache_path, entry["path"])
+        print(f"Evicting cache entry '{key}' ({entry['size']} bytes) from '{cache_path}'...")
+        if os.path.isdir(entry_path):
+            delete_directory_if_exists(entry_path)
+        elif os.path.exists(entry_path):
+            os.remove(entry_path)
+        total_size -= entry["size"]
+        evicted_keys.append(key)
 
-    # Add all diff_jit_options to the command
-    for option in base_jit_options:
-        command.extend(["-base_jit_option", option])
+    for key in evicted_keys:
+        del index[key]
+    if total_size > max_bytes:
+        print(f"Cache '{cache_path}' still uses {total_size} bytes after eviction (limit {max_bytes}); the entries in use do not fit.")
+    return evicted_keys
 
-    # Add all diff_jit_options to the command
-    for option in diff_jit_options:
-        command.extend(["-diff_jit_option", option])
+def determine_jit_ee_version(core_root_path):
+    """Ask mcs.exe in the Core_Root for the JIT-EE version the collections must match."""
+    mcs_path = os.path.join(core_root_path, "mcs.exe")
+    if not os.path.exists(mcs_path):
+        print(f"'{mcs_path}' does not exist. Ensure the build step completed successfully.")
+        sys.exit(1)
+    try:
+        result = run_child([mcs_path, "-printJITEEVersion"], capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError:
+        print(f"Failed to determine the JIT-EE version using '{mcs_path}'.")
+        sys.exit(1)
+    jit_ee_version = result.stdout.strip()
+    print(f"JIT-EE version of '{core_root_path}': {jit_ee_version}")
+    return jit_ee_version
 
-    # Add the filter
-    # command.extend(["-filter", "libraries_tests.run"])
+def verify_mch_cache_entry(cache_path, entry):
+    """
+    Check a cached collection file against its recorded checksum.
 
-    print(f"Running SuperPMI command: {' '.join(command)}")
-    run_command(command, cwd=repo_root)
+    The full checksum is only recomputed when the size or modification time of the file changed.
+    """
+    entry_path = os.path.join(cache_path, entry["path"])
+    if not os.path.exists(entry_path):
+        return False
+    stat = os.stat(entry_path)
+    if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]:
+        return True
+    if compute_file_sha256(entry_path) != entry["sha256"]:
+        print(f"Checksum mismatch for cached collection '{entry_path}'.")
+        return False
+    entry["mtime_ns"] = stat.st_mtime_ns
+    return True
 
-    # Copy everything except the 'mch' folder from spmi_path to a new folder in destination_path
-    output_folder_name = os.path.splitext(os.path.basename(details_csv_path))[0]  # Remove .md or .csv extension
-    output_folder_path = os.path.join(destination_path, output_folder_name)
+def prime_mch_cache(repo_root, core_root_path, cache_path=MCH_CACHE_PATH, max_bytes=MCH_CACHE_MAX_BYTES):
+    """
+    Make sure the shared MCH cache holds the collections for the JIT-EE version of core_root_path.
 
-    if not os.path.exists(spmi_path):
-        print(f"SPMI path '{spmi_path}' does not exist. Ensure the SuperPMI command ran successfully.")
-        sys.exit(1)
+    Collections are keyed by JIT-EE version and file name. Missing or corrupted entries are
+    downloaded once with superpmi.py download and moved into the cache. Returns the folder
+    holding the collections, to be passed to superpmi.py with -mch_files.
+    """
+    jit_ee_version = determine_jit_ee_version(core_root_path)
+    collection_folder_name = f"{jit_ee_version}.{SPMI_TARGET}"
+    collection_folder_path = os.path.join(cache_path, collection_folder_name)
 
-    print(f"Copying contents of '{spmi_path}' (excluding 'mch') to '{output_folder_path}'...")
+    # Only one run or branch at a time may download into and update the cache
+    with cache_lock(cache_path, MCH_CACHE_LOCK_TIMEOUT):
+        index = load_cache_index(cache_path)
+        version_keys = [key for key in index if key.startswith(f"{collection_folder_name}/")]
+        invalid_keys = [key for key in version_keys if not verify_mch_cache_entry(cache_path, index[key])]
+        for key in invalid_keys:
+            print(f"Dropping invalid MCH cache entry '{key}'.")
+            entry_path = os.path.join(cache_path, index[key]["path"])
+            if os.path.exists(entry_path):
+                os.remove(entry_path)
+            del index[key]
+
+        if version_keys and not invalid_keys:
+            print(f"Using {len(version_keys)} cached collections from '{collection_folder_path}'.")
+        else:
+            # Download into a staging location next to the cache so the files can be moved in with a rename
+            staging_path = get_temp_path(os.path.join(cache_path, "staging"))
+            delete_directory_if_exists(staging_path)
+            superpmi_script = os.path.join(repo_root, "src", "coreclr", "scripts", "superpmi.py")
+            run_command([
+                "python", superpmi_script, "download",
+                "-spmi_location", staging_path,
+                "-core_root", core_root_path,
+                "-jit_ee_version", jit_ee_version,
+            ], cwd=repo_root)
+
+            downloaded_path = os.path.join(staging_path, "mch", collection_folder_name)
+            if not os.path.exists(downloaded_path):
+                print(f"Downloaded collections not found at '{downloaded_path}'.")
+                sys.exit(1)
+
+            os.makedirs(collection_folder_path, exist_ok=True)
+            for file_name in sorted(os.listdir(downloaded_path)):
+                key = f"{collection_folder_name}/{file_name}"
+                if key in index:
+                    continue
+                entry_path = os.path.join(collection_folder_path, file_name)
+                os.replace(os.path.join(downloaded_path, file_name), entry_path)
+                stat = os.stat(entry_path)
+                index[key] = {
+                    "path": os.path.join(collection_folder_name, file_name),
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "sha256": compute_file_sha256(entry_path),
+                    "last_used": time.time(),
+                }
+                print(f"Added '{file_name}' to the MCH cache.")
+            delete_directory_if_exists(staging_path)
+            version_keys = [key for key in index if key.startswith(f"{collection_folder_name}/")]
+
+        # Mark the collections as recently used and make room for them
+        now = time.time()
+        for key in version_keys:
+            index[key]["last_used"] = now
+        evict_lru_cache_entries(cache_path, index, max_bytes, protected_keys=set(version_keys))
+        save_cache_index(cache_path, index)
+    return collection_folder_path
+
+def get_directory_size(path):
+    """Return the total size in bytes of the files below a directory."""
+    total_size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            total_size += os.path.getsize(os.path.join(dir_path, file_name))
+    return total_size
+
+def get_commit_sha(cwd, ref="HEAD"):
+    """Return the commit SHA that ref points to in the repository at cwd."""
     try:
-        os.makedirs(output_folder_path, exist_ok=True)
-        for item in os.listdir(spmi_path):
-            item_path = os.path.join(spmi_path, item)
-            if os.path.isdir(item_path) and item.lower() == "mch":
-                continue  # Skip the 'mch' folder
-            shutil.move(item_path, os.path.join(output_folder_path, item))
-        print(f"Copied contents to '{output_folder_path}' successfully.")
-    except Exception as e:
-        print(f"Failed to copy contents of '{spmi_path}' to '{output_folder_path}': {e}")
+        result = run_child(["git", "rev-parse", ref], cwd=cwd, shell=USE_SHELL, capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except subprocess.CalledProcessError:
+        print(f"Failed to resolve '{ref}' in '{cwd}'.")
         sys.exit(1)
 
-    # Delete the contents of spmi_path
-    print(f"Deleting contents of '{spmi_path}'...")
+def run_build(repo_root, build_steps=BUILD_STEPS):
+    """Run the build steps that produce the Core_Root of the checked out branch."""
+    for script_path_parts, build_args in build_steps:
+        run_command([os.path.join(repo_root, *script_path_parts)] + build_args, cwd=repo_root)
+
+def describe_build_steps(build_steps=BUILD_STEPS):
+    """Return the build steps as JSON-friendly lists of the script path and its arguments."""
+    return [["/".join(script_path_parts)] + build_args for script_path_parts, build_args in build_steps]
+
+def get_build_cache_key(commit_sha):
+    """Return the build cache key of a commit: a hash of the commit SHA and the build steps."""
+    key_data = {
+        "commit": commit_sha,
+        "steps": describe_build_steps(),
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+def get_build_state_path(repo_root):
+    """Return the file recording the last successful build of the checkout at repo_root."""
+    return os.path.join(repo_root, "artifacts", BUILD_STATE_FILE_NAME)
+
+def save_build_state(repo_root, commit_sha):
+    """Record that the Core_Root of repo_root now matches commit_sha (None to forget the last build)."""
+    state_path = get_build_state_path(repo_root)
+    if commit_sha is None:
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        return
+    temp_path = get_temp_path(state_path)
+    with open(temp_path, "w") as state_file:
+        json.dump({"commit": commit_sha, "steps": describe_build_steps(), "built": time.time()}, state_file, indent=2)
+    os.replace(temp_path, state_path)
+
+def get_changed_paths(repo_root, commit_sha):
+    """Return the tracked files of the checkout at repo_root that differ from commit_sha, or None if git cannot compare them."""
+    # Without a second commit the diff also covers uncommitted changes of the working tree
+    result = run_child(["git", "diff", "--name-only", "--no-renames", commit_sha], cwd=repo_root, shell=USE_SHELL, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return [path for path in result.stdout.splitlines() if path]
+
+def plan_build(repo_root):
+    """
+    Pick the smallest build that brings the Core_Root of repo_root up to date, and return it with the reason.
+
+    The plan is 'none' when no tracked file changed since the last successful build of the checkout
+    (see save_build_state), 'jit' when every changed file is under JIT_ONLY_PATHS, and 'full' when
+    there is no usable record of the last build, its Core_Root is missing or other files changed.
+    """
+    state_path = get_build_state_path(repo_root)
+    if not os.path.exists(state_path):
+        return "full", "no earlier build of this checkout is recorded"
     try:
-        delete_directory_if_exists(spmi_path)
-        print(f"Deleted contents of '{spmi_path}' successfully.")
-    except Exception as e:
-        print(f"Failed to delete contents of '{spmi_path}': {e}")
-        sys.exit(1)
+        with open(state_path, "r") as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError) as e:
+        return "full", f"the build record '{state_path}' is unreadable: {e}"
+    if state.get("steps") != describe_build_steps():
+        return "full", "the build steps changed since the last build"
+    if not os.path.exists(os.path.join(get_core_root_path(repo_root), "clrjit.dll")):
+        return "full", "the Core_Root of the last build is missing"
 
-    return details_csv_path  # Return the dynamically created path
+    changed_paths = get_changed_paths(repo_root, state["commit"])
+    if changed_paths is None:
+        return "full", f"the last built commit {state['commit']} is not in the repository"
+    if not changed_paths:
+        return "none", f"nothing changed since the build of {state['commit']}"
+    other_paths = [path for path in changed_paths if not path.startswith(JIT_ONLY_PATHS)]
+    if other_paths:
+        return "full", f"{len(other_paths)} changed files are outside {', '.join(JIT_ONLY_PATHS)}, e.g. '{other_paths[0]}'"
+    return "jit", f"only {len(changed_paths)} JIT files changed since the build of {state['commit']}"
 
-def get_human_readable_label(csv_name):
-    # Example: 16_eGPR_JitBypassApxCheck_1_EnableApxNDD_0_EnableApxConditionalChaining_1_EnableApxPPX_0
-    pattern = (
-        r'(?P<branch>[^_]+_[^_]+)_'
-        r'JitBypassApxCheck_(?P<JitBypassApxCheck>[01])_'
-        r'EnableApxNDD_(?P<EnableApxNDD>[01])_'
-        r'EnableApxConditionalChaining_(?P<EnableApxConditionalChaining>[01])_'
-        r'EnableApxPPX_(?P<EnableApxPPX>[01])'
-    )
-    match = re.match(pattern, csv_name)
-    if not match:
-        return csv_name  # fallback
+def patch_core_root_jit(repo_root):
+    """
+    Copy the JIT binaries of a JIT-only build into the existing Core_Root of repo_root.
 
-    branch = match.group('branch').replace('_', ' ')
-    ndd = "NDD on" if match.group('EnableApxNDD') == "1" else "NDD off"
-    ccmp = "CCMP On" if match.group('EnableApxConditionalChaining') == "1" else "CCMP Off"
-    ppx = "PPX On" if match.group('EnableApxPPX') == "1" else "PPX Off"
-    # Optionally, include JitBypassApxCheck if you want
-    # jitbypass = "JitBypassApxCheck=1" if match.group('JitBypassApxCheck') == "1" else "JitBypassApxCheck=0"
-    return f"{branch}, {ndd}, {ccmp}, {ppx}"
+    Only the JIT binaries the Core_Root already has are replaced. Each is written next to its target
+    and renamed over it, so files of the Core_Root that are linked elsewhere (e.g. into the snapshot
+    store) are not modified. Returns False if the build produced no clrjit.dll.
+    """
+    binaries_path = os.path.join(repo_root, *JIT_BINARIES_PATH_PARTS)
+    core_root_path = get_core_root_path(repo_root)
+    if not os.path.exists(os.path.join(binaries_path, "clrjit.dll")):
+        print(f"The JIT build wrote no 'clrjit.dll' to '{binaries_path}'.")
+        return False
+    patched = []
+    for file_name in sorted(os.listdir(binaries_path)):
+        destination_path = os.path.join(core_root_path, file_name)
+        if not file_name.lower().startswith(JIT_BINARY_PREFIX) or not os.path.isfile(destination_path):
+            continue
+        temp_path = get_temp_path(destination_path)
+        shutil.copy2(os.path.join(binaries_path, file_name), temp_path)
+        os.replace(temp_path, destination_path)
+        patched.append(file_name)
+    print(f"Patched {', '.join(patched)} into '{core_root_path}'.")
+    return True
+
+def lookup_build_cache(key, cache_path=BUILD_CACHE_PATH):
+    """Return the cached Core_Root for a build cache key, or None if the key is not cached."""
+    # Other runs sharing the cache may store or evict entries at the same time
+    with cache_lock(cache_path):
+        index = load_cache_index(cache_path)
+        entry = index.get(key)
+        if entry is None:
+            return None
+        cached_core_root_path = os.path.join(cache_path, entry["path"])
+        if not os.path.isdir(cached_core_root_path):
+            print(f"Build cache entry '{key}' is missing on disk. Dropping it.")
+            del index[key]
+            save_cache_index(cache_path, index)
+            return None
+        entry["last_used"] = time.time()
+        save_cache_index(cache_path, index)
+    print(f"Build cache hit for '{entry['branch']}' at {entry['commit']}: '{cached_core_root_path}'.")
+    return cached_core_root_path
 
-def create_visual_representation(*details_csv_paths):
+def store_build_in_cache(key, core_root_path, branch, commit_sha, cache_path=BUILD_CACHE_PATH, max_bytes=BUILD_CACHE_MAX_BYTES, snapshot_store_path=None):
     """
-    Reads multiple diffAPX_details.csv files and creates separate graphs for:
-    - Instruction Count Difference
-    - % Instruction Count Difference
-    - % Instruction Count Difference (Ignoring Zero diffs)
+    Copy a freshly built Core_Root into the build cache and evict old builds beyond max_bytes.
+
+    With a snapshot store the cached Core_Root links to the stored files instead of being a full copy.
     """
-    if not details_csv_paths:
-        print("No CSV paths provided for visualization.")
-        sys.exit(1)
+    entry_path = os.path.join(cache_path, key)
+    temp_entry_path = get_temp_path(entry_path)
+    delete_directory_if_exists(temp_entry_path)
+    print(f"Storing '{core_root_path}' in the build cache as '{key}'...")
+    try:
+        copy_core_root(None, temp_entry_path, "Core_Root", core_root_path, snapshot_store_path)
+        delete_directory_if_exists(entry_path)
+        os.replace(temp_entry_path, entry_path)
+    except Exception as e:
+        print(f"Failed to store '{core_root_path}' in the build cache: {e}")
+        delete_directory_if_exists(temp_entry_path)
+        return
 
-    data_frames = []
-    labels = []
+    with cache_lock(cache_path):
+        index = load_cache_index(cache_path)
+        index[key] = {
+            "path": os.path.join(key, "Core_Root"),
+            "size": get_directory_size(entry_path),
+            "branch": branch,
+            "commit": commit_sha,
+            "created": time.time(),
+            "last_used": time.time(),
+        }
+        for evicted_key in evict_lru_cache_entries(cache_path, index, max_bytes, protected_keys={key}):
+            delete_directory_if_exists(os.path.join(cache_path, evicted_key))
+        save_cache_index(cache_path, index)
 
-    # Read and process each CSV file
-    for csv_path in details_csv_paths:
-        if not os.path.exists(csv_path):
-            print(f"File '{csv_path}' does not exist. Ensure the file is generated correctly.")
-            sys.exit(1)
+def build_branch(branch_root, branch, build_cache_path=None, build_cache_max_bytes=BUILD_CACHE_MAX_BYTES, snapshot_store_path=None, minimal_rebuild=True):
+    """
+    Reuse the Core_Root of an earlier build of the checked out commit, or run the build commands.
 
-        print(f"Reading diff details from '{csv_path}'...")
-        try:
-            # Read the CSV file
-            data = pd.read_csv(csv_path)
-
-            # Check if required columns exist
-            required_columns = [
-                'Collection',
-                'Instruction Count Difference',
-                '% Instruction Count Difference',
-                '% Instruction Count Difference (Ignoring Zero diffs)'
-            ]
-            for column in required_columns:
-                if column not in data.columns:
-                    print(f"Required column '{column}' is missing in '{csv_path}'.")
-                    sys.exit(1)
-
-            # Remove '.mch' and '.windows' from the Collection column
-            data['Collection'] = data['Collection'].str.replace('.mch', '', regex=False)
-            data['Collection'] = data['Collection'].str.replace(r'\.windows.*', '', regex=True)
-
-            # Dynamically generate the label
-            csv_name = os.path.splitext(os.path.basename(csv_path))[0]
-            human_readable_label = get_human_readable_label(csv_name)
-            data_frames.append(data)
-            labels.append(human_readable_label)
+    Without a build_cache_path the branch is always built. With minimal_rebuild the build is
+    planned against the last build of the checkout (see plan_build): nothing is built when no
+    file changed, and only the JIT, patched into the existing Core_Root, when only JIT files
+    changed. Returns the cached Core_Root, or None when the Core_Root in branch_root is to be used.
+    """
+    commit_sha = get_commit_sha(branch_root)
+    if build_cache_path:
+        build_cache_key = get_build_cache_key(commit_sha)
+        with profile_phase("build cache lookup", branch=branch):
+            core_root_path = lookup_build_cache(build_cache_key, build_cache_path)
+        if core_root_path is not None:
+            return core_root_path
 
-        except Exception as e:
-            print(f"Failed to read or process '{csv_path}': {e}")
-            sys.exit(1)
+    plan, reason = plan_build(branch_root) if minimal_rebuild else ("full", "minimal rebuilds are disabled")
+    print(f"Build plan for '{branch}': {plan} ({reason}).")
+    # Forget the last build until this one succeeds; an interrupted build leaves the Core_Root half updated
+    save_build_state(branch_root, None)
+    if plan == "jit":
+        with profile_phase("build", branch=branch, plan="jit"):
+            run_build(branch_root, JIT_BUILD_STEPS)
+            if not patch_core_root_jit(branch_root):
+                print("Falling back to the full build.")
+                plan = "full"
+    if plan == "full":
+        with profile_phase("build", branch=branch, plan="full"):
+            run_build(branch_root)
+    save_build_state(branch_root, commit_sha)
+    if build_cache_path:
+        with profile_phase("build cache save", branch=branch):
+            store_build_in_cache(build_cache_key, get_core_root_path(branch_root), branch, commit_sha, build_cache_path, build_cache_max_bytes, snapshot_store_path)
+    return None
+
+def list_build_cache(cache_path=BUILD_CACHE_PATH):
+    """Print the entries of the build cache, most recently used first."""
+    index = load_cache_index(cache_path)
+    if not index:
+        print(f"Build cache '{cache_path}' is empty.")
+        return
+    print(f"Build cache '{cache_path}':")
+    print(f"{'Key':<16} {'Branch':<24} {'Commit':<12} {'Size (GB)':>10}  Last used")
+    for key, entry in sorted(index.items(), key=lambda item: item[1]["last_used"], reverse=True):
+        last_used = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["last_used"]))
+        print(f"{key[:16]:<16} {entry['branch']:<24} {entry['commit'][:12]:<12} {entry['size'] / 1024 ** 3:>10.2f}  {last_used}")
+    total_size = sum(entry["size"] for entry in index.values())
+    print(f"{len(index)} entries, {total_size / 1024 ** 3:.2f} GB in total.")
 
-    # Merge all data frames on the 'Collection' column
-    merged_data = data_frames[0]
-    for i, df in enumerate(data_frames[1:], start=1):
-        merged_data = pd.merge(
-            merged_data,
-            df,
-            on='Collection',
-            suffixes=('', f'_{i}')
+def purge_build_cache(cache_path=BUILD_CACHE_PATH, keys=None):
+    """Remove build cache entries. keys may be full keys or prefixes; all entries are removed if it is empty."""
+    with cache_lock(cache_path):
+        index = load_cache_index(cache_path)
+        purged_keys = [key for key in index if not keys or any(key.startswith(prefix) for prefix in keys)]
+        for key in purged_keys:
+            print(f"Purging build cache entry '{key}' ({index[key]['branch']} at {index[key]['commit'][:12]})...")
+            delete_directory_if_exists(os.path.join(cache_path, key))
+            del index[key]
+        save_cache_index(cache_path, index)
+    print(f"Purged {len(purged_keys)} build cache entries.")
+
+@contextlib.contextmanager
+def cache_lock(cache_path, timeout=CACHE_LOCK_TIMEOUT):
+    """Hold an exclusive lock file in cache_path so parallel runs do not update its index at the same time."""
+    os.makedirs(cache_path, exist_ok=True)
+    lock_path = os.path.join(cache_path, "lock")
+    deadline = time.time() + timeout
+    while True:
+        try:
+            lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.time() > deadline:
+                print(f"Timed out waiting for the lock '{lock_path}'. Delete it if no other run is using the cache.")
+                sys.exit(1)
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        os.close(lock_fd)
+        os.remove(lock_path)
+
+def get_collection_set_fingerprint(mch_files):
+    """Describe the collections in an MCH cache folder by name and checksum (or size if they are not indexed)."""
+    cache_path = os.path.dirname(os.path.abspath(mch_files))
+    collection_folder_name = os.path.basename(os.path.abspath(mch_files))
+    index = load_cache_index(cache_path)
+    collections = sorted(
+        (key, entry["sha256"]) for key, entry in index.items() if key.startswith(f"{collection_folder_name}/")
+    )
+    if not collections:
+        collections = sorted(
+            (file_name, os.path.getsize(os.path.join(mch_files, file_name))) for file_name in os.listdir(mch_files)
         )
+    return collections
 
-    # Define the columns to plot
-    columns_to_plot = [
-        'Instruction Count Difference',
-        '% Instruction Count Difference',
-        '% Instruction Count Difference (Ignoring Zero diffs)'
-    ]
+def get_result_key(base_jit_path, diff_jit_path, base_jit_options, diff_jit_options, mch_files, replay_args=(), base_once=False):
+    """
+    Return the result store key of a SuperPMI run: a hash of both JITs, their options and the collections.
 
-    # Add explanations for each graph
-    explanations = {
-        'Instruction Count Difference': r"$\bf{Instruction\ Count\ Difference}$ = $\bf{(Diff\ Instr\ Count\ -\ Base\ Instr\ Count)}$",
-        '% Instruction Count Difference': r"$\bf{\% Instruction\ Count\ Difference}$ = $\bf{\frac{(Diff\ Instr\ Count\ -\ Base\ Instr\ Count)\ \times\ 100}{Base\ Instr\ Count}}$",
-        '% Instruction Count Difference (Ignoring Zero diffs)': r"$\bf{\% Instruction\ Count\ Difference\ (Ignoring\ Zero\ Diffs)}$ = $\bf{\frac{(Diff\ Instr\ Count\ -\ Base\ Instr\ Count)\ \times\ 100}{Base\ Instr\ Count}}$ only for methods with diff"
+    replay_args (such as -filter and -compile) narrow down what is replayed and are part of the key.
+    So is base_once: a run comparing the diff JIT with stored base metrics (see replay_diff_against_base)
+    leaves out methods only one JIT compiled and has fewer asm dumps than a full asmdiffs run.
+    """
+    key_data = {
+        "base_jit": compute_file_sha256(base_jit_path),
+        "diff_jit": compute_file_sha256(diff_jit_path),
+        "base_jit_options": sorted(base_jit_options),
+        "diff_jit_options": sorted(diff_jit_options),
+        "collections": get_collection_set_fingerprint(mch_files),
     }
+    if replay_args:
+        key_data["replay_args"] = list(replay_args)
+    if base_once:
+        key_data["base_once"] = True
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
 
-    # Create a graph for each column
-    for column in columns_to_plot:
-        print(f"Creating graph for column: {column}")
-        plt.figure(figsize=(16, 10))
-
-        # Plot each dataset
-        x = range(len(merged_data['Collection']))
-        width = 0.2  # Bar width
-        gap = 0.5  # Gap between collections
-        for i, label in enumerate(labels):
-            column_name = column if i == 0 else f"{column}_{i}"
-            bar_positions = [pos + (i * width) + (gap * pos) for pos in x]
-            bar_values = merged_data[column_name]
-            plt.bar(
-                bar_positions,
-                bar_values,
-                width=width,
-                label=label
-            )
+def restore_stored_result(key, details_csv_path, output_folder_path, store_path=RESULT_STORE_PATH):
+    """Copy the details CSV and output folder of a stored run to the given locations. Returns False on a miss."""
+    with cache_lock(store_path):
+        index = load_cache_index(store_path)
+        entry = index.get(key)
+        if entry is None or not os.path.isdir(os.path.join(store_path, entry["path"])):
+            return False
+        entry["last_used"] = time.time()
+        save_cache_index(store_path, index)
 
-            # Add values above the bars
-            for pos, value in zip(bar_positions, bar_values):
-                plt.text(
-                    pos, 
-                    value + (0.02 * (value) if value != 0 else 0.1),  # Position slightly above the bar
-                    f"{value:.2f}", 
-                    ha='center', 
-                    va='bottom', 
-                    fontsize=8
-                )
+    entry_path = os.path.join(store_path, entry["path"])
+    print(f"Result store hit for '{os.path.basename(details_csv_path)}'. Restoring the results of an earlier run...")
+    if os.path.exists(details_csv_path):
+        os.remove(details_csv_path)
+    clone_file(os.path.join(entry_path, "details.csv"), details_csv_path)
+    delete_directory_if_exists(output_folder_path)
+    shutil.copytree(os.path.join(entry_path, "output"), output_folder_path, copy_function=clone_file)
+    return True
 
-        # Configure the graph
-        plt.xlabel("Collection")
-        plt.ylabel(column)
-        plt.title(
-            f"{column}",
-            fontweight="bold",  # Make the header bold
-            fontsize=16         # Use a larger font size for the header
-        )
-        plt.xticks(
-            [pos + (width * (len(labels) - 1) / 2) + (gap * pos) for pos in x],
-            merged_data['Collection'],
-            rotation=45,
-            fontsize=10
-        )
-        plt.legend()
-        plt.tight_layout()
+def store_result(key, details_csv_path, output_folder_path, store_path=RESULT_STORE_PATH, max_bytes=RESULT_STORE_MAX_BYTES):
+    """Keep the details CSV and output folder of a SuperPMI run in the result store."""
+    entry_path = os.path.join(store_path, key)
+    temp_entry_path = get_temp_path(entry_path)
+    delete_directory_if_exists(temp_entry_path)
+    try:
+        os.makedirs(temp_entry_path)
+        clone_file(details_csv_path, os.path.join(temp_entry_path, "details.csv"))
+        shutil.copytree(output_folder_path, os.path.join(temp_entry_path, "output"), copy_function=clone_file)
+    except Exception as e:
+        print(f"Failed to store the results of '{details_csv_path}': {e}")
+        delete_directory_if_exists(temp_entry_path)
+        return
 
-        # Add explanation text to the graph
-        explanation = explanations.get(column, "")
-        plt.figtext(0.5, -0.05, explanation, wrap=True, horizontalalignment='center', fontsize=10)
+    with cache_lock(store_path):
+        delete_directory_if_exists(entry_path)
+        os.replace(temp_entry_path, entry_path)
+        index = load_cache_index(store_path)
+        index[key] = {
+            "path": key,
+            "size": get_directory_size(entry_path),
+            "name": os.path.basename(details_csv_path),
+            "last_used": time.time(),
+        }
+        evict_lru_cache_entries(store_path, index, max_bytes, protected_keys={key})
+        save_cache_index(store_path, index)
+    print(f"Stored the results of '{os.path.basename(details_csv_path)}' in the result store.")
 
-        # Invert the y-axis to flip the graph
-        plt.gca().invert_yaxis()
+def report_result_store(destination_path, csv_prefix, diff_coreroot_path, diff_jit_options_list, base_jit_options, mch_files, store_path=RESULT_STORE_PATH, force_rerun=False, replay_args=(), base_once=False):
+    """Print which configurations the result store already holds, also on the console from a pipeline stage. Returns a (hits, misses) tuple."""
+    index = load_cache_index(store_path)
+    base_jit_path = os.path.join(destination_path, "base", "clrjit.dll")
+    diff_jit_path = os.path.join(diff_coreroot_path, "clrjit.dll")
+    hits = []
+    misses = []
+    for diff_jit_options in diff_jit_options_list:
+        name = get_configuration_name(csv_prefix, diff_jit_options)
+        key = get_result_key(base_jit_path, diff_jit_path, base_jit_options, diff_jit_options, mch_files, replay_args, base_once)
+        if key in index and not force_rerun:
+            hits.append(name)
+        else:
+            misses.append(name)
 
-        # Save the graph
-        graph_path = os.path.join(os.path.dirname(details_csv_paths[0]), f"{column.replace(' ', '_').lower()}_comparison.png")
-        plt.savefig(graph_path, bbox_inches="tight")
-        print(f"Graph for column '{column}' saved at '{graph_path}'.")
+    report = [f"Result store for '{csv_prefix}': {len(hits)} hits, {len(misses)} misses{' (recomputation forced)' if force_rerun else ''}."]
+    report.extend(f"    hit:  {name}" for name in hits)
+    report.extend(f"    miss: {name}" for name in misses)
+    print_to_console("\n".join(report))
+    return hits, misses
 
-        # Show the graph
-        # plt.show()
+def get_configuration_name(csv_prefix, diff_jit_options):
+    """Return the unique name used for the details CSV and output folder of a configuration."""
+    options_suffix = "_".join(option.replace("=", "_") for option in diff_jit_options)
+    return f"{csv_prefix}_{options_suffix}"
 
-if __name__ == "__main__":
-    print("Starting the script...")
+def get_replay_args(filters=None, compile_contexts=None):
+    """Return the superpmi.py arguments limiting a replay to some collections (-filter) or method contexts (-compile)."""
+    replay_args = []
+    if filters:
+        replay_args.extend(["-filter"] + list(filters))
+    if compile_contexts:
+        replay_args.extend(["-compile", compile_contexts])
+    return replay_args
 
-    # Create a new folder 'runResults' parallel to the 'runtime' repository
-    run_results_path = os.path.abspath(os.path.join(DIR_NAME, "..", "runResults"))
-    if os.path.exists(run_results_path):
-        print(f"'runResults' folder already exists at: {run_results_path}. Deleting its contents...")
-        try:
-            # Delete all contents of the folder
-            for item in os.listdir(run_results_path):
-                item_path = os.path.join(run_results_path, item)
-                if os.path.isdir(item_path):
-                    shutil.rmtree(item_path)
-                else:
-                    os.remove(item_path)
-            print(f"All contents of 'runResults' folder deleted successfully.")
-        except Exception as e:
-            print(f"Failed to delete contents of 'runResults' folder: {e}")
-            sys.exit(1)
+def run_superpmi(repo_root, destination_path, csv_prefix, diff_coreroot_path, diff_jit_options, base_jit_options, spmi_location=None, parallelism=None, mch_files=None, result_store_path=None, force_rerun=False, filters=None, compile_contexts=None, name_suffix="", archive_outputs=True, reuse_base=False):
+    """
+    Run the superpmi.py command with specified csv_prefix and diff_jit_options.
+
+    By default SuperPMI works in the repository's artifacts\\spmi directory. Pass a private
+    spmi_location to allow several configurations to run at the same time, and parallelism
+    to limit the number of cores the replay may use. mch_files points SuperPMI at already
+    downloaded collections (see prime_mch_cache) instead of downloading them again.
+    filters only replays the collections whose names contain one of them, and compile_contexts
+    only the given method contexts (e.g. '1-50,1001-1050'); name_suffix is added to the names of
+    the details CSV and output folder of such partial runs. With archive_outputs the asm dumps
+    in the output folder are packed into a compressed archive (see archive_spmi_outputs).
+    With reuse_base (and mch_files) the base JIT is replayed only once for all configurations
+    (see replay_base_metrics) and this run only replays the diff JIT (see replay_diff_against_base).
+
+    With a result_store_path, a run whose JITs, options and collections match an earlier run
+    returns the stored details CSV and output folder instead of replaying, unless force_rerun is set.
+    """
+    # Delete the SPMI directory (artifacts\spmi unless a private location is given) if it exists
+    spmi_path = spmi_location if spmi_location else os.path.join(repo_root, "artifacts", "spmi")
+    delete_directory_if_exists(spmi_path)
+
+    # Create a unique name for the details CSV file based on csv_prefix and diff_jit_options
+    config_name = get_configuration_name(csv_prefix, diff_jit_options) + name_suffix
+    details_csv_path = os.path.join(destination_path, f"{config_name}.csv")
+    replay_args = get_replay_args(filters, compile_contexts)
+
+    base_core_root_path = os.path.join(destination_path, "base")
+    base_jit_path = os.path.join(base_core_root_path, "clrjit.dll")
+    diff_jit_path = os.path.join(diff_coreroot_path, "clrjit.dll")
+    superpmi_script = os.path.join(repo_root, "src", "coreclr", "scripts", "superpmi.py")
+    output_folder_path = os.path.join(destination_path, config_name)
+
+    # Reuse the results of an earlier run of the same JITs, options and collections
+    result_key = None
+    if result_store_path and mch_files:
+        result_key = get_result_key(base_jit_path, diff_jit_path, base_jit_options, diff_jit_options, mch_files, replay_args, reuse_base)
+        with profile_phase("result store lookup", branch=csv_prefix, options=" ".join(diff_jit_options)):
+            restored = not force_rerun and restore_stored_result(result_key, details_csv_path, output_folder_path, result_store_path)
+        if restored:
+            return details_csv_path
+
+    # Remove earlier results; restored files may share their data with the result store
+    if os.path.exists(details_csv_path):
+        os.remove(details_csv_path)
+    delete_directory_if_exists(output_folder_path)
+
+    if reuse_base and mch_files:
+        base_metrics_path = replay_base_metrics(destination_path, base_core_root_path, base_jit_options, mch_files, parallelism, filters, compile_contexts)
+        with profile_phase("superpmi replay", branch=csv_prefix, options=" ".join(diff_jit_options)):
+            replay_diff_against_base(base_metrics_path, base_core_root_path, base_jit_options, diff_jit_path, diff_jit_options, mch_files, spmi_path, details_csv_path, parallelism, filters, compile_contexts)
     else:
-        print(f"'runResults' folder does not exist. Creating it at: {run_results_path}")
+        if reuse_base:
+            print("Replaying the base once needs the MCH cache. Running a full asmdiffs instead.")
+        # Build the command
+        command = [
+            "python", superpmi_script, "asmdiffs",
+            "-details", details_csv_path,
+            "-base_jit_path", base_jit_path,
+            "-diff_jit_path", diff_jit_path,
+            # Use the copied Core_Root, the build in the repository may belong to another branch
+            "-core_root", base_core_root_path,
+        ]
+
+        # Add all diff_jit_options to the command
+        for option in base_jit_options:
+            command.extend(["-base_jit_option", option])
+
+        # Add all diff_jit_options to the command
+        for option in diff_jit_options:
+            command.extend(["-diff_jit_option", option])
+
+        # Replay the collections from the shared MCH cache
+        if mch_files:
+            command.extend(["-mch_files", mch_files])
+
+        # Keep the outputs of this run in its own location
+        if spmi_location:
+            command.extend(["-spmi_location", spmi_location])
+
+        # Limit the number of cores used by the replay
+        if parallelism:
+            command.extend(["-parallelism", str(parallelism)])
+
+        # Only replay some collections or method contexts
+        command.extend(replay_args)
+
+        print(f"Running SuperPMI command: {' '.join(command)}")
+        with profile_phase("superpmi replay", branch=csv_prefix, options=" ".join(diff_jit_options)):
+            run_command(command, cwd=repo_root)
+
+    # Publish everything except the 'mch' folder from spmi_path as a new folder in destination_path
+    if not os.path.exists(spmi_path):
+        print(f"SPMI path '{spmi_path}' does not exist. Ensure the SuperPMI command ran successfully.")
+        sys.exit(1)
+
+    with profile_phase("collect superpmi outputs", branch=csv_prefix, options=" ".join(diff_jit_options)):
         try:
-            os.makedirs(run_results_path)
-            print(f"'runResults' folder created successfully.")
+            collect_spmi_outputs(spmi_path, output_folder_path, archive_outputs)
         except Exception as e:
-            print(f"Failed to create 'runResults' folder: {e}")
+            print(f"Failed to collect the outputs of '{spmi_path}' in '{output_folder_path}': {e}")
             sys.exit(1)
 
-    # Add jitutils\bin to the PATH environment variable
-    jitutils_bin_path = os.path.abspath(os.path.join(JITUTILS_DIR_NAME, "bin"))
-    os.environ["PATH"] += os.pathsep + jitutils_bin_path
-    print(f"Added '{jitutils_bin_path}' to PATH.")
+    if result_key:
+        with profile_phase("result store save", branch=csv_prefix, options=" ".join(diff_jit_options)):
+            store_result(result_key, details_csv_path, output_folder_path, result_store_path)
 
-    # Get the absolute path to the repository directory
-    repo_root = os.path.abspath(DIR_NAME)
-    print(f"Repository root path: {repo_root}")
+    return details_csv_path  # Return the dynamically created path
+
+def collect_spmi_outputs(spmi_path, output_folder_path, archive=True):
+    """
+    Publish the outputs of a SuperPMI run from spmi_path as output_folder_path, leaving out the 'mch' folder.
 
-    # Check if the repository directory already exists
-    if os.path.exists(repo_root):
-        print(f"Directory '{repo_root}' already exists. Skipping cloning step.")
+    The outputs are gathered (and, with archive, packed by archive_spmi_outputs) in a temporary
+    folder next to output_folder_path, which is then renamed into place, so the output folder
+    either holds all outputs of the run or does not exist. When spmi_path has no 'mch' folder and
+    is on the same volume, it is renamed as a whole instead of item by item.
+    """
+    staging_path = get_temp_path(output_folder_path)
+    delete_directory_if_exists(staging_path)
+    same_volume = os.stat(spmi_path).st_dev == os.stat(os.path.dirname(output_folder_path)).st_dev
+    items = os.listdir(spmi_path)
+    if same_volume and not any(item.lower() == "mch" and os.path.isdir(os.path.join(spmi_path, item)) for item in items):
+        print(f"Renaming '{spmi_path}' to '{output_folder_path}'...")
+        os.replace(spmi_path, staging_path)
     else:
-        # Clone the repository
-        clone_repo(REPO_URL, DIR_NAME)
-
-    # Define branches to test
-    branches = ["16_eGPR"]  # Add your branch names here
-
-    # Define diff_jit_options for each branch
-    diff_jit_options_16_eGPR = [
-        ["JitBypassApxCheck=1", "EnableApxNDD=0", "EnableApxConditionalChaining=0", "EnableApxPPX=0"],
-        #["JitBypassApxCheck=1", "EnableApxNDD=1", "EnableApxConditionalChaining=0", "EnableApxPPX=0"],
-        ["JitBypassApxCheck=1", "EnableApxNDD=0", "EnableApxConditionalChaining=0", "EnableApxPPX=1"],
-        ["JitBypassApxCheck=1", "EnableApxNDD=1", "EnableApxConditionalChaining=1", "EnableApxPPX=1"]
-    ]
-    diff_jit_options_future_branch = [
-        ["JitBypassApxCheck=1", "EnableApxNDD=0", "EnableApxConditionalChaining=0", "EnableApxPPX=0"]
-    ]
-    # Define base_jit_options as a flat list
-    base_jit_options = [
-        "JitBypassApxCheck=0",
-        "EnableApxNDD=0",
-        "EnableApxConditionalChaining=0",
-        "EnableApxPPX=0"
-    ]
+        print(f"Moving contents of '{spmi_path}' (excluding 'mch') to '{output_folder_path}'...")
+        os.makedirs(staging_path)
+        for item in items:
+            item_path = os.path.join(spmi_path, item)
+            if os.path.isdir(item_path) and item.lower() == "mch":
+                continue  # Skip the 'mch' folder
+            if not same_volume:
+                record_phase_bytes("moved", get_path_size(item_path))
+            shutil.move(item_path, os.path.join(staging_path, item))
+        delete_directory_if_exists(spmi_path)
 
-    # Collect all CSV paths for both branches
-    all_details_csv_paths = []
+    if archive:
+        archive_spmi_outputs(staging_path)
+    delete_directory_if_exists(output_folder_path)
+    os.replace(staging_path, output_folder_path)
+    print(f"Outputs of the run are in '{output_folder_path}'.")
 
-    # Iterate over branches and run superpmi for each branch
-    for branch in branches:
-        print(f"Processing branch: {branch}")
-        checkout_branch(branch, cwd=repo_root)
+def get_superpmi_tool_path(core_root_path):
+    """Return the superpmi.exe of a Core_Root."""
+    superpmi_path = os.path.join(core_root_path, "superpmi.exe")
+    if not os.path.exists(superpmi_path):
+        print(f"'{superpmi_path}' does not exist. Ensure the build step completed successfully.")
+        sys.exit(1)
+    return superpmi_path
 
-        # Run the build commands after checking out the branch
-        build_cmd_path = os.path.join(repo_root, "build.cmd")
-        tests_build_cmd_path = os.path.join(repo_root, "src", "tests", "build.cmd")
-        run_command([build_cmd_path, "clr+libs", "-rc", "checked", "-lc", "Release"], cwd=repo_root)
-        run_command([tests_build_cmd_path, "x64", "Checked", "generatelayoutonly"], cwd=repo_root)
+def get_mch_collections(mch_files, filters=None):
+    """Return the paths of the collections in an MCH folder, only those whose names contain one of filters if given."""
+    file_names = sorted(file_name for file_name in os.listdir(mch_files) if file_name.lower().endswith(".mch"))
+    if filters:
+        file_names = [file_name for file_name in file_names if any(value.lower() in file_name.lower() for value in filters)]
+    if not file_names:
+        print(f"No collections to replay in '{mch_files}'.")
+        sys.exit(1)
+    return [os.path.join(mch_files, file_name) for file_name in file_names]
 
-        # Copy Core_Root to the results folder and rename it to 'base' only for the '16_eGPR' branch
-        if branch == "16_eGPR":
-            copy_core_root(repo_root, run_results_path, "base")
+def replay_jit_metrics(superpmi_path, jit_path, jit_options, mch_path, details_path, parallelism=None, compile_contexts=None):
+    """
+    Replay one collection with a single JIT and write the per-method details (superpmi.exe -details) to details_path.
 
-        # Copy Core_Root to the results folder and rename it to the branch name
-        copy_core_root(repo_root, run_results_path, branch)
+    superpmi.exe exits with an error when some methods fail to compile or miss data, so the
+    replay only fails when it wrote no details at all.
+    """
+    command = [superpmi_path, "-details", details_path, "-p"] + ([str(parallelism)] if parallelism else [])
+    if compile_contexts:
+        command.extend(["-c", compile_contexts])
+    for option in jit_options:
+        command.extend(["-jitoption", option])
+    command.extend([jit_path, mch_path])
+    print(f"Running command: {' '.join(command)}")
+    result = run_child(command, **get_stage_output_args())
+    if not os.path.exists(details_path):
+        print(f"Failed to replay '{mch_path}' with '{jit_path}' (exit code {result.returncode}).")
+        sys.exit(1)
+    if result.returncode != 0:
+        print(f"Replaying '{mch_path}' with '{jit_path}' reported failures (exit code {result.returncode}). Comparing the methods that compiled.")
 
-        diff_coreroot_path = os.path.join(run_results_path, branch)
+def read_jit_metrics(details_path):
+    """Read the context, method name and instruction count of every method from the details of a single-JIT replay."""
+    # superpmi.exe lists the results of a single JIT under the base columns
+    columns = find_method_details_columns(details_path, required_roles=("context", "base"))
+    if columns is None:
+        print(f"'{details_path}' has no method contexts and instruction counts.")
+        sys.exit(1)
+    roles = [role for role in ("context", "method", "base") if role in columns]
+    data = pd.read_csv(details_path, usecols=[columns[role] for role in roles])
+    data = data.rename(columns={columns[role]: role for role in roles}).dropna(subset=["context", "base"])
+    if "method" not in data.columns:
+        data["method"] = data["context"].astype(str)
+    return data.rename(columns={"base": "instructions"}).astype({"context": int})
 
-        # Run superpmi for the specific configurations
-        if branch == "16_eGPR":
-            for diff_jit_options in diff_jit_options_16_eGPR:
-                csv_prefix = f"{branch}"
-                details_csv_path = run_superpmi(
-                    repo_root,
-                    run_results_path,
-                    csv_prefix,
-                    diff_coreroot_path,
-                    diff_jit_options,
-                    base_jit_options
-                )
-                all_details_csv_paths.append(details_csv_path)
-        elif branch == "future_branch":
-            for diff_jit_options in diff_jit_options_future_branch:
-                csv_prefix = f"{branch}"
+def replay_base_metrics(destination_path, base_core_root_path, base_jit_options, mch_files, parallelism=None, filters=None, compile_contexts=None):
+    """
+    Replay the base JIT over the collections once and return the folder holding its per-method metrics.
+
+    The folder, '<destination_path>/base_metrics/<key>', has the details of every collection. The
+    key covers the base JIT, its options, the collections and the replayed contexts, so every
+    configuration compared with the same base reuses it. Configurations starting at the same time
+    wait for the first one to finish the replay.
+    """
+    base_jit_path = os.path.join(base_core_root_path, "clrjit.dll")
+    key_data = {
+        "base_jit": compute_file_sha256(base_jit_path),
+        "base_jit_options": sorted(base_jit_options),
+        "collections": get_collection_set_fingerprint(mch_files),
+        "replay_args": get_replay_args(filters, compile_contexts),
+    }
+    key = hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+    metrics_path = os.path.join(destination_path, BASE_METRICS_DIR_NAME, key[:16])
+    with BASE_METRICS_LOCK:
+        if os.path.isdir(metrics_path):
+            print(f"Reusing the base metrics in '{metrics_path}'.")
+            return metrics_path
+
+        superpmi_path = get_superpmi_tool_path(base_core_root_path)
+        staging_path = get_temp_path(metrics_path)
+        delete_directory_if_exists(staging_path)
+        os.makedirs(staging_path)
+        with profile_phase("base replay", options=" ".join(base_jit_options)):
+            for mch_path in get_mch_collections(mch_files, filters):
+                details_path = os.path.join(staging_path, f"{os.path.basename(mch_path)}.csv")
+                replay_jit_metrics(superpmi_path, base_jit_path, base_jit_options, mch_path, details_path, parallelism, compile_contexts)
+        os.replace(staging_path, metrics_path)
+        print(f"Base metrics saved in '{metrics_path}'.")
+    return metrics_path
+
+def write_methods_asm(superpmi_path, jit_path, jit_options, mch_path, methods, asm_folder_path):
+    """
+    Write the disassembly of some method contexts of a collection, compiled by jit_path with jit_options, to '<asm_folder_path>/<context>.dasm'.
+
+    methods is a list of (context, method name). They are compiled in one superpmi.exe run whose
+    listing is split at the header of every method. The listings are matched with the methods in
+    context order, by name unless there is exactly one listing per method.
+    """
+    os.makedirs(asm_folder_path, exist_ok=True)
+    listing_path = get_temp_path(os.path.join(asm_folder_path, "listing.txt"))
+    command = [superpmi_path, "-c", ",".join(str(context) for context, _ in methods)]
+    for option in list(jit_options) + ["JitDisasm=*", "JitDisasmDiffable=1", f"JitStdOutFile={listing_path}"]:
+        command.extend(["-jitoption", option])
+    command.extend([jit_path, mch_path])
+    run_child(command, capture_output=True)
+    if not os.path.exists(listing_path):
+        print(f"No asm was written for {len(methods)} methods of '{mch_path}' with '{jit_path}'.")
+        return
+
+    with open(listing_path, "r", errors="replace") as listing_file:
+        listings = re.split(r"(?m)^(?=; Assembly listing for method )", listing_file.read())
+    os.remove(listing_path)
+    listings = [listing for listing in listings if listing.startswith("; Assembly listing for method ")]
+    if len(listings) == len(methods):
+        matched = zip((context for context, _ in methods), listings)
+    else:
+        matched = []
+        position = 0
+        for listing in listings:
+            header = listing.split("\n", 1)[0]
+            while position < len(methods) and methods[position][1] not in header:
+                position += 1
+            if position == len(methods):
+                break
+            matched.append((methods[position][0], listing))
+            position += 1
+    for context, listing in matched:
+        with open(os.path.join(asm_folder_path, f"{context}.dasm"), "w") as asm_file:
+            asm_file.write(listing)
+
+def replay_diff_against_base(base_metrics_path, base_core_root_path, base_jit_options, diff_jit_path, diff_jit_options, mch_files, spmi_path, details_csv_path, parallelism=None, filters=None, compile_contexts=None):
+    """
+    Replay only the diff JIT and compare it with the base metrics stored by replay_base_metrics.
+
+    Writes the details CSV with the same columns as superpmi.py asmdiffs, the per-method details of
+    every collection ('details/<collection>.csv') and the asm of the base and diff JIT for up to
+    BASE_REUSE_ASM_LIMIT changed methods per collection ('asm.asmdiffs/<collection>/base|diff/<context>.dasm')
+    in spmi_path. Methods that only one of the JITs compiled are left out.
+    """
+    superpmi_path = get_superpmi_tool_path(base_core_root_path)
+    base_jit_path = os.path.join(base_core_root_path, "clrjit.dll")
+    details_path = os.path.join(spmi_path, "details")
+    diff_metrics_path = os.path.join(spmi_path, "diff_metrics")
+    os.makedirs(details_path, exist_ok=True)
+    os.makedirs(diff_metrics_path, exist_ok=True)
+
+    rows = []
+    asm_jobs = []
+    for mch_path in get_mch_collections(mch_files, filters):
+        collection = os.path.basename(mch_path)
+        diff_details_path = os.path.join(diff_metrics_path, f"{collection}.csv")
+        replay_jit_metrics(superpmi_path, diff_jit_path, diff_jit_options, mch_path, diff_details_path, parallelism, compile_contexts)
+        base = read_jit_metrics(os.path.join(base_metrics_path, f"{collection}.csv"))
+        diff = read_jit_metrics(diff_details_path)
+        methods = base.merge(diff[["context", "instructions"]], on="context", suffixes=("_base", "_diff"))
+
+        methods.rename(columns={
+            "context": "Context",
+            "method": "Method full name",
+            "instructions_base": "Base instructions",
+            "instructions_diff": "Diff instructions",
+        }).assign(Collection=collection)[
+            ["Context", "Method full name", "Collection", "Base instructions", "Diff instructions"]
+        ].to_csv(os.path.join(details_path, f"{collection}.csv"), index=False)
+
+        difference = methods["instructions_diff"] - methods["instructions_base"]
+        base_total = methods["instructions_base"].sum()
+        changed_base_total = methods.loc[difference != 0, "instructions_base"].sum()
+        rows.append({
+            'Collection': collection,
+            'Instruction Count Difference': difference.sum(),
+            '% Instruction Count Difference': difference.sum() * 100 / base_total if base_total else 0.0,
+            '% Instruction Count Difference (Ignoring Zero diffs)': difference.sum() * 100 / changed_base_total if changed_base_total else 0.0,
+        })
+
+        # Generate the asm of the largest changes, like superpmi.py does for every diff
+        changed = methods.loc[difference[difference != 0].abs().sort_values(ascending=False).index[:BASE_REUSE_ASM_LIMIT]].sort_values("context")
+        if not changed.empty:
+            changed_methods = list(zip(changed["context"], changed["method"]))
+            for side, jit_path, jit_options in (("base", base_jit_path, base_jit_options), ("diff", diff_jit_path, diff_jit_options)):
+                asm_jobs.append((superpmi_path, jit_path, jit_options, mch_path, changed_methods, os.path.join(spmi_path, "asm.asmdiffs", collection, side)))
+
+    if asm_jobs:
+        print(f"Generating the asm of {sum(len(job[4]) for job in asm_jobs) // 2} changed methods...")
+        with ThreadPoolExecutor(max_workers=parallelism or os.cpu_count() or 1) as executor:
+            list(executor.map(lambda job: write_methods_asm(*job), asm_jobs))
+
+    delete_directory_if_exists(diff_metrics_path)
+    pd.DataFrame(rows, columns=DETAILS_COLUMNS).to_csv(details_csv_path, index=False)
+    print(f"Compared the diff JIT with the base metrics of {len(rows)} collections in '{details_csv_path}'.")
+
+def start_pinned_process(command, cpus, **popen_args):
+    """Start a process already restricted to the given CPU numbers, so that none of its startup runs on other CPUs."""
+    if hasattr(os, "sched_setaffinity"):
+        # Pin the child between fork and exec
+        return subprocess.Popen(command, preexec_fn=lambda: os.sched_setaffinity(0, cpus), **popen_args)
+    if os.name != "nt":
+        print("Pinning processes to CPUs is not supported on this platform. Run without -tp_cpus.")
+        sys.exit(1)
+    import ctypes  # Only needed for SetProcessAffinityMask on Windows
+    # Create the process suspended (CREATE_SUSPENDED), pin it and only then let it start
+    process = subprocess.Popen(command, creationflags=0x00000004, **popen_args)
+    handle = int(process._handle)
+    if not ctypes.windll.kernel32.SetProcessAffinityMask(handle, ctypes.c_size_t(sum(1 << cpu for cpu in cpus))):
+        process.kill()
+        process.wait()
+        print(f"Failed to pin process {process.pid} to CPUs {cpus}.")
+        sys.exit(1)
+    ctypes.windll.ntdll.NtResumeProcess(handle)
+    return process
+
+def time_jit_replay(superpmi_path, jit_path, jit_options, mch_path, cpus=None, compile_contexts=None):
+    """Replay one collection with a single JIT in one process, pinned to cpus if given, and return the wall time in seconds and the exit code."""
+    command = [superpmi_path]
+    if compile_contexts:
+        command.extend(["-c", compile_contexts])
+    for option in jit_options:
+        command.extend(["-jitoption", option])
+    command.extend([jit_path, mch_path])
+    start = time.perf_counter()
+    # Printing every method would be timed too, so the replay's output is dropped
+    if cpus:
+        process = start_pinned_process(command, cpus, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    returncode, cpu_seconds, peak_rss = wait_for_child(process)
+    seconds = time.perf_counter() - start
+    record_child_usage(cpu_seconds, peak_rss)
+    return seconds, returncode
+
+def get_median_and_mad(values):
+    """Return the median of values and their median absolute deviation (MAD) from it."""
+    values = np.asarray(values, dtype=float)
+    median = float(np.median(values))
+    return median, float(np.median(np.abs(values - median)))
+
+def run_throughput(destination_path, csv_prefix, diff_coreroot_path, diff_jit_options, base_jit_options, mch_files, filters=None, compile_contexts=None, repeats=TP_REPEATS, warmup=TP_WARMUP, cpus=None):
+    """
+    Time the replays of the base and diff JITs over every collection and return the path of the throughput CSV.
+
+    Each collection is replayed warmup times with both JITs untimed, then in repeats rounds of one
+    timed base and one timed diff replay, alternating which JIT goes first so that drifts of the
+    machine hit both. Every replay runs in a single process, pinned to cpus if given. The times of
+    every replay go to '<config>_tp_runs.csv' and the median and MAD of the times and of the
+    per-round % differences to '<config>_tp.csv', whose TP_COLUMNS can be drawn by
+    create_visual_representation. Medians and MADs keep a few disturbed rounds from moving the
+    results; rounds far from the median are only counted in the 'Outliers' column.
+    """
+    config_name = get_configuration_name(csv_prefix, diff_jit_options) + TP_NAME_SUFFIX
+    tp_csv_path = os.path.join(destination_path, f"{config_name}.csv")
+    runs_csv_path = os.path.join(destination_path, f"{config_name}_runs.csv")
+    base_core_root_path = os.path.join(destination_path, "base")
+    superpmi_path = get_superpmi_tool_path(base_core_root_path)
+    jits = {
+        "Base": (os.path.join(base_core_root_path, "clrjit.dll"), base_jit_options),
+        "Diff": (os.path.join(diff_coreroot_path, "clrjit.dll"), diff_jit_options),
+    }
+
+    runs = []
+    rows = []
+    for mch_path in get_mch_collections(mch_files, filters):
+        collection = os.path.basename(mch_path)
+        print(f"Timing {warmup} warmup and {repeats} timed rounds of '{collection}'{f' on CPUs {cpus}' if cpus else ''}...")
+        for _ in range(warmup):
+            for side, (jit_path, jit_options) in jits.items():
+                _, returncode = time_jit_replay(superpmi_path, jit_path, jit_options, mch_path, cpus, compile_contexts)
+                if returncode != 0:
+                    print(f"Replaying '{collection}' with the {side.lower()} JIT reported failures (exit code {returncode}). Timing it anyway.")
+
+        times = {"Base": [], "Diff": []}
+        for round_index in range(repeats):
+            order = ["Base", "Diff"] if round_index % 2 == 0 else ["Diff", "Base"]
+            for side in order:
+                jit_path, jit_options = jits[side]
+                seconds, returncode = time_jit_replay(superpmi_path, jit_path, jit_options, mch_path, cpus, compile_contexts)
+                times[side].append(seconds)
+                runs.append([collection, round_index + 1, side, seconds, returncode])
+
+        differences = [(diff - base) * 100 / base for base, diff in zip(times["Base"], times["Diff"])]
+        base_median, base_mad = get_median_and_mad(times["Base"])
+        diff_median, diff_mad = get_median_and_mad(times["Diff"])
+        difference_median, difference_mad = get_median_and_mad(differences)
+        outliers = sum(abs(value - difference_median) > TP_OUTLIER_MADS * TP_MAD_SCALE * difference_mad for value in differences)
+        rows.append([collection, base_median, base_mad, diff_median, diff_mad, difference_median, difference_mad, repeats, outliers])
+        print(f"    {collection}: {difference_median:+.2f}% (MAD {difference_mad:.2f}%, {outliers} outlier rounds)")
+
+    for path, data in (
+        (runs_csv_path, pd.DataFrame(runs, columns=["Collection", "Round", "JIT", "Seconds", "Exit Code"])),
+        (tp_csv_path, pd.DataFrame(rows, columns=[
+            "Collection", "Base Median (s)", "Base MAD (s)", "Diff Median (s)", "Diff MAD (s)",
+            "% Throughput Difference", "% Throughput Difference MAD", "Rounds", "Outliers",
+        ])),
+    ):
+        temp_path = get_temp_path(path)
+        data.to_csv(temp_path, index=False)
+        os.replace(temp_path, path)
+    print(f"Throughput results saved in '{tp_csv_path}'.")
+    return tp_csv_path
+
+def get_archive_compressor():
+    """Return the codec name and compress function used for new archives: zstd if it is installed, zlib otherwise."""
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL).compress
+    return "zlib", lambda data: zlib.compress(data, ARCHIVE_ZLIB_LEVEL)
+
+def decompress_archive_member(codec, data):
+    """Decompress one member of an archive written with the given codec."""
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if zstandard is None:
+        print("This archive is compressed with zstd. Install the 'zstandard' package to read it.")
+        sys.exit(1)
+    return zstandard.ZstdDecompressor().decompress(data)
+
+def get_archived_method(relative_path):
+    """Return the (collection, context, side) of an asm dump path such as 'asm.asmdiffs/<collection>/base/<context>.dasm', or None."""
+    parts = relative_path.split("/")
+    match = re.match(r"(\d+)", parts[-1])
+    side_indexes = [i for i, part in enumerate(parts[:-1]) if part.lower() in ("base", "diff")]
+    if not match or not side_indexes:
+        return None
+    side_index = side_indexes[-1]
+    collection = parts[side_index - 1] if side_index > 0 else ""
+    return collection, match.group(1), parts[side_index].lower()
+
+def archive_spmi_outputs(output_folder_path):
+    """
+    Pack the asm dumps and diff text of a SuperPMI output folder into one compressed archive.
+
+    Every file is compressed on its own, one after the other, into ARCHIVE_FILE_NAME, so a single
+    file can later be read back by seeking to it. ARCHIVE_INDEX_NAME records the codec, the offset
+    and sizes of every file and, per collection and method context, the base and diff asm dump
+    (see extract_method_asm). The packed files are removed. Returns the number of packed files.
+    """
+    members = []
+    for dir_path, _, file_names in os.walk(output_folder_path):
+        for file_name in sorted(file_names):
+            if os.path.splitext(file_name)[1].lower() in ARCHIVE_FILE_EXTENSIONS:
+                members.append(os.path.relpath(os.path.join(dir_path, file_name), output_folder_path).replace(os.sep, "/"))
+    if not members:
+        return 0
+
+    codec, compress = get_archive_compressor()
+    index = {"codec": codec, "files": {}, "methods": {}}
+    original_size = 0
+    with profile_phase("archive outputs", files=len(members)):
+        with open(os.path.join(output_folder_path, ARCHIVE_FILE_NAME), "wb") as archive_file:
+            for relative_path in sorted(members):
+                member_path = os.path.join(output_folder_path, *relative_path.split("/"))
+                with open(member_path, "rb") as member_file:
+                    data = member_file.read()
+                compressed = compress(data)
+                index["files"][relative_path] = [archive_file.tell(), len(compressed), len(data)]
+                archive_file.write(compressed)
+                original_size += len(data)
+                os.remove(member_path)
+
+                method = get_archived_method(relative_path)
+                if method:
+                    collection, context, side = method
+                    index["methods"].setdefault(collection, {}).setdefault(context, {})[side] = relative_path
+            archive_size = archive_file.tell()
+
+        temp_index_path = get_temp_path(os.path.join(output_folder_path, ARCHIVE_INDEX_NAME))
+        with open(temp_index_path, "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(temp_index_path, os.path.join(output_folder_path, ARCHIVE_INDEX_NAME))
+
+        # Remove the folders the packed files leave empty
+        for dir_path, _, _ in sorted(os.walk(output_folder_path), key=lambda item: len(item[0]), reverse=True):
+            if dir_path != output_folder_path and not os.listdir(dir_path):
+                os.rmdir(dir_path)
+
+    print(f"Archived {len(members)} files of '{output_folder_path}' with {codec}: {original_size / 1024 ** 2:.1f} MB -> {archive_size / 1024 ** 2:.1f} MB.")
+    return len(members)
+
+def read_archived_file(output_folder_path, relative_path, index=None):
+    """Read one file back from the archive of an output folder, decompressing only that file."""
+    if index is None:
+        with open(os.path.join(output_folder_path, ARCHIVE_INDEX_NAME), "r") as index_file:
+            index = json.load(index_file)
+    offset, compressed_size, _ = index["files"][relative_path]
+    with open(os.path.join(output_folder_path, ARCHIVE_FILE_NAME), "rb") as archive_file:
+        archive_file.seek(offset)
+        return decompress_archive_member(index["codec"], archive_file.read(compressed_size)).decode("utf-8", errors="replace")
+
+def extract_method_asm(output_folder_path, context, collection=None):
+    """
+    Return {'base': text, 'diff': text} with the asm of one method context from an archived output folder.
+
+    collection (or a part of its name) is needed when several collections have the context.
+    """
+    index_path = os.path.join(output_folder_path, ARCHIVE_INDEX_NAME)
+    if not os.path.exists(index_path):
+        print(f"'{output_folder_path}' has no archived outputs ('{ARCHIVE_INDEX_NAME}' does not exist).")
+        sys.exit(1)
+    with open(index_path, "r") as index_file:
+        index = json.load(index_file)
+
+    matches = [
+        name for name, methods in index["methods"].items()
+        if str(context) in methods and (collection is None or collection.lower() in name.lower())
+    ]
+    if not matches:
+        print(f"Method context {context} is not in the archive of '{output_folder_path}'.")
+        sys.exit(1)
+    if len(matches) > 1:
+        print(f"Method context {context} is in several collections: {', '.join(matches)}. Pass the collection as well.")
+        sys.exit(1)
+    return {side: read_archived_file(output_folder_path, relative_path, index) for side, relative_path in sorted(index["methods"][matches[0]][str(context)].items())}
+
+def resolve_parallel_jobs(jobs=None, cores_per_job=None, job_count=None):
+    """
+    Work out how many SuperPMI configurations to run at the same time and how many cores each may use.
+
+    If jobs is not given it is derived from the number of cores and cores_per_job. It never
+    exceeds job_count, the number of configurations to run.
+    Returns a (jobs, parallelism) tuple; parallelism is None when SuperPMI may use every core.
+    """
+    total_cores = os.cpu_count() or 1
+    if cores_per_job is not None and cores_per_job < 1:
+        print(f"Invalid number of cores per job: {cores_per_job}")
+        sys.exit(1)
+    if jobs is None:
+        jobs = max(1, total_cores // cores_per_job) if cores_per_job else 1
+    if jobs < 1:
+        print(f"Invalid number of parallel jobs: {jobs}")
+        sys.exit(1)
+    if job_count:
+        jobs = min(jobs, job_count)
+
+    parallelism = cores_per_job
+    if parallelism is None and jobs > 1:
+        # Share the cores evenly between the jobs
+        parallelism = max(1, total_cores // jobs)
+    return jobs, parallelism
+
+def find_method_details_columns(csv_path, required_roles=("method", "base", "diff")):
+    """
+    Map the roles of a per-method details CSV (context, method, collection, base and diff instruction
+    counts) to its column names. Returns None if the file is not a per-method details file, i.e. lacks
+    one of required_roles.
+    """
+    try:
+        header = pd.read_csv(csv_path, nrows=0).columns
+    except Exception:
+        return None
+    columns = {}
+    for role, candidates in METHOD_DETAILS_COLUMN_CANDIDATES.items():
+        matches = [column for column in header if column.strip().lower() in candidates]
+        if matches:
+            columns[role] = matches[0]
+    if not all(role in columns for role in required_roles):
+        return None
+    return columns
+
+def find_method_details_files(output_folder_path):
+    """Return the per-method details CSVs below a SuperPMI output folder."""
+    method_details_files = []
+    for dir_path, _, file_names in os.walk(output_folder_path):
+        for file_name in sorted(file_names):
+            file_path = os.path.join(dir_path, file_name)
+            if file_name.lower().endswith(".csv") and find_method_details_columns(file_path):
+                method_details_files.append(file_path)
+    return method_details_files
+
+def push_top_methods(heap, rows, top_n, sign):
+    """
+    Keep the top_n rows with the largest sign * difference in a bounded min-heap.
+
+    Heap items are (score, sequence number, row) so rows with equal scores never get compared.
+    """
+    for row in rows:
+        item = (sign * row["difference"], next(METHOD_HEAP_SEQUENCE), row)
+        if len(heap) < top_n:
+            heapq.heappush(heap, item)
+        elif item[0] > heap[0][0]:
+            heapq.heapreplace(heap, item)
+
+def analyze_method_diffs(method_details_paths, config_name, top_n=METHOD_ANALYSIS_TOP_N, chunk_size=METHOD_ANALYSIS_CHUNK_SIZE):
+    """
+    Stream per-method details CSVs in chunks and summarize them per collection and for the whole config.
+
+    Only running totals and bounded heaps of the top_n improvements and regressions are kept,
+    so memory does not depend on the number of methods. Returns the summary dictionary.
+    """
+    totals = {}
+    improvement_heaps = {}
+    regression_heaps = {}
+    for csv_path in method_details_paths:
+        columns = find_method_details_columns(csv_path)
+        if columns is None:
+            print(f"'{csv_path}' is not a per-method details file. Skipping it.")
+            continue
+
+        print(f"Analyzing per-method details in '{csv_path}'...")
+        # Files without a collection column hold the methods of one collection, named after the file
+        default_collection = os.path.splitext(os.path.basename(csv_path))[0]
+        for chunk in pd.read_csv(csv_path, usecols=list(columns.values()), chunksize=chunk_size):
+            chunk = chunk.rename(columns={column: role for role, column in columns.items()})
+            chunk = chunk.dropna(subset=["base", "diff"])
+            if "collection" not in chunk.columns:
+                chunk["collection"] = default_collection
+            if "context" not in chunk.columns:
+                chunk["context"] = ""
+            chunk["difference"] = chunk["diff"] - chunk["base"]
+
+            for collection, group in chunk.groupby("collection", sort=False):
+                for key in (collection, METHOD_SUMMARY_ALL_COLLECTIONS):
+                    total = totals.setdefault(key, {"methods": 0, "changed": 0, "improved": 0, "regressed": 0, "base_instructions": 0, "diff_instructions": 0})
+                    total["methods"] += len(group)
+                    total["changed"] += int((group["difference"] != 0).sum())
+                    total["improved"] += int((group["difference"] < 0).sum())
+                    total["regressed"] += int((group["difference"] > 0).sum())
+                    total["base_instructions"] += int(group["base"].sum())
+                    total["diff_instructions"] += int(group["diff"].sum())
+
+                    # Only the chunk's own top rows can enter the heaps
+                    improvements = group[group["difference"] < 0].nsmallest(top_n, "difference")
+                    regressions = group[group["difference"] > 0].nlargest(top_n, "difference")
+                    push_top_methods(improvement_heaps.setdefault(key, []), improvements.to_dict("records"), top_n, -1)
+                    push_top_methods(regression_heaps.setdefault(key, []), regressions.to_dict("records"), top_n, 1)
+
+    def describe(heap):
+        methods = []
+        for _, _, row in sorted(heap, key=lambda item: item[0], reverse=True):
+            methods.append({
+                "context": str(row["context"]),
+                "method": str(row["method"]),
+                "base_instructions": int(row["base"]),
+                "diff_instructions": int(row["diff"]),
+                "difference": int(row["difference"]),
+                "percent_difference": (row["difference"] * 100 / row["base"]) if row["base"] else None,
+            })
+        return methods
+
+    return {
+        "config": config_name,
+        "top_n": top_n,
+        "collections": {
+            key: dict(total, top_improvements=describe(improvement_heaps.get(key, [])), top_regressions=describe(regression_heaps.get(key, [])))
+            for key, total in totals.items()
+        },
+    }
+
+def write_method_diff_summary(output_folder_path, destination_path, config_name, top_n=METHOD_ANALYSIS_TOP_N, label=None):
+    """Analyze the per-method details of a run and write '<config>_methods.json'. Returns its path, or None."""
+    method_details_paths = find_method_details_files(output_folder_path)
+    if not method_details_paths:
+        print(f"No per-method details found in '{output_folder_path}'. Skipping the method analysis.")
+        return None
+
+    summary = analyze_method_diffs(method_details_paths, config_name, top_n)
+    summary["label"] = label if label else config_name
+    summary_path = os.path.join(destination_path, f"{config_name}_methods.json")
+    with open(summary_path, "w") as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    print(f"Per-method summary of '{config_name}' saved at '{summary_path}'.")
+    return summary_path
+
+def create_method_diff_graphs(*summary_paths, render_workers=None):
+    """Create a graph of the top regressions and improvements across all collections for each method summary."""
+    graphs = []
+    for summary_path in summary_paths:
+        with open(summary_path, "r") as summary_file:
+            summary = json.load(summary_file)
+        overall = summary["collections"].get(METHOD_SUMMARY_ALL_COLLECTIONS)
+        if not overall:
+            continue
+        for kind, title in (("top_regressions", "Top Regressions"), ("top_improvements", "Top Improvements")):
+            methods = overall[kind]
+            if not methods:
+                continue
+            graphs.append({
+                "title": f"{title}: {summary['label']}",
+                "ylabel": "Instruction Count Difference",
+                "labels": [summary["label"]],
+                "collections": [shorten_method_name(method["method"]) for method in methods],
+                "values": [[method["difference"] for method in methods]],
+                "explanation": GRAPH_EXPLANATIONS['Instruction Count Difference'],
+                "path": os.path.join(os.path.dirname(summary_path), f"{summary['config']}_{kind}.png"),
+            })
+    if not graphs:
+        print("No per-method summaries to graph.")
+        return []
+    return render_graphs(graphs, render_workers)
+
+def get_preview_sample(fraction, max_contexts=PREVIEW_MAX_CONTEXTS, clusters=PREVIEW_CLUSTERS):
+    """
+    Return the deterministic sample of method contexts replayed in preview mode.
+
+    The contexts 1..max_contexts are split into clusters of equal stride, and a block of
+    fraction * stride consecutive contexts is taken from each one, at an offset derived from
+    the fraction. Every collection is a stratum sampled with the same fraction, and every
+    configuration replays the same contexts, so their estimates can be compared. Returns the
+    plan as a dict with the '-compile' ranges for superpmi.py.
+
+    The real number of contexts of a collection is not known before it is replayed. Contexts
+    after max_contexts are never sampled, so the estimates only describe the first max_contexts
+    contexts of a collection, and a collection with fewer contexts than the offset of the first
+    block gets no samples at all (see write_preview_estimate).
+    """
+    if not 0 < fraction < 1:
+        print(f"Invalid preview fraction: {fraction}")
+        sys.exit(1)
+    if max_contexts < 1:
+        print(f"Invalid number of preview contexts: {max_contexts}")
+        sys.exit(1)
+    stride = max(1, max_contexts // clusters)
+    block = max(1, round(stride * fraction))
+    offset = int(hashlib.sha256(f"preview:{fraction}".encode("utf-8")).hexdigest(), 16) % (stride - block + 1)
+    ranges = [f"{start}-{start + block - 1}" for start in range(1 + offset, max_contexts + 1, stride)]
+    return {"stride": stride, "block": block, "offset": offset, "fraction": block / stride, "compile": ",".join(ranges)}
+
+def read_sampled_methods(output_folder_path, sample):
+    """
+    Read the per-method base and diff instruction counts of a preview run and sum them per sampled cluster.
+
+    Returns a data frame with one row per collection and cluster, or None when the output has no
+    per-method details with context numbers, and the names of all replayed collections, including
+    those none of whose contexts were sampled.
+    """
+    frames = []
+    collections = []
+    for csv_path in find_method_details_files(output_folder_path):
+        columns = find_method_details_columns(csv_path)
+        if columns is None or "context" not in columns:
+            continue
+        data = pd.read_csv(csv_path, usecols=[columns[role] for role in ("context", "collection", "base", "diff") if role in columns])
+        data = data.rename(columns={column: role for role, column in columns.items()}).dropna(subset=["context", "base", "diff"])
+        if "collection" not in data.columns:
+            data["collection"] = os.path.splitext(os.path.basename(csv_path))[0]
+        collections.extend(data["collection"].unique() if not data.empty else [os.path.splitext(os.path.basename(csv_path))[0]])
+        frames.append(data)
+    if not frames:
+        return None, collections
+
+    methods = pd.concat(frames, ignore_index=True)
+    position = methods["context"].astype(int) - 1 - sample["offset"]
+    methods = methods[(position >= 0) & (position % sample["stride"] < sample["block"])].copy()
+    methods["cluster"] = position // sample["stride"]
+    methods["difference"] = methods["diff"] - methods["base"]
+    methods["changed_base"] = methods["base"].where(methods["difference"] != 0, 0)
+    methods["methods"] = 1
+    return methods.groupby(["collection", "cluster"], as_index=False)[["base", "difference", "changed_base", "methods"]].sum(), list(dict.fromkeys(collections))
+
+def estimate_sampled_difference(clusters, fraction, z):
+    """
+    Estimate the differences of the population a set of sampled clusters comes from.
+
+    Each collection is a stratum of clusters drawn with the same fraction. The instruction count
+    difference is expanded by 1 / fraction; the percentages are ratio estimates whose variance comes
+    from the linearized residuals. Strata with a single cluster are treated conservatively, as if
+    the spread were as large as the cluster's own value. Returns {column: (estimate, lower, upper)}.
+    """
+    def stratum_variance(values):
+        variance = 0.0
+        for _, group in values.groupby(clusters["collection"]):
+            if len(group) > 1:
+                variance += len(group) * (1 - fraction) * group.var(ddof=1)
+            else:
+                variance += (1 - fraction) * float(group.iloc[0]) ** 2
+        return variance
+
+    estimates = {}
+    total_difference = clusters["difference"].sum()
+    total_variance = stratum_variance(clusters["difference"]) / fraction ** 2
+    half_width = z * np.sqrt(total_variance)
+    total = total_difference / fraction
+    estimates['Instruction Count Difference'] = (total, total - half_width, total + half_width)
+
+    for column, base_column in (('% Instruction Count Difference', "base"), ('% Instruction Count Difference (Ignoring Zero diffs)', "changed_base")):
+        total_base = clusters[base_column].sum()
+        if total_base == 0:
+            estimates[column] = (0.0, 0.0, 0.0) if total_difference == 0 else (np.nan, np.nan, np.nan)
+            continue
+        ratio = total_difference / total_base
+        residuals = clusters["difference"] - ratio * clusters[base_column]
+        half_width = z * np.sqrt(stratum_variance(residuals)) / total_base
+        estimates[column] = (ratio * 100, (ratio - half_width) * 100, (ratio + half_width) * 100)
+    return estimates
+
+def is_preview_ambiguous(interval, tolerance):
+    """
+    Decide whether a preview needs a full run.
+
+    interval is the (estimate, lower, upper) of the % instruction count difference over all
+    collections. An interval entirely above or below zero is a clear regression or improvement,
+    and one inside +/- tolerance percent is no real change. Anything else is ambiguous.
+    """
+    _, lower, upper = interval
+    if np.isnan(lower) or np.isnan(upper):
+        return True
+    if lower > 0 or upper < 0:
+        return False
+    return bool(max(-lower, upper) > tolerance)
+
+def write_preview_estimate(output_folder_path, destination_path, config_name, sample, confidence=PREVIEW_CONFIDENCE, tolerance=PREVIEW_TOLERANCE):
+    """
+    Estimate the results of a full run from a preview run and decide whether the estimate is ambiguous.
+
+    Writes '<config>_estimate.csv', with the columns of a details CSV plus the lower and upper
+    confidence bounds and the number of sampled methods per collection, and '<config>_estimate.json'
+    with the estimate over all collections. Returns (estimate CSV path, ambiguous); the path is None
+    when the preview has no usable per-method details. Collections with no sampled contexts (see
+    get_preview_sample) get a row without estimates, and make the preview ambiguous since the
+    overall estimate leaves them out.
+    """
+    clusters, collections = read_sampled_methods(output_folder_path, sample)
+    if clusters is None or clusters.empty:
+        if collections:
+            print(f"The preview sampled no contexts of {', '.join(collections)}. The preview cannot be estimated.")
+        else:
+            print(f"No per-method details with context numbers found in '{output_folder_path}'. The preview cannot be estimated.")
+        return None, True
+
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    rows = []
+    for collection, collection_clusters in clusters.groupby("collection", sort=False):
+        row = {'Collection': collection}
+        for column, (estimate, lower, upper) in estimate_sampled_difference(collection_clusters, sample["fraction"], z).items():
+            row[column] = estimate
+            row[f"{column} Lower"] = lower
+            row[f"{column} Upper"] = upper
+        row['Sampled Methods'] = int(collection_clusters["methods"].sum())
+        rows.append(row)
+    unsampled = [collection for collection in collections if collection not in set(clusters["collection"])]
+    for collection in unsampled:
+        row = {'Collection': collection}
+        for column in DETAILS_COLUMNS[1:]:
+            row[column] = row[f"{column} Lower"] = row[f"{column} Upper"] = np.nan
+        row['Sampled Methods'] = 0
+        rows.append(row)
+    if unsampled:
+        print(f"The preview sampled no contexts of {', '.join(unsampled)}, which may have fewer than {sample['offset'] + 1} contexts.")
+    estimate_csv_path = os.path.join(destination_path, f"{config_name}_estimate.csv")
+    pd.DataFrame(rows).to_csv(estimate_csv_path, index=False)
+
+    overall = estimate_sampled_difference(clusters, sample["fraction"], z)
+    ambiguous = is_preview_ambiguous(overall['% Instruction Count Difference'], tolerance) or bool(unsampled)
+    summary = {
+        "config": config_name,
+        "confidence": confidence,
+        "fraction": sample["fraction"],
+        "sampled_methods": int(clusters["methods"].sum()),
+        "unsampled_collections": unsampled,
+        "estimates": {column: dict(zip(("estimate", "lower", "upper"), map(float, values))) for column, values in overall.items()},
+        "ambiguous": ambiguous,
+    }
+    with open(os.path.join(destination_path, f"{config_name}_estimate.json"), "w") as summary_file:
+        json.dump(summary, summary_file, indent=2)
+
+    estimate, lower, upper = overall['% Instruction Count Difference']
+    print(
+        f"Preview of '{config_name}': % Instruction Count Difference {estimate:.3f} "
+        f"({confidence:.0%} CI {lower:.3f} to {upper:.3f}) from {summary['sampled_methods']} methods"
+        f"{', ambiguous' if ambiguous else ''}."
+    )
+    return estimate_csv_path, ambiguous
+
+def shorten_method_name(method_name):
+    """Shorten a method name for use as an axis label."""
+    if len(method_name) <= METHOD_LABEL_MAX_LENGTH:
+        return method_name
+    return method_name[:METHOD_LABEL_MAX_LENGTH - 3] + "..."
+
+def parse_jit_options(jit_options):
+    """Parse a list of 'Name=Value' JIT options into an ordered dictionary."""
+    parsed_options = {}
+    for option in jit_options:
+        name, _, value = option.partition("=")
+        parsed_options[name.strip()] = value.strip()
+    return parsed_options
+
+def format_configuration_label(branch, parsed_options):
+    """Return the legend label of a configuration, e.g. '16 eGPR, NDD on, CCMP Off, PPX On'."""
+    parts = [branch.replace('_', ' ')]
+    for name, value in parsed_options.items():
+        if name in JIT_OPTION_LABELS:
+            on_label, off_label = JIT_OPTION_LABELS[name]
+            parts.append(on_label if value == "1" else off_label)
+        elif name not in HIDDEN_JIT_OPTIONS:
+            parts.append(f"{name}={value}")
+    return ", ".join(parts)
+
+def read_details_csv(csv_path, columns=DETAILS_COLUMNS):
+    """Read the per-collection columns (DETAILS_COLUMNS unless given) of a details CSV and shorten the collection names."""
+    if not os.path.exists(csv_path):
+        print(f"File '{csv_path}' does not exist. Ensure the file is generated correctly.")
+        sys.exit(1)
+
+    print(f"Reading diff details from '{csv_path}'...")
+    try:
+        # Only read the columns that are compared
+        data = pd.read_csv(csv_path, usecols=lambda column: column in columns)
+    except Exception as e:
+        print(f"Failed to read or process '{csv_path}': {e}")
+        sys.exit(1)
+
+    # Check if required columns exist
+    for column in columns:
+        if column not in data.columns:
+            print(f"Required column '{column}' is missing in '{csv_path}'.")
+            sys.exit(1)
+
+    data['Collection'] = shorten_collection_names(data['Collection'])
+    return data
+
+def shorten_collection_names(collections):
+    """Remove '.mch' and '.windows...' from a series of collection names."""
+    collections = collections.str.replace('.mch', '', regex=False)
+    return collections.str.replace(r'\.windows.*', '', regex=True)
+
+def read_estimate_intervals(csv_path):
+    """Return the confidence bounds of a preview estimate CSV as a data frame, or None for an exact details CSV."""
+    header = pd.read_csv(csv_path, nrows=0).columns
+    bound_columns = [column for column in header if column.endswith(" Lower") or column.endswith(" Upper")]
+    if not bound_columns:
+        return None
+    intervals = pd.read_csv(csv_path, usecols=['Collection'] + bound_columns)
+    intervals['Collection'] = shorten_collection_names(intervals['Collection'])
+    return intervals.set_index('Collection')
+
+def open_results_database(database_path):
+    """Open the SQLite results store, creating it and its tables and indexes if needed."""
+    os.makedirs(os.path.dirname(os.path.abspath(database_path)), exist_ok=True)
+    # Several analysis stages, and other runs, may record their runs at the same time
+    connection = sqlite3.connect(database_path, timeout=CACHE_LOCK_TIMEOUT)
+    metric_columns = ", ".join(f"{db_column} REAL" for db_column in DETAILS_DB_COLUMNS.values() if db_column != "collection")
+    connection.executescript(f"""
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            branch TEXT NOT NULL,
+            label TEXT NOT NULL,
+            options TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS run_options (
+            run_id INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+            option TEXT NOT NULL,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS results (
+            run_id INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+            collection TEXT NOT NULL,
+            {metric_columns}
+        );
+        CREATE INDEX IF NOT EXISTS run_options_by_option ON run_options(option, value);
+        CREATE INDEX IF NOT EXISTS results_by_run ON results(run_id, collection);
+        CREATE INDEX IF NOT EXISTS results_by_collection ON results(collection);
+    """)
+    connection.execute("PRAGMA foreign_keys = ON")
+    return connection
+
+def record_run_results(database_path, details_csv_path, branch, diff_jit_options, estimate=False, columns=DETAILS_COLUMNS):
+    """
+    Store the results of one details CSV in the results database.
+
+    The rows are tagged with the branch and the parsed diff JIT options, so later comparisons
+    do not have to recover them from the file name. Recording a run again replaces it. The
+    label of a preview estimate (see write_preview_estimate) says it is an estimate. The results
+    table only holds DETAILS_COLUMNS, so for CSVs with other columns (e.g. TP_COLUMNS) only the
+    run, with its label and options, is recorded. Returns the label.
+    """
+    data = read_details_csv(details_csv_path, columns)
+    name = os.path.splitext(os.path.basename(details_csv_path))[0]
+    parsed_options = parse_jit_options(diff_jit_options)
+    label = format_configuration_label(branch, parsed_options) + (PREVIEW_LABEL_SUFFIX if estimate else "")
+
+    connection = open_results_database(database_path)
+    try:
+        with connection:
+            connection.execute("DELETE FROM runs WHERE name = ?", (name,))
+            run_id = connection.execute(
+                "INSERT INTO runs (name, branch, label, options) VALUES (?, ?, ?, ?)",
+                (name, branch, label, json.dumps(parsed_options))
+            ).lastrowid
+            connection.executemany(
+                "INSERT INTO run_options (run_id, option, value) VALUES (?, ?, ?)",
+                [(run_id, option, value) for option, value in parsed_options.items()]
+            )
+            if columns == DETAILS_COLUMNS:
+                rows = data[DETAILS_COLUMNS].rename(columns=DETAILS_DB_COLUMNS)
+                rows.insert(0, "run_id", run_id)
+                rows.to_sql("results", connection, if_exists="append", index=False)
+    finally:
+        connection.close()
+    print(f"Recorded {len(data)} collections of '{name}' in '{database_path}'.")
+    return label
+
+def load_results(details_csv_paths, database_path=None, columns=DETAILS_COLUMNS):
+    """
+    Return the results of the given details CSVs as one long-format data frame.
+
+    Runs recorded in the results database are read from it with their stored labels; other
+    CSVs are read directly and keep their file name as label unless the database has a label for
+    them. The frame has 'Run', 'Label', 'Collection' and the compared columns, in the order of
+    details_csv_paths. The database only holds DETAILS_COLUMNS, so CSVs with other columns
+    (e.g. TP_COLUMNS) are always read directly.
+    """
+    names = [os.path.splitext(os.path.basename(csv_path))[0] for csv_path in details_csv_paths]
+    recorded = pd.DataFrame()
+    labels = {}
+    if database_path and os.path.exists(database_path):
+        connection = open_results_database(database_path)
+        try:
+            labels = dict(connection.execute(
+                f"SELECT name, label FROM runs WHERE name IN ({', '.join('?' for _ in names)})", names
+            ).fetchall())
+            if columns == DETAILS_COLUMNS:
+                metric_columns = ", ".join(f"results.{db_column}" for db_column in DETAILS_DB_COLUMNS.values() if db_column != "collection")
+                recorded = pd.read_sql_query(
+                    f"SELECT runs.name AS Run, runs.label AS Label, results.collection AS collection, {metric_columns} "
+                    f"FROM results JOIN runs ON runs.run_id = results.run_id "
+                    f"WHERE runs.name IN ({', '.join('?' for _ in names)})",
+                    connection,
+                    params=names
+                ).rename(columns={db_column: column for column, db_column in DETAILS_DB_COLUMNS.items()})
+        finally:
+            connection.close()
+
+    frames = []
+    for csv_path, name in zip(details_csv_paths, names):
+        if not recorded.empty and name in set(recorded["Run"]):
+            frames.append(recorded[recorded["Run"] == name])
+            continue
+        data = read_details_csv(csv_path, columns)
+        data.insert(0, "Run", name)
+        data.insert(1, "Label", labels.get(name, name))
+        frames.append(data)
+    return pd.concat(frames, ignore_index=True)
+
+def create_visual_representation(*details_csv_paths, results_database_path=None, render_workers=None, graph_folder=None, columns=DETAILS_COLUMNS):
+    """
+    Reads multiple diffAPX_details.csv files and creates separate graphs for:
+    - Instruction Count Difference
+    - % Instruction Count Difference
+    - % Instruction Count Difference (Ignoring Zero diffs)
+    or for the other columns after 'Collection' in columns, e.g. TP_COLUMNS for the throughput CSVs.
+
+    Runs recorded in results_database_path are read from the results store. The runs are
+    combined in long format and pivoted per column, so a collection missing from one run
+    leaves a gap instead of being dropped from every run. Preview estimates are drawn hatched
+    with their confidence intervals as error bars. The graphs are rendered in a
+    process pool of render_workers processes (see render_graphs) and saved in graph_folder,
+    by default the folder of the first CSV. Returns the graph paths.
+    """
+    if not details_csv_paths:
+        print("No CSV paths provided for visualization.")
+        sys.exit(1)
+    graph_folder = graph_folder or os.path.dirname(details_csv_paths[0])
+    os.makedirs(graph_folder, exist_ok=True)
+
+    long_data = load_results(details_csv_paths, results_database_path, columns)
+    runs = list(dict.fromkeys(long_data['Run']))
+    labels = [long_data.loc[long_data['Run'] == run, 'Label'].iloc[0] for run in runs]
+    collections = list(dict.fromkeys(long_data['Collection']))
+
+    # Define the columns to plot
+    columns_to_plot = [column for column in columns if column != 'Collection']
+
+    # Confidence bounds of the runs that are preview estimates
+    intervals = {}
+    for csv_path in details_csv_paths:
+        run_intervals = read_estimate_intervals(csv_path)
+        if run_intervals is not None:
+            intervals[os.path.splitext(os.path.basename(csv_path))[0]] = run_intervals
+
+    # Describe a graph for each column; one row per run and one column per collection
+    graphs = []
+    for column in columns_to_plot:
+        pivoted_data = long_data.pivot(index='Run', columns='Collection', values=column).reindex(index=runs, columns=collections)
+        graph = {
+            "title": column,
+            "ylabel": column,
+            "labels": labels,
+            "collections": collections,
+            "values": pivoted_data.to_numpy(dtype=float),
+            "explanation": GRAPH_EXPLANATIONS.get(column, ""),
+            "path": os.path.join(graph_folder, f"{column.replace(' ', '_').lower()}_comparison.png"),
+        }
+        if intervals:
+            # Lower and upper bounds per run and collection; NaN for exact results
+            bounds = np.full((2, len(runs), len(collections)), np.nan)
+            for i, run in enumerate(runs):
+                if run in intervals:
+                    for j, bound in enumerate(("Lower", "Upper")):
+                        bounds[j, i] = intervals[run][f"{column} {bound}"].reindex(collections).to_numpy(dtype=float)
+            graph["bounds"] = bounds
+            graph["estimates"] = [run in intervals for run in runs]
+            graph["title"] = f"{column} (includes estimates from a sample)"
+        graphs.append(graph)
+
+    print(f"Creating graphs for columns: {', '.join(columns_to_plot)}")
+    return render_graphs(graphs, render_workers)
+
+def draw_bar_chart(figure, axes, graph, values):
+    """Draw one group of bars per collection, with one bar and one call to bar/bar_label per run."""
+    run_count, collection_count = values.shape
+    width = min(BAR_WIDTH, (1 + BAR_GROUP_GAP - 0.3) / run_count)  # Bar width, narrower when there are many runs
+    group_positions = np.arange(collection_count) * (1 + BAR_GROUP_GAP)
+    for i, label in enumerate(graph["labels"]):
+        estimate = graph.get("estimates", [False] * run_count)[i]
+        errors = None
+        if estimate:
+            # Error bars from the confidence bounds of a preview estimate
+            errors = np.nan_to_num(np.abs(graph["bounds"][:, i] - values[i]))
+        bars = axes.bar(group_positions + i * width, values[i], width=width, label=label, yerr=errors, capsize=3, hatch="//" if estimate else None)
+        # Add values above the bars, skipping collections this run does not have
+        axes.bar_label(bars, labels=["" if np.isnan(value) else f"{value:.2f}" for value in values[i]], padding=3, fontsize=8)
+
+    axes.set_xlabel("Collection")
+    axes.set_ylabel(graph["ylabel"])
+    axes.set_xticks(group_positions + width * (run_count - 1) / 2, graph["collections"], rotation=45, fontsize=10)
+    axes.legend()
+
+    # Invert the y-axis to flip the graph
+    axes.invert_yaxis()
+
+def draw_heatmap(figure, axes, graph, values):
+    """Draw a run x collection heatmap, used when there are too many bars to read."""
+    run_count, collection_count = values.shape
+    limit = np.nanmax(np.abs(values)) if not np.all(np.isnan(values)) else 0
+    limit = limit or 1
+    # Improvements (negative differences) are green, regressions red
+    image = axes.imshow(values, aspect="auto", cmap="RdYlGn_r", vmin=-limit, vmax=limit)
+    axes.set_xlabel("Collection")
+    axes.set_xticks(np.arange(collection_count), graph["collections"], rotation=90, fontsize=8)
+    axes.set_yticks(np.arange(run_count), graph["labels"], fontsize=8)
+    figure.colorbar(image, ax=axes, label=graph["ylabel"])
+
+    if values.size <= RENDER_HEATMAP_ANNOTATION_LIMIT:
+        estimates = graph.get("estimates", [False] * run_count)
+        for (row, column), value in np.ndenumerate(values):
+            if not np.isnan(value):
+                # Estimated values are marked with a '~'
+                axes.text(column, row, f"{'~' if estimates[row] else ''}{value:.2f}", ha='center', va='center', fontsize=6)
+
+def render_graph(graph):
+    """
+    Render one comparison graph to a PNG file and return its path.
+
+    graph holds the title, labels, collections and a runs x collections 'values' matrix. Matrices
+    larger than RENDER_DENSE_THRESHOLD are drawn as a heatmap instead of bars.
+    """
+    values = np.asarray(graph["values"], dtype=float)
+    dense = values.size > RENDER_DENSE_THRESHOLD
+    figure = Figure(figsize=(16, max(6, 0.35 * values.shape[0] + 4)) if dense else (16, 10))
+    axes = figure.add_subplot()
+    if dense:
+        draw_heatmap(figure, axes, graph, values)
+    else:
+        draw_bar_chart(figure, axes, graph, values)
+
+    axes.set_title(
+        graph["title"],
+        fontweight="bold",  # Make the header bold
+        fontsize=16         # Use a larger font size for the header
+    )
+    figure.tight_layout()
+
+    # Add explanation text to the graph
+    figure.text(0.5, -0.05, graph["explanation"], wrap=True, horizontalalignment='center', fontsize=10)
+
+    figure.savefig(graph["path"], bbox_inches="tight")
+    # Release the figure's memory right away instead of keeping every figure alive
+    figure.clear()
+    print(f"Graph '{graph['title']}' saved at '{graph['path']}'{' as a heatmap' if dense else ''}.")
+    return graph["path"]
+
+def render_graphs(graphs, workers=None):
+    """Render several graphs, in a process pool unless workers is 1. Returns the graph paths in order."""
+    if workers is None:
+        workers = min(len(graphs), os.cpu_count() or 1)
+    if workers <= 1:
+        return [render_graph(graph) for graph in graphs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(render_graph, graphs))
+
+def load_run_config(config_path):
+    """
+    Read a run configuration (JSON, or TOML where tomllib is available) describing the branches and their option matrices.
+
+    The file holds 'base_branch', 'base_jit_options' and a 'branches' table; see run_config.json.
+    """
+    try:
+        if config_path.lower().endswith(".toml"):
+            if tomllib is None:
+                print(f"Reading '{config_path}' needs tomllib (Python 3.11 or later). Use a JSON configuration instead.")
+                sys.exit(1)
+            with open(config_path, "rb") as config_file:
+                config = tomllib.load(config_file)
+        else:
+            with open(config_path, "r") as config_file:
+                config = json.load(config_file)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read the run configuration '{config_path}': {e}")
+        sys.exit(1)
+
+    if not isinstance(config.get("branches"), dict) or not config["branches"]:
+        print(f"Run configuration '{config_path}' does not define any branches.")
+        sys.exit(1)
+    base_branch = config.get("base_branch")
+    if base_branch not in config["branches"]:
+        print(f"Base branch '{base_branch}' of '{config_path}' is not one of its branches.")
+        sys.exit(1)
+    return config
+
+def normalize_jit_option_value(value):
+    """
+    Return the canonical text of a JIT option value.
+
+    Booleans become 1 or 0 and numbers are written as their digits, which the JIT reads as
+    hexadecimal. Strings with a '0x' prefix are written as lower-case hexadecimal without it.
+    Any other string, such as a method name for JitDisasm, is kept exactly as written.
+    """
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    value = str(value)
+    if re.fullmatch(r"0[xX][0-9a-fA-F]+", value):
+        return format(int(value, 16), "x")
+    return value
+
+def normalize_jit_options(options):
+    """
+    Turn a {name: value} option set into a 'Name=Value' list with canonical values.
+
+    Option names are case-insensitive; a later spelling of the same option replaces the value
+    of the earlier one but keeps its position and spelling.
+    """
+    normalized = {}
+    names = {}
+    for name, value in options.items():
+        name = names.setdefault(name.strip().lower(), name.strip())
+        normalized[name] = normalize_jit_option_value(value)
+    return [f"{name}={value}" for name, value in normalized.items()]
+
+def get_option_set_key(branch, diff_jit_options):
+    """Return the key identifying a branch and option set, independent of the option order and spelling."""
+    options = sorted(f"{name.lower()}={value}" for name, value in parse_jit_options(diff_jit_options).items())
+    return f"{branch}:{','.join(options)}"
+
+def option_set_matches(options, rule):
+    """Return True if the option set has every option value given in an include or exclude rule."""
+    lower_options = {name.lower(): value for name, value in parse_jit_options(options).items()}
+    return all(lower_options.get(name.lower()) == value for name, value in parse_jit_options(normalize_jit_options(rule)).items())
+
+def expand_branch_matrix(branch_config):
+    """
+    Return the diff JIT option lists of a branch: its fixed 'options' combined with the cartesian
+    product of its 'axes', without the sets matching an 'exclude' rule, followed by its 'include' sets.
+    """
+    fixed_options = branch_config.get("options", {})
+    axes = branch_config.get("axes", {})
+    exclude_rules = branch_config.get("exclude", [])
+    option_sets = []
+    for values in itertools.product(*axes.values()):
+        option_set = normalize_jit_options(dict(fixed_options, **dict(zip(axes, values))))
+        if not any(option_set_matches(option_set, rule) for rule in exclude_rules):
+            option_sets.append(option_set)
+    for include in branch_config.get("include", []):
+        option_sets.append(normalize_jit_options(dict(fixed_options, **include)))
+    return option_sets
+
+def build_job_matrix(config):
+    """
+    Expand the run configuration into the list of jobs (branch and diff JIT options) to run.
+
+    Equivalent option sets of a branch, such as the same options in another order or spelling,
+    only run once. Branches with 'enabled' set to false are skipped. Every job keeps its position
+    in the matrix as 'index', which orders the results no matter how the jobs are scheduled.
+    """
+    jobs = []
+    seen_keys = set()
+    for branch, branch_config in config["branches"].items():
+        if not branch_config.get("enabled", True):
+            continue
+        for diff_jit_options in expand_branch_matrix(branch_config):
+            key = get_option_set_key(branch, diff_jit_options)
+            if key in seen_keys:
+                print(f"Skipping duplicate configuration {' '.join(diff_jit_options)} of branch '{branch}'.")
+                continue
+            seen_keys.add(key)
+            jobs.append({
+                "index": len(jobs),
+                "branch": branch,
+                "options": diff_jit_options,
+                "key": key,
+                "name": get_configuration_name(branch, diff_jit_options),
+            })
+    return jobs
+
+def select_shard(jobs, shard_index, shard_count):
+    """
+    Return the jobs of one shard of the matrix (shard_index counts from 1).
+
+    The jobs are dealt out round-robin in key order, so every machine splits the same
+    configuration the same way regardless of its timings.
+    """
+    if shard_count < 1 or not 1 <= shard_index <= shard_count:
+        print(f"Invalid shard {shard_index}/{shard_count}.")
+        sys.exit(1)
+    ordered_keys = sorted(job["key"] for job in jobs)
+    shard_keys = set(ordered_keys[shard_index - 1::shard_count])
+    return [job for job in jobs if job["key"] in shard_keys]
+
+def order_jobs_by_cost(jobs, timings_path=JOB_TIMINGS_PATH):
+    """
+    Estimate the replay time of every job from earlier runs and sort the jobs longest first.
+
+    Jobs that never ran are estimated at the average of the known jobs. Jobs with equal
+    estimates keep their matrix order. Returns the sorted jobs, each with an 'estimate' in seconds.
+    """
+    timings = load_cache_index(timings_path)
+    known_seconds = [timings[job["key"]]["seconds"] for job in jobs if job["key"] in timings]
+    default_seconds = sum(known_seconds) / len(known_seconds) if known_seconds else 0.0
+    for job in jobs:
+        job["estimate"] = timings[job["key"]]["seconds"] if job["key"] in timings else default_seconds
+    print(f"Estimated the cost of {len(known_seconds)} of {len(jobs)} jobs from earlier runs.")
+    return sorted(jobs, key=lambda job: -job["estimate"])
+
+def record_job_timing(timings_path, job, seconds):
+    """Blend the replay time of a job into its stored estimate."""
+    with cache_lock(timings_path):
+        timings = load_cache_index(timings_path)
+        entry = timings.get(job["key"])
+        if entry:
+            seconds = JOB_TIMING_SMOOTHING * seconds + (1 - JOB_TIMING_SMOOTHING) * entry["seconds"]
+        timings[job["key"]] = {
+            "seconds": seconds,
+            "runs": (entry["runs"] if entry else 0) + 1,
+            "last_run": time.time(),
+        }
+        save_cache_index(timings_path, timings)
+
+def write_matrix_manifest(run_results_path, jobs, shard_index=1, shard_count=1):
+    """Write the jobs of this run, in matrix order, to 'matrix.json' in the results folder for merging shards."""
+    manifest = {
+        "shard_index": shard_index,
+        "shard_count": shard_count,
+        "jobs": [{key: job[key] for key in ("index", "branch", "options", "key", "name")} for job in sorted(jobs, key=lambda job: job["index"])],
+    }
+    manifest_path = os.path.join(run_results_path, MATRIX_MANIFEST_NAME)
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest_path
+
+def merge_shard_results(shard_paths, run_results_path, database_path=RESULTS_DATABASE_PATH):
+    """
+    Merge the results folders of several shards into run_results_path.
+
+    The details CSVs (or preview estimates), output folders and method summaries are linked or
+    copied over and the runs are recorded in the results database with the branch and options of
+    their job in the shard's manifest. Returns the details CSV and method summary paths of all
+    jobs, in matrix order.
+    """
+    jobs = {}
+    for shard_path in shard_paths:
+        manifest_path = os.path.join(shard_path, MATRIX_MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            print(f"'{shard_path}' is not a results folder of a shard: '{manifest_path}' does not exist.")
+            sys.exit(1)
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        print(f"Merging shard {manifest['shard_index']}/{manifest['shard_count']} from '{shard_path}' ({len(manifest['jobs'])} jobs)...")
+
+        for job in manifest["jobs"]:
+            for file_name in (f"{job['name']}.csv", f"{job['name']}_estimate.csv", f"{job['name']}_methods.json"):
+                if os.path.exists(os.path.join(shard_path, file_name)):
+                    # A job merged before, from another shard or the same one passed twice, is replaced
+                    if os.path.exists(os.path.join(run_results_path, file_name)):
+                        os.remove(os.path.join(run_results_path, file_name))
+                    clone_file(os.path.join(shard_path, file_name), os.path.join(run_results_path, file_name))
+            if os.path.isdir(os.path.join(shard_path, job["name"])):
+                delete_directory_if_exists(os.path.join(run_results_path, job["name"]))
+                shutil.copytree(os.path.join(shard_path, job["name"]), os.path.join(run_results_path, job["name"]), copy_function=clone_file)
+            jobs[job["key"]] = job
+
+    jobs = sorted(jobs.values(), key=lambda job: job["index"])
+    details_csv_paths = []
+    for job in jobs:
+        # Jobs whose preview estimate was not ambiguous have no full results
+        details_csv_path = os.path.join(run_results_path, f"{job['name']}.csv")
+        estimate = not os.path.exists(details_csv_path)
+        if estimate:
+            details_csv_path = os.path.join(run_results_path, f"{job['name']}_estimate.csv")
+        record_run_results(database_path, details_csv_path, job["branch"], job["options"], estimate)
+        details_csv_paths.append(details_csv_path)
+    method_summary_paths = [
+        os.path.join(run_results_path, f"{job['name']}_methods.json") for job in jobs
+        if os.path.exists(os.path.join(run_results_path, f"{job['name']}_methods.json"))
+    ]
+    print(f"Merged {len(jobs)} jobs from {len(shard_paths)} shards into '{run_results_path}'.")
+    return details_csv_paths, method_summary_paths
+
+class StageOutputRouter:
+    """Stand-in for sys.stdout that writes to the log of the pipeline stage running on the current thread."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        return (getattr(STAGE_OUTPUT, "log_file", None) or self.stream).write(text)
+
+    def flush(self):
+        (getattr(STAGE_OUTPUT, "log_file", None) or self.stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def print_to_console(text):
+    """Print text, and when a pipeline stage prints it, also on the console next to its log (see StageOutputRouter)."""
+    print(text)
+    if isinstance(sys.stdout, StageOutputRouter) and getattr(STAGE_OUTPUT, "log_file", None):
+        print(text, file=sys.stdout.stream)
+
+def add_stage(stages, name, function, dependencies=(), resource_class="cpu", priority=0):
+    """
+    Declare a pipeline stage in stages.
+
+    function is called with the results of the finished stages (a dict keyed by stage name) once
+    every stage in dependencies has finished, while holding one slot of resource_class (see
+    STAGE_RESOURCE_LIMITS). When stages wait for a slot, the one with the highest priority gets it
+    first. Its return value becomes the result of the stage.
+    """
+    if name in stages:
+        print(f"Pipeline stage '{name}' is declared twice.")
+        sys.exit(1)
+    stages[name] = {
+        "name": name,
+        "function": function,
+        "dependencies": list(dependencies),
+        "resource_class": resource_class,
+        "priority": priority,
+    }
+
+def order_stages(stages):
+    """Return the stage names in an order where every stage follows its dependencies."""
+    ordered = []
+    state = {}
+
+    def visit(name, path):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            print(f"Pipeline stages have a dependency cycle: {' -> '.join(path + [name])}")
+            sys.exit(1)
+        state[name] = "visiting"
+        for dependency in stages[name]["dependencies"]:
+            if dependency not in stages:
+                print(f"Pipeline stage '{name}' depends on the unknown stage '{dependency}'.")
+                sys.exit(1)
+            visit(dependency, path + [name])
+        state[name] = "done"
+        ordered.append(name)
+
+    for name in stages:
+        visit(name, [])
+    return ordered
+
+def get_stage_log_path(log_folder, name):
+    """Return the path of the log file of a pipeline stage."""
+    return os.path.join(log_folder, re.sub(r"[^\w.=-]+", "_", name) + ".log")
+
+def run_stage(stage, log_path, results):
+    """Run a stage's function on this thread with its output, and that of its commands, going to log_path."""
+    with open(log_path, "w", buffering=1) as log_file:
+        STAGE_OUTPUT.log_file = log_file
+        try:
+            return stage["function"](results)
+        except BaseException as error:
+            if not isinstance(error, SystemExit):
+                traceback.print_exc(file=log_file)
+            # The helpers exit on failure; turn that into an error the scheduler can report
+            raise RuntimeError(f"Pipeline stage '{stage['name']}' failed") from error
+        finally:
+            STAGE_OUTPUT.log_file = None
+
+async def run_stages(stages, order, resource_limits, log_folder, results):
+    """Start every stage as soon as its dependencies have finished and a slot of its resource class is free, highest priority first."""
+    loop = asyncio.get_running_loop()
+    free_slots = dict(resource_limits)
+    # Stages waiting for a slot of each resource class: a heap of (-priority, sequence, future)
+    waiting = {resource_class: [] for resource_class in resource_limits}
+    sequence = itertools.count()
+    tasks = {}
+
+    async def acquire_slot(stage):
+        resource_class = stage["resource_class"]
+        if free_slots[resource_class] > 0 and not waiting[resource_class]:
+            free_slots[resource_class] -= 1
+            return
+        future = loop.create_future()
+        heapq.heappush(waiting[resource_class], (-stage["priority"], next(sequence), future))
+        await future
+
+    def release_slot(resource_class):
+        # Hand the slot to the waiting stage with the highest priority
+        while waiting[resource_class]:
+            _, _, future = heapq.heappop(waiting[resource_class])
+            if not future.cancelled():
+                future.set_result(None)
+                return
+        free_slots[resource_class] += 1
+
+    async def run(stage):
+        if stage["dependencies"]:
+            await asyncio.gather(*(tasks[dependency] for dependency in stage["dependencies"]))
+        await acquire_slot(stage)
+        try:
+            log_path = get_stage_log_path(log_folder, stage["name"])
+            print(f"[{stage['name']}] Started ({stage['resource_class']}), log: '{log_path}'")
+            start = time.perf_counter()
+            results[stage["name"]] = await loop.run_in_executor(executor, run_stage, stage, log_path, results)
+            print(f"[{stage['name']}] Finished in {time.perf_counter() - start:.1f} s.")
+        finally:
+            release_slot(stage["resource_class"])
+
+    with ThreadPoolExecutor(max_workers=sum(resource_limits.values())) as executor:
+        for name in order:
+            tasks[name] = asyncio.create_task(run(stages[name]))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            print("Waiting for the running stages to finish...")
+            raise
+
+def run_pipeline(stages, resource_limits=STAGE_RESOURCE_LIMITS, log_folder=STAGE_LOGS_DIR_NAME):
+    """
+    Run the declared stages (see add_stage) on an asyncio scheduler and return their results.
+
+    Stages run on a thread pool as soon as their dependencies have finished, at most
+    resource_limits[resource class] at a time, so independent work overlaps. Everything a stage
+    prints, and the output of its commands, goes to its own log file in log_folder; the console
+    only shows when stages start and finish. Exits when a stage fails, after the stages that are
+    already running have finished.
+    """
+    order = order_stages(stages)
+    unknown_classes = {stage["resource_class"] for stage in stages.values()} - set(resource_limits)
+    if unknown_classes:
+        print(f"Unknown resource classes: {', '.join(sorted(unknown_classes))}")
+        sys.exit(1)
+    os.makedirs(log_folder, exist_ok=True)
+
+    results = {}
+    stdout = sys.stdout
+    sys.stdout = StageOutputRouter(stdout)
+    try:
+        asyncio.run(run_stages(stages, order, resource_limits, log_folder, results))
+    except RuntimeError as error:
+        print(f"{error}. See the stage logs in '{log_folder}'.")
+        sys.exit(1)
+    finally:
+        sys.stdout = stdout
+    return results
+
+def parse_resource_limits(values):
+    """Return STAGE_RESOURCE_LIMITS updated with CLASS=N values from the command line."""
+    resource_limits = dict(STAGE_RESOURCE_LIMITS)
+    for value in values or []:
+        resource_class, _, limit = value.partition("=")
+        if resource_class not in resource_limits or not limit.isdigit() or int(limit) < 1:
+            print(f"Invalid resource limit '{value}'. Use CLASS=N with CLASS one of {', '.join(resource_limits)}.")
+            sys.exit(1)
+        resource_limits[resource_class] = int(limit)
+    return resource_limits
+
+def declare_pipeline_stages(args, repo_root, run_results_path, base_branch, jobs, base_jit_options, timings_path=None):
+    """
+    Declare the stages of a run and their dependencies.
+
+    Cloning the runtime and setting up jitutils are independent. Each branch of the jobs (and the
+    base branch) is checked out, built (or restored from the build cache), has its Core_Root copied
+    and its collections primed, and then each of its jobs is replayed and analyzed on its own. The
+    replays start in the order of jobs (see order_jobs_by_cost) and their replay times are recorded
+    in timings_path. In preview mode every job first replays a sample (see get_preview_sample) and
+    only runs in full when its estimate is ambiguous. The graphs of a branch are drawn while the
+    next branch is still replaying, and the combined graphs, in matrix order, at the end. In
+    throughput mode the JITs of every job are then timed one job at a time (see run_throughput). Without
+    worktrees the branches share one checkout, so a branch is only checked out once the previous
+    branch no longer uses it.
+    """
+    branches = list(dict.fromkeys([base_branch] + [job["branch"] for job in jobs]))
+    build_cache_path = None if args.no_build_cache else os.path.abspath(args.build_cache)
+    build_cache_max_bytes = int(args.build_cache_max_gb * 1024 ** 3)
+    snapshot_store_path = None if args.no_snapshot_store else os.path.abspath(args.snapshot_store)
+    result_store_path = None if args.no_result_store else os.path.abspath(args.result_store)
+    results_database_path = os.path.abspath(args.results_db)
+    worktrees_path = os.path.abspath(WORKTREES_DIR_NAME)
+    workspaces_path = os.path.join(run_results_path, SPMI_WORKSPACES_DIR_NAME)
+    jitutils_bin_path = os.path.abspath(os.path.join(JITUTILS_DIR_NAME, "bin"))
+    _, parallelism = resolve_parallel_jobs(args.jobs, args.cores_per_job, len(jobs))
+    preview_sample = get_preview_sample(args.preview_fraction, args.preview_max_contexts) if args.preview else None
+    replay_args = get_replay_args(args.filter, preview_sample["compile"] if preview_sample else None)
+    stages = {}
+
+    def clone_stage(results):
+        if os.path.exists(repo_root):
+            print(f"Directory '{repo_root}' already exists. Skipping cloning step.")
+        elif args.worktrees:
+            # The clone only holds the history; the branches are checked out in their worktrees
+            with profile_phase("clone"):
+                clone_repo(REPO_URL, repo_root, ["--filter=blob:none", "--no-checkout"])
+        else:
+            with profile_phase("clone"):
+                clone_repo(REPO_URL, repo_root)
+    add_stage(stages, "clone", clone_stage, resource_class="network")
+
+    def jitutils_stage(results):
+        if os.path.isdir(jitutils_bin_path):
+            print(f"Directory '{jitutils_bin_path}' already exists. Skipping the jitutils setup.")
+            return
+        with profile_phase("jitutils setup"):
+            setup_jitutils()
+    add_stage(stages, "jitutils", jitutils_stage, resource_class="network")
+
+    checkout_stage_dependencies = ["clone"]
+    if args.worktrees:
+        def fetch_stage(results):
+            with profile_phase("fetch branches"):
+                fetch_branches(branches, repo_root, args.fetch_depth)
+            os.makedirs(worktrees_path, exist_ok=True)
+        add_stage(stages, "fetch branches", fetch_stage, ["clone"], "network")
+        checkout_stage_dependencies = ["fetch branches"]
+
+    def declare_branch_stages(branch, checkout_stage_dependencies):
+        """Declare the stages of one branch. Returns the stages using its checkout and its analysis stages."""
+        branch_root = os.path.join(worktrees_path, branch) if args.worktrees else repo_root
+        diff_coreroot_path = os.path.join(run_results_path, branch)
+        branch_jobs = [job for job in jobs if job["branch"] == branch]
+
+        def checkout_stage(results):
+            if args.worktrees:
+                with profile_phase("prepare worktree", branch=branch):
+                    prepare_worktree(branch, repo_root, worktrees_path)
+            else:
+                with profile_phase("checkout", branch=branch):
+                    checkout_branch(branch, cwd=repo_root)
+        add_stage(stages, f"checkout {branch}", checkout_stage, checkout_stage_dependencies, "disk" if args.worktrees else "network")
+
+        add_stage(
+            stages, f"build {branch}",
+            lambda results: build_branch(branch_root, branch, build_cache_path, build_cache_max_bytes, snapshot_store_path, not args.full_build),
+            [f"checkout {branch}"], "build"
+        )
+
+        def core_root_stage(results):
+            core_root_path = results[f"build {branch}"]
+            # Copy Core_Root to the results folder as 'base' only for the base branch
+            if branch == base_branch:
+                with profile_phase("copy Core_Root", branch=branch, destination="base"):
+                    copy_core_root(branch_root, run_results_path, "base", core_root_path, snapshot_store_path)
+            with profile_phase("copy Core_Root", branch=branch, destination=branch):
+                copy_core_root(branch_root, run_results_path, branch, core_root_path, snapshot_store_path)
+        add_stage(stages, f"core root {branch}", core_root_stage, [f"build {branch}"], "disk")
+
+        def mch_cache_stage(results):
+            if args.no_mch_cache:
+                return None
+            # Point superpmi at the shared MCH cache, downloading the collections only if they are not cached yet
+            with profile_phase("MCH cache", branch=branch):
+                mch_files = prime_mch_cache(branch_root, diff_coreroot_path, os.path.abspath(args.mch_cache), int(args.mch_cache_max_gb * 1024 ** 3))
+            if result_store_path:
+                report_result_store(run_results_path, branch, diff_coreroot_path, [job["options"] for job in branch_jobs], base_jit_options, mch_files, result_store_path, args.force_rerun, replay_args, args.base_once)
+            return mch_files
+        add_stage(stages, f"MCH cache {branch}", mch_cache_stage, sorted({f"core root {branch}", f"core root {base_branch}"}), "network")
+
+        checkout_users = [f"core root {branch}", f"MCH cache {branch}"]
+        analysis_stages = []
+        for job in branch_jobs:
+            diff_jit_options = job["options"]
+            config_name = job["name"]
+
+            replay_dependencies = [f"MCH cache {branch}", "jitutils"]
+            if preview_sample:
+                def preview_stage(results, job=job):
+                    run_superpmi(
+                        branch_root,
+                        run_results_path,
+                        branch,
+                        diff_coreroot_path,
+                        job["options"],
+                        base_jit_options,
+                        spmi_location=os.path.join(workspaces_path, job["name"] + PREVIEW_NAME_SUFFIX),
+                        parallelism=parallelism,
+                        mch_files=results[f"MCH cache {branch}"],
+                        result_store_path=result_store_path,
+                        force_rerun=args.force_rerun,
+                        filters=args.filter,
+                        compile_contexts=preview_sample["compile"],
+                        name_suffix=PREVIEW_NAME_SUFFIX,
+                        archive_outputs=not args.no_archive,
+                        reuse_base=args.base_once
+                    )
+                    with profile_phase("preview estimate", branch=branch, options=" ".join(job["options"])):
+                        return write_preview_estimate(os.path.join(run_results_path, job["name"] + PREVIEW_NAME_SUFFIX), run_results_path, job["name"], preview_sample, args.preview_confidence, args.preview_tolerance)
+                add_stage(stages, f"preview {config_name}", preview_stage, replay_dependencies, "replay", job.get("estimate", 0) * preview_sample["fraction"])
+                checkout_users.append(f"preview {config_name}")
+                replay_dependencies = [f"preview {config_name}"]
+
+            def replay_stage(results, job=job):
+                if preview_sample:
+                    estimate_csv_path, ambiguous = results[f"preview {job['name']}"]
+                    if estimate_csv_path and not (ambiguous and args.escalate):
+                        print(f"Keeping the preview estimate of '{job['name']}'{' (ambiguous, escalation disabled)' if ambiguous else ''}.")
+                        return None
+                    print(f"The preview of '{job['name']}' is ambiguous. Escalating to a full run...")
+                first_phase = len(PHASE_TIMELINE)
                 details_csv_path = run_superpmi(
-                    repo_root,
+                    branch_root,
                     run_results_path,
-                    csv_prefix,
+                    branch,
                     diff_coreroot_path,
-                    diff_jit_options,
-                    base_jit_options
+                    job["options"],
+                    base_jit_options,
+                    spmi_location=os.path.join(workspaces_path, job["name"]),
+                    parallelism=parallelism,
+                    mch_files=results[f"MCH cache {branch}"],
+                    result_store_path=result_store_path,
+                    force_rerun=args.force_rerun,
+                    filters=args.filter,
+                    archive_outputs=not args.no_archive,
+                    reuse_base=args.base_once
+                )
+                # Remember how long the replay took (nothing when the result store had it) to order the next run
+                replay_seconds = sum(
+                    phase["wall"] for phase in PHASE_TIMELINE[first_phase:]
+                    if phase["name"] == "superpmi replay" and phase["thread"] == threading.get_ident()
                 )
-                all_details_csv_paths.append(details_csv_path)
+                if timings_path and replay_seconds:
+                    record_job_timing(timings_path, job, replay_seconds)
+                return details_csv_path
+            add_stage(stages, f"replay {config_name}", replay_stage, replay_dependencies, "replay", job.get("estimate", 0))
+            checkout_users.append(f"replay {config_name}")
+
+            def analysis_stage(results, diff_jit_options=diff_jit_options, config_name=config_name):
+                details_csv_path = results[f"replay {config_name}"]
+                output_folder_path = os.path.join(run_results_path, config_name)
+                # Without a full run the preview estimate stands in for the results
+                estimate = details_csv_path is None
+                if estimate:
+                    details_csv_path = results[f"preview {config_name}"][0]
+                    output_folder_path += PREVIEW_NAME_SUFFIX
+
+                # Record the results, tagged with the branch and options, in the results store
+                with profile_phase("record results", branch=branch, options=" ".join(diff_jit_options)):
+                    label = record_run_results(results_database_path, details_csv_path, branch, diff_jit_options, estimate)
+
+                # Summarize the per-method details of the run
+                method_summary_path = None
+                if args.top_methods > 0:
+                    with profile_phase("method analysis", branch=branch, options=" ".join(diff_jit_options)):
+                        method_summary_path = write_method_diff_summary(output_folder_path, run_results_path, config_name, args.top_methods, label)
+                return details_csv_path, method_summary_path
+            add_stage(stages, f"analyze {config_name}", analysis_stage, [f"replay {config_name}"], "cpu")
+            analysis_stages.append(f"analyze {config_name}")
+
+        # Draw the graphs of the branch while the other branches are still running
+        if len(branches) > 1 and analysis_stages:
+            def branch_graphs_stage(results):
+                details_csv_paths = [results[name][0] for name in analysis_stages]
+                with profile_phase("graphs", branch=branch):
+                    create_visual_representation(*details_csv_paths, results_database_path=results_database_path, render_workers=args.render_workers, graph_folder=os.path.join(run_results_path, f"{branch}_graphs"))
+            add_stage(stages, f"graphs {branch}", branch_graphs_stage, analysis_stages, "cpu")
+        return checkout_users, analysis_stages
+
+    # The base branch comes first; without worktrees the other branches wait for its checkout
+    for branch in branches:
+        checkout_users, _ = declare_branch_stages(branch, checkout_stage_dependencies)
+        if not args.worktrees:
+            # The next branch replaces this branch's checkout
+            checkout_stage_dependencies = ["clone"] + checkout_users
+    all_analysis_stages = [f"analyze {job['name']}" for job in sorted(jobs, key=lambda job: job["index"])]
+
+    def graphs_stage(results):
+        details_csv_paths = [results[name][0] for name in all_analysis_stages]
+        method_summary_paths = [results[name][1] for name in all_analysis_stages if results[name][1]]
+        # Create a visual representation for all cases across all branches
+        with profile_phase("graphs"):
+            create_visual_representation(*details_csv_paths, results_database_path=results_database_path, render_workers=args.render_workers)
+            if method_summary_paths:
+                create_method_diff_graphs(*method_summary_paths, render_workers=args.render_workers)
+        delete_directory_if_exists(workspaces_path)
+    # A shard may have no jobs of the matrix, and then nothing to draw
+    if all_analysis_stages:
+        add_stage(stages, "graphs", graphs_stage, all_analysis_stages, "cpu")
+
+    # Time the JITs once everything else has finished, one configuration at a time, so the other stages do not disturb the timings
+    if args.throughput and jobs:
+        quiet_after = ["graphs"] + [f"graphs {branch}" for branch in branches if f"graphs {branch}" in stages]
+        throughput_stages = []
+        for job in sorted(jobs, key=lambda job: job["index"]):
+            def throughput_stage(results, job=job):
+                with profile_phase("throughput", branch=job["branch"], options=" ".join(job["options"])):
+                    tp_csv_path = run_throughput(
+                        run_results_path,
+                        job["branch"],
+                        os.path.join(run_results_path, job["branch"]),
+                        job["options"],
+                        base_jit_options,
+                        results[f"MCH cache {job['branch']}"],
+                        filters=args.filter,
+                        repeats=args.tp_repeats,
+                        warmup=args.tp_warmup,
+                        cpus=args.tp_cpus
+                    )
+                # Record the run so the graphs are labelled from its branch and options
+                record_run_results(results_database_path, tp_csv_path, job["branch"], job["options"], columns=TP_COLUMNS)
+                return tp_csv_path
+            add_stage(stages, f"throughput {job['name']}", throughput_stage, quiet_after + [f"MCH cache {job['branch']}"], "throughput")
+            throughput_stages.append(f"throughput {job['name']}")
+
+        def throughput_graphs_stage(results):
+            with profile_phase("throughput graphs"):
+                create_visual_representation(*(results[name] for name in throughput_stages), results_database_path=results_database_path, render_workers=args.render_workers, graph_folder=os.path.join(run_results_path, TP_GRAPHS_DIR_NAME), columns=TP_COLUMNS)
+        add_stage(stages, "throughput graphs", throughput_graphs_stage, throughput_stages, "cpu")
+    return stages
+
+def parse_shard(value):
+    """Parse an 'I/N' shard argument into an (index, count) tuple."""
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"invalid shard '{value}', expected I/N with 1 <= I <= N")
+    return int(match.group(1)), int(match.group(2))
+
+def parse_arguments():
+    """Parse the command-line options of the script."""
+    parser = argparse.ArgumentParser(description="Build the runtime branches and compare JIT configurations with SuperPMI.")
+    parser.add_argument("-jobs", type=int, default=None,
+                        help="Number of SuperPMI configurations to run in parallel. Defaults to 1, or to the number of cores divided by -cores_per_job.")
+    parser.add_argument("-cores_per_job", type=int, default=None,
+                        help="Number of cores each SuperPMI configuration may use. Defaults to an even share of the cores.")
+    parser.add_argument("-render_workers", type=int, default=None,
+                        help="Number of processes rendering the graphs. Defaults to one per graph, up to the number of cores.")
+    parser.add_argument("-top_methods", type=int, default=METHOD_ANALYSIS_TOP_N,
+                        help="Number of top improved and regressed methods to keep per collection and config in the per-method summaries. 0 disables the analysis.")
+    parser.add_argument("--worktrees", action="store_true",
+                        help="Check out every branch in its own persistent git worktree, fetched with a blob filter, instead of re-creating it in the 'runtime' clone. Keeps each branch's artifacts for incremental builds.")
+    parser.add_argument("-fetch_depth", type=int, default=None,
+                        help="Fetch the branches with this history depth in worktree mode (shallow fetch).")
+    parser.add_argument("-mch_cache", default=MCH_CACHE_PATH,
+                        help="Folder of the shared MCH collection cache. Defaults to the APX_PERF_MCH_CACHE environment variable or ~/.apx_performance/mch_cache.")
+    parser.add_argument("-mch_cache_max_gb", type=float, default=MCH_CACHE_MAX_BYTES / 1024 ** 3,
+                        help="Size limit of the MCH cache in GB. Least recently used collections are evicted beyond it.")
+    parser.add_argument("--no_mch_cache", action="store_true",
+                        help="Let superpmi.py download the collections into its SPMI location for every run instead of using the MCH cache.")
+    parser.add_argument("-build_cache", default=BUILD_CACHE_PATH,
+                        help="Folder of the build cache. Defaults to the APX_PERF_BUILD_CACHE environment variable or ~/.apx_performance/build_cache.")
+    parser.add_argument("-build_cache_max_gb", type=float, default=BUILD_CACHE_MAX_BYTES / 1024 ** 3,
+                        help="Size limit of the build cache in GB. Least recently used builds are evicted beyond it.")
+    parser.add_argument("--no_build_cache", action="store_true",
+                        help="Always build the branches instead of restoring an earlier build of the same commit.")
+    parser.add_argument("--full_build", action="store_true",
+                        help="Always run the full build instead of only rebuilding the JIT (or nothing) when only JIT files changed since the last build of the checkout.")
+    parser.add_argument("-snapshot_store", default=SNAPSHOT_STORE_PATH,
+                        help="Folder of the deduplicating Core_Root snapshot store. Defaults to the APX_PERF_SNAPSHOT_STORE environment variable or ~/.apx_performance/snapshots. Put it on the same volume as the results folder so the snapshots can be hardlinked.")
+    parser.add_argument("--no_snapshot_store", action="store_true",
+                        help="Copy Core_Root folders with a full copy instead of linking them from the snapshot store.")
+    parser.add_argument("-result_store", default=RESULT_STORE_PATH,
+                        help="Folder of the SuperPMI result store. Defaults to the APX_PERF_RESULT_STORE environment variable or ~/.apx_performance/results.")
+    parser.add_argument("--no_result_store", action="store_true",
+                        help="Do not reuse or store the results of SuperPMI runs.")
+    parser.add_argument("-results_db", default=RESULTS_DATABASE_PATH,
+                        help="SQLite database that keeps the per-collection results of every run across runs. Defaults to the APX_PERF_RESULTS_DB environment variable or ~/.apx_performance/results.sqlite.")
+    parser.add_argument("--force_rerun", action="store_true",
+                        help="Replay every configuration even if the result store holds its results, and store the new results.")
+    parser.add_argument("-config", default=RUN_CONFIG_PATH,
+                        help="Run configuration (JSON, or TOML on Python 3.11 and later) with the branches and JIT option matrices to run. Defaults to run_config.json next to the script.")
+    parser.add_argument("-shard", type=parse_shard, default=(1, 1), metavar="I/N",
+                        help="Run only the I-th of N slices of the matrix, e.g. 2/3. Merge the results folders of all shards with -merge_shards.")
+    parser.add_argument("-merge_shards", nargs="+", metavar="PATH",
+                        help="Merge the results folders of the shards of a matrix into 'runResults', draw the graphs and exit.")
+    parser.add_argument("-timings", default=JOB_TIMINGS_PATH,
+                        help="Folder of the replay times of earlier jobs, used to start the longest jobs first. Defaults to the APX_PERF_TIMINGS environment variable or ~/.apx_performance/timings.")
+    parser.add_argument("-filter", nargs="+", metavar="COLLECTION",
+                        help="Only replay the collections whose names contain one of these strings (superpmi.py -filter).")
+    parser.add_argument("--preview", action="store_true",
+                        help="Replay a deterministic sample of the method contexts of every collection first and estimate the results with confidence intervals. Jobs whose estimate is ambiguous run in full.")
+    parser.add_argument("-preview_fraction", type=float, default=PREVIEW_FRACTION,
+                        help="Share of the method contexts replayed in preview mode.")
+    parser.add_argument("-preview_max_contexts", type=int, default=PREVIEW_MAX_CONTEXTS,
+                        help="Only the contexts up to this number of every collection are sampled in preview mode; the estimates describe those contexts.")
+    parser.add_argument("-preview_confidence", type=float, default=PREVIEW_CONFIDENCE,
+                        help="Confidence level of the preview intervals.")
+    parser.add_argument("-preview_tolerance", type=float, default=PREVIEW_TOLERANCE,
+                        help="A preview whose interval of the %% instruction count difference straddles zero stays an estimate only if it lies within +/- this many percent.")
+    parser.add_argument("--no_escalation", dest="escalate", action="store_false",
+                        help="Keep ambiguous preview estimates instead of running those jobs in full.")
+    parser.add_argument("--base_once", action="store_true",
+                        help="Replay the base JIT only once per set of collections and compare every configuration with its stored per-method metrics, replaying only the diff JIT. Needs the MCH cache.")
+    parser.add_argument("--throughput", action="store_true",
+                        help="After the asm diffs, time the base and diff JIT replays of every configuration and write their median and MAD to '<config>_tp.csv' with graphs in 'throughput_graphs'. Needs the MCH cache.")
+    parser.add_argument("-tp_repeats", type=int, default=TP_REPEATS,
+                        help="Number of timed rounds (one base and one diff replay) per collection in throughput mode.")
+    parser.add_argument("-tp_warmup", type=int, default=TP_WARMUP,
+                        help="Number of untimed replays per JIT and collection before the timed rounds in throughput mode.")
+    parser.add_argument("-tp_cpus", type=int, nargs="+", metavar="CPU",
+                        help="Pin the throughput replays to these CPU numbers, e.g. -tp_cpus 2 3.")
+    parser.add_argument("--no_archive", action="store_true",
+                        help="Keep the asm dumps of every run as plain files instead of packing them into a compressed archive.")
+    parser.add_argument("-extract_asm", nargs="+", metavar=("OUTPUT_FOLDER", "CONTEXT"),
+                        help="Print the base and diff asm of one method context from the archive of a run's output folder and exit. Add a collection name when several collections have the context.")
+    parser.add_argument("-resource_limit", action="append", metavar="CLASS=N",
+                        help="Number of pipeline stages of a resource class (network, disk, build, replay, throughput, cpu) that may run at the same time. May be repeated. The replay limit defaults to -jobs.")
+    parser.add_argument("--list_build_cache", action="store_true",
+                        help="List the entries of the build cache and exit.")
+    parser.add_argument("-purge_build_cache", nargs="*", metavar="KEY",
+                        help="Remove the given build cache entries (key prefixes), or all entries if none are given, and exit.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    build_cache_path = os.path.abspath(args.build_cache)
+    snapshot_store_path = None if args.no_snapshot_store else os.path.abspath(args.snapshot_store)
+    if args.extract_asm:
+        if len(args.extract_asm) not in (2, 3):
+            print("-extract_asm takes an output folder, a method context and optionally a collection.")
+            sys.exit(1)
+        for side, text in extract_method_asm(*args.extract_asm).items():
+            print(f"; ===== {side} =====")
+            print(text)
+        sys.exit(0)
+    if args.list_build_cache or args.purge_build_cache is not None:
+        if args.purge_build_cache is not None:
+            purge_build_cache(build_cache_path, args.purge_build_cache)
+        if args.list_build_cache:
+            list_build_cache(build_cache_path)
+        sys.exit(0)
+
+    if args.throughput:
+        if args.no_mch_cache:
+            print("Throughput mode replays the collections of the MCH cache. Remove --no_mch_cache or --throughput.")
+            sys.exit(1)
+        if args.tp_repeats < 1 or args.tp_warmup < 0:
+            print("-tp_repeats must be at least 1 and -tp_warmup at least 0.")
+            sys.exit(1)
+        if args.tp_cpus and not all(0 <= cpu < (os.cpu_count() or 1) for cpu in args.tp_cpus):
+            print(f"-tp_cpus must be CPU numbers between 0 and {(os.cpu_count() or 1) - 1}.")
+            sys.exit(1)
+
+    print("Starting the script...")
+
+    # Create a new folder 'runResults' parallel to the 'runtime' repository
+    run_results_path = os.path.abspath(os.path.join(DIR_NAME, "..", "runResults"))
+    for shard_path in args.merge_shards or []:
+        if os.path.commonpath([os.path.abspath(shard_path), run_results_path]) == run_results_path:
+            print(f"Copy the shard results out of '{run_results_path}' before merging them; it is cleared on every run.")
+            sys.exit(1)
+    if os.path.exists(run_results_path):
+        print(f"'runResults' folder already exists at: {run_results_path}. Deleting its contents...")
+        try:
+            # Delete all contents of the folder
+            for item in os.listdir(run_results_path):
+                item_path = os.path.join(run_results_path, item)
+                if os.path.isdir(item_path):
+                    shutil.rmtree(item_path)
+                else:
+                    os.remove(item_path)
+            print(f"All contents of 'runResults' folder deleted successfully.")
+        except Exception as e:
+            print(f"Failed to delete contents of 'runResults' folder: {e}")
+            sys.exit(1)
+    else:
+        print(f"'runResults' folder does not exist. Creating it at: {run_results_path}")
+        try:
+            os.makedirs(run_results_path)
+            print(f"'runResults' folder created successfully.")
+        except Exception as e:
+            print(f"Failed to create 'runResults' folder: {e}")
+            sys.exit(1)
+
+    # Add jitutils\bin to the PATH environment variable
+    jitutils_bin_path = os.path.abspath(os.path.join(JITUTILS_DIR_NAME, "bin"))
+    os.environ["PATH"] += os.pathsep + jitutils_bin_path
+    print(f"Added '{jitutils_bin_path}' to PATH.")
+
+    # Get the absolute path to the repository directory
+    repo_root = os.path.abspath(DIR_NAME)
+    print(f"Repository root path: {repo_root}")
+
+    # Merge the results folders of the shards of a matrix and draw their graphs
+    if args.merge_shards:
+        with profile_phase("merge shards"):
+            details_csv_paths, method_summary_paths = merge_shard_results(args.merge_shards, run_results_path, os.path.abspath(args.results_db))
+        with profile_phase("graphs"):
+            if details_csv_paths:
+                create_visual_representation(*details_csv_paths, results_database_path=os.path.abspath(args.results_db), render_workers=args.render_workers)
+            else:
+                print("The shards have no jobs. Nothing to draw.")
+            if method_summary_paths:
+                create_method_diff_graphs(*method_summary_paths, render_workers=args.render_workers)
+        print_phase_summary()
+        print("Script completed successfully.")
+        sys.exit(0)
+
+    # Read the branches and JIT option matrices to run, and the base JIT options
+    run_config = load_run_config(args.config)
+    base_branch = run_config["base_branch"]
+    base_jit_options = normalize_jit_options(run_config.get("base_jit_options", {}))
+    jobs = build_job_matrix(run_config)
+    shard_index, shard_count = args.shard
+    if shard_count > 1:
+        jobs = select_shard(jobs, shard_index, shard_count)
+        print(f"Running shard {shard_index}/{shard_count} of the matrix: {len(jobs)} jobs.")
+    write_matrix_manifest(run_results_path, jobs, shard_index, shard_count)
+    if not jobs:
+        # The empty manifest still lets -merge_shards account for this shard
+        print(f"Shard {shard_index}/{shard_count} has no jobs of the matrix. Nothing to run.")
+        print("Script completed successfully.")
+        sys.exit(0)
+
+    # Start the jobs that took longest in earlier runs first
+    timings_path = os.path.abspath(args.timings)
+    jobs = order_jobs_by_cost(jobs, timings_path)
+    for job in jobs:
+        print(f"    {job['name']}: about {job['estimate']:.0f} s")
+
+    # Run as many replays at a time as -jobs allows, unless -resource_limit says otherwise
+    jobs_at_once, _ = resolve_parallel_jobs(args.jobs, args.cores_per_job, len(jobs))
+    resource_limits = parse_resource_limits([f"replay={jobs_at_once}"] + (args.resource_limit or []))
+
+    # Clone, build, copy, replay and plot as declared stages, overlapping the independent ones
+    stages = declare_pipeline_stages(args, repo_root, run_results_path, base_branch, jobs, base_jit_options, timings_path)
+    print(f"Running {len(stages)} pipeline stages with resource limits {resource_limits}...")
+    run_pipeline(stages, resource_limits, os.path.join(run_results_path, STAGE_LOGS_DIR_NAME))
+
+    # Drop Core_Root snapshots and files that are no longer needed
+    if snapshot_store_path:
+        with profile_phase("snapshot store cleanup"):
+            gc_snapshot_store(snapshot_store_path)
 
-    # Create a visual representation for all cases across both branches
-    create_visual_representation(*all_details_csv_paths)
+    # Save the phase timeline and show where the time went
+    write_phase_timeline(os.path.join(run_results_path, TIMELINE_FILE_NAME), os.path.join(run_results_path, TRACE_FILE_NAME))
+    print_phase_summary()
 
     print("Script completed successfully.")
\ No newline at end of file
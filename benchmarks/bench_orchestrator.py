@@ -0,0 +1,453 @@
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_PATH))
+import DownloadRepoAndRunTest as orchestrator  # noqa: E402
+
+# Stored results the runs are compared against (see --update_baseline)
+BASELINE_PATH = os.path.join(BENCHMARKS_PATH, "baseline.json")
+# A case regresses when it takes more than (1 + tolerance) times its baseline, plus a small slack against noise
+REGRESSION_TOLERANCE = 0.5
+REGRESSION_MIN_SECONDS = 0.25
+REGRESSION_MIN_MB = 32.0
+# Seconds between two samples of the memory use of the orchestrator process
+RSS_SAMPLE_INTERVAL = 0.01
+# Sizes of the stand-ins: Core_Root files, filler source files in the repository, branches, JIT option
+# sets per branch, collections, method contexts per collection and asm dumps per collection
+SCALES = {
+    "small": {"core_root_files": 300, "core_root_file_kb": 8, "repo_files": 200, "branches": 2, "configs": 2, "collections": 4, "methods": 2000, "dumps": 50, "mch_kb": 64},
+    "medium": {"core_root_files": 2000, "core_root_file_kb": 16, "repo_files": 2000, "branches": 2, "configs": 4, "collections": 8, "methods": 20000, "dumps": 500, "mch_kb": 256},
+    "large": {"core_root_files": 5000, "core_root_file_kb": 32, "repo_files": 10000, "branches": 3, "configs": 8, "collections": 16, "methods": 100000, "dumps": 2000, "mch_kb": 1024},
+}
+# Phases of the orchestrator (see profile_phase) reported on their own for the cases that record them
+CASE_PHASES = {
+    "replay": ["collect superpmi outputs", "archive outputs", "result store save"],
+    "replay (stored)": ["result store lookup"],
+    "replay (base once)": ["base replay", "superpmi replay"],
+    "pipeline": ["superpmi replay", "collect superpmi outputs", "copy Core_Root", "graphs"],
+}
+
+def run_git(command, cwd):
+    subprocess.run(["git"] + command, cwd=cwd, check=True, capture_output=True)
+
+def write_script(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as script_file:
+        script_file.write(content)
+    os.chmod(path, 0o755)
+
+def create_origin_repo(workspace_path, scale):
+    """
+    Create a bare repository standing in for the runtime's origin and return its path and branch names.
+
+    Its build.cmd scripts run fake_build.py and its superpmi.py is fake_superpmi.py. Every branch
+    changes one file of the JIT on top of 'main', which holds repo_files filler source files.
+    """
+    origin_path = os.path.join(workspace_path, "origin.git")
+    seed_path = os.path.join(workspace_path, "seed")
+    build_shim = f"#!/bin/sh\nexec \"{sys.executable}\" \"{os.path.join(BENCHMARKS_PATH, 'fake_build.py')}\" \"$@\"\n"
+    write_script(os.path.join(seed_path, "build.cmd"), build_shim)
+    write_script(os.path.join(seed_path, "src", "tests", "build.cmd"), build_shim)
+    os.makedirs(os.path.join(seed_path, "src", "coreclr", "scripts"))
+    shutil.copyfile(os.path.join(BENCHMARKS_PATH, "fake_superpmi.py"), os.path.join(seed_path, "src", "coreclr", "scripts", "superpmi.py"))
+    jit_path = os.path.join(seed_path, "src", "coreclr", "jit")
+    os.makedirs(jit_path)
+    for index in range(scale["repo_files"]):
+        with open(os.path.join(jit_path, f"source{index:05d}.cpp"), "w") as source_file:
+            source_file.write(f"// Filler source file {index}\n" + "int f() { return 0; }\n" * 40)
+
+    run_git(["init", "-q", "-b", "main"], seed_path)
+    run_git(["add", "-A"], seed_path)
+    run_git(["-c", "user.name=bench", "-c", "user.email=bench@example.com", "commit", "-q", "-m", "Initial"], seed_path)
+    branches = ["bench_base"] + [f"bench_diff{index}" for index in range(1, scale["branches"])]
+    for branch in branches:
+        run_git(["checkout", "-q", "-b", branch, "main"], seed_path)
+        with open(os.path.join(jit_path, "source00000.cpp"), "a") as source_file:
+            source_file.write(f"// Changed on {branch}\n")
+        run_git(["-c", "user.name=bench", "-c", "user.email=bench@example.com", "commit", "-q", "-am", f"Change {branch}"], seed_path)
+    run_git(["clone", "-q", "--bare", seed_path, origin_path], workspace_path)
+    shutil.rmtree(seed_path)
+    return origin_path, branches
+
+def get_run_config(branches, scale):
+    """Return a run configuration with 'configs' JIT option sets for every branch."""
+    return {
+        "base_branch": branches[0],
+        "base_jit_options": {"JitBypassApxCheck": 0, "JitBenchOption": 0},
+        "branches": {
+            branch: {"options": {"JitBypassApxCheck": 1}, "axes": {"JitBenchOption": list(range(1, scale["configs"] + 1))}}
+            for branch in branches
+        },
+    }
+
+@contextlib.contextmanager
+def redirect_output(log_file):
+    """Send everything written to stdout and stderr, by this process and its children, to log_file."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    os.dup2(log_file.fileno(), 1)
+    os.dup2(log_file.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        for fd in saved_fds:
+            os.close(fd)
+
+def read_rss():
+    """Return the resident set size of this process in bytes, or None where /proc is not available."""
+    try:
+        with open("/proc/self/statm", "r") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+@contextlib.contextmanager
+def sample_peak_rss(interval=RSS_SAMPLE_INTERVAL):
+    """Sample the RSS of this process in the background; yields a dict whose 'growth' is set to the peak growth in bytes, or None."""
+    start_rss = read_rss()
+    usage = {"peak": start_rss, "growth": None}
+    stop = threading.Event()
+
+    def sample():
+        while True:
+            rss = read_rss()
+            usage["peak"] = max(usage["peak"], rss)
+            if stop.wait(interval):
+                return
+
+    sampler = threading.Thread(target=sample, daemon=True) if start_rss is not None else None
+    if sampler:
+        sampler.start()
+    try:
+        yield usage
+    finally:
+        if sampler:
+            stop.set()
+            sampler.join()
+            usage["growth"] = usage["peak"] - start_rss
+
+def measure(results, name, function, log_file):
+    """
+    Run one benchmark case and record its wall time, the time of its phases and how much the RSS of
+    this process grew at its peak. Child processes are not included in the peak.
+    """
+    print(f"    {name}...", end="", flush=True)
+    first_phase = len(orchestrator.PHASE_TIMELINE)
+    start = time.perf_counter()
+    try:
+        with redirect_output(log_file), sample_peak_rss() as usage:
+            value = function()
+    except SystemExit:
+        print(f" failed. See '{log_file.name}'.")
+        sys.exit(1)
+    seconds = time.perf_counter() - start
+    results[name] = {"seconds": seconds}
+    if usage["growth"] is not None:
+        results[name]["peak_mb"] = usage["growth"] / 1024 ** 2
+    print(f" {seconds:.2f} s")
+
+    phases = orchestrator.PHASE_TIMELINE[first_phase:]
+    for phase_name in CASE_PHASES.get(name, []):
+        matching = [phase["wall"] for phase in phases if phase["name"] == phase_name]
+        if matching:
+            results[f"{name}: {phase_name}"] = {"seconds": sum(matching)}
+    return value
+
+def get_first_archived_method(output_folder_path):
+    """Return the (context, collection) of the first method in the archive of an output folder."""
+    with open(os.path.join(output_folder_path, orchestrator.ARCHIVE_INDEX_NAME), "r") as index_file:
+        methods = json.load(index_file)["methods"]
+    collection = sorted(methods)[0]
+    return sorted(methods[collection], key=int)[0], collection
+
+def run_pipeline_case(workspace_path, origin_path, branches, scale):
+    """Run the whole orchestration, as the script's main does, against the stand-ins with cold caches."""
+    pipeline_path = os.path.join(workspace_path, "pipeline")
+    os.makedirs(os.path.join(pipeline_path, orchestrator.JITUTILS_DIR_NAME, "bin"))
+    config_path = os.path.join(pipeline_path, "run_config.json")
+    with open(config_path, "w") as config_file:
+        json.dump(get_run_config(branches, scale), config_file)
+
+    saved = os.getcwd(), orchestrator.REPO_URL, sys.argv
+    os.chdir(pipeline_path)
+    orchestrator.REPO_URL = origin_path
+    sys.argv = [
+        "DownloadRepoAndRunTest.py", "-config", config_path, "-jobs", "2", "--worktrees",
+        "-build_cache", os.path.join(pipeline_path, "build_cache"),
+        "-mch_cache", os.path.join(pipeline_path, "mch_cache"),
+        "-snapshot_store", os.path.join(pipeline_path, "snapshots"),
+        "-result_store", os.path.join(pipeline_path, "results"),
+        "-results_db", os.path.join(pipeline_path, "results.sqlite"),
+        "-timings", os.path.join(pipeline_path, "timings"),
+        "--throughput", "-tp_repeats", "2",
+    ]
+    try:
+        args = orchestrator.parse_arguments()
+        run_results_path = os.path.join(pipeline_path, "runResults")
+        os.makedirs(run_results_path)
+        run_config = orchestrator.load_run_config(args.config)
+        jobs = orchestrator.order_jobs_by_cost(orchestrator.build_job_matrix(run_config), args.timings)
+        jobs_at_once, _ = orchestrator.resolve_parallel_jobs(args.jobs, args.cores_per_job, len(jobs))
+        stages = orchestrator.declare_pipeline_stages(
+            args, os.path.abspath(orchestrator.DIR_NAME), run_results_path, run_config["base_branch"], jobs,
+            orchestrator.normalize_jit_options(run_config["base_jit_options"]), args.timings
+        )
+        orchestrator.run_pipeline(stages, orchestrator.parse_resource_limits([f"replay={jobs_at_once}"]), os.path.join(run_results_path, orchestrator.STAGE_LOGS_DIR_NAME))
+    finally:
+        os.chdir(saved[0])
+        orchestrator.REPO_URL, sys.argv = saved[1:]
+
+def run_benchmarks(workspace_path, scale):
+    """Run every benchmark case at one scale in an empty workspace folder and return their results."""
+    os.environ.update({
+        "BENCH_CORE_ROOT_FILES": str(scale["core_root_files"]),
+        "BENCH_CORE_ROOT_FILE_KB": str(scale["core_root_file_kb"]),
+        "BENCH_COLLECTIONS": str(scale["collections"]),
+        "BENCH_METHODS": str(scale["methods"]),
+        "BENCH_DUMPS": str(scale["dumps"]),
+        "BENCH_MCH_KB": str(scale["mch_kb"]),
+    })
+    origin_path, branches = create_origin_repo(workspace_path, scale)
+    run_config = get_run_config(branches, scale)
+    jobs = orchestrator.build_job_matrix(run_config)
+    base_jit_options = orchestrator.normalize_jit_options(run_config["base_jit_options"])
+    repo_root = os.path.join(workspace_path, "runtime")
+    worktrees_path = os.path.join(workspace_path, "worktrees")
+    run_results_path = os.path.join(workspace_path, "runResults")
+    build_cache_path = os.path.join(workspace_path, "build_cache")
+    result_store_path = os.path.join(workspace_path, "results")
+    workspaces_path = os.path.join(run_results_path, orchestrator.SPMI_WORKSPACES_DIR_NAME)
+    database_path = os.path.join(workspace_path, "results.sqlite")
+    os.makedirs(run_results_path)
+    results = {}
+
+    with open(os.path.join(workspace_path, "bench.log"), "w") as log_file:
+        measure(results, "clone", lambda: orchestrator.clone_repo(origin_path, repo_root), log_file)
+        measure(results, "checkout", lambda: [orchestrator.checkout_branch(branch, repo_root) for branch in branches], log_file)
+        def prepare_worktrees():
+            # The fetch and worktree stages of the pipeline, one after the other
+            orchestrator.fetch_branches(branches, repo_root)
+            os.makedirs(worktrees_path, exist_ok=True)
+            return {branch: orchestrator.prepare_worktree(branch, repo_root, worktrees_path) for branch in branches}
+        worktree_paths = measure(results, "worktrees", prepare_worktrees, log_file)
+        measure(results, "build", lambda: [orchestrator.build_branch(worktree_paths[branch], branch) for branch in branches], log_file)
+
+        # The branches only differ in JIT files, so switching the clone to another branch only rebuilds the JIT
+        orchestrator.build_branch(repo_root, branches[-1])
+        def rebuild_jit():
+            for branch in branches[:-1]:
+                orchestrator.checkout_branch(branch, repo_root)
+                orchestrator.build_branch(repo_root, branch)
+        measure(results, "checkout and JIT rebuild", rebuild_jit, log_file)
+
+        base_root = worktree_paths[branches[0]]
+        base_key = orchestrator.get_build_cache_key(orchestrator.get_commit_sha(base_root))
+        measure(results, "build cache store", lambda: orchestrator.store_build_in_cache(
+            base_key, orchestrator.get_core_root_path(base_root), branches[0], orchestrator.get_commit_sha(base_root), build_cache_path
+        ), log_file)
+        measure(results, "build cache hit", lambda: orchestrator.build_branch(base_root, branches[0], build_cache_path), log_file)
+
+        def copy_core_roots(destination_path, snapshot_store_path=None):
+            orchestrator.copy_core_root(base_root, destination_path, "base", snapshot_store_path=snapshot_store_path)
+            for branch in branches:
+                orchestrator.copy_core_root(worktree_paths[branch], destination_path, branch, snapshot_store_path=snapshot_store_path)
+        measure(results, "copy Core_Root", lambda: copy_core_roots(run_results_path), log_file)
+        measure(results, "snapshot Core_Root", lambda: copy_core_roots(os.path.join(workspace_path, "snapshot_copies"), os.path.join(workspace_path, "snapshots")), log_file)
+
+        mch_cache_path = os.path.join(workspace_path, "mch_cache")
+        base_core_root_path = os.path.join(run_results_path, "base")
+        mch_files = measure(results, "MCH cache download", lambda: orchestrator.prime_mch_cache(base_root, base_core_root_path, mch_cache_path), log_file)
+        measure(results, "MCH cache hit", lambda: orchestrator.prime_mch_cache(base_root, base_core_root_path, mch_cache_path), log_file)
+
+        def replay_jobs(reuse_base=False):
+            name_suffix = "_base_once" if reuse_base else ""
+            return [
+                orchestrator.run_superpmi(
+                    worktree_paths[job["branch"]], run_results_path, job["branch"], os.path.join(run_results_path, job["branch"]),
+                    job["options"], base_jit_options, spmi_location=os.path.join(workspaces_path, job["name"] + name_suffix),
+                    mch_files=mch_files, result_store_path=None if reuse_base else result_store_path,
+                    name_suffix=name_suffix, reuse_base=reuse_base
+                )
+                for job in jobs
+            ]
+        details_csv_paths = measure(results, "replay", replay_jobs, log_file)
+        measure(results, "replay (stored)", replay_jobs, log_file)
+        measure(results, "replay (base once)", lambda: replay_jobs(reuse_base=True), log_file)
+
+        measure(results, "record results", lambda: [
+            orchestrator.record_run_results(database_path, details_csv_path, job["branch"], job["options"])
+            for job, details_csv_path in zip(jobs, details_csv_paths)
+        ], log_file)
+        measure(results, "method analysis", lambda: [
+            orchestrator.write_method_diff_summary(os.path.join(run_results_path, job["name"]), run_results_path, job["name"])
+            for job in jobs
+        ], log_file)
+        first_output_path = os.path.join(run_results_path, jobs[0]["name"])
+        measure(results, "extract asm", lambda: orchestrator.extract_method_asm(first_output_path, *get_first_archived_method(first_output_path)), log_file)
+        measure(results, "graphs", lambda: orchestrator.create_visual_representation(
+            *details_csv_paths, results_database_path=database_path, graph_folder=os.path.join(run_results_path, "graphs")
+        ), log_file)
+        def measure_throughput():
+            tp_csv_paths = []
+            for job in jobs:
+                tp_csv_paths.append(orchestrator.run_throughput(
+                    run_results_path, job["branch"], os.path.join(run_results_path, job["branch"]), job["options"],
+                    base_jit_options, mch_files, repeats=3, cpus=[0]
+                ))
+                orchestrator.record_run_results(database_path, tp_csv_paths[-1], job["branch"], job["options"], columns=orchestrator.TP_COLUMNS)
+            orchestrator.create_visual_representation(
+                *tp_csv_paths, results_database_path=database_path,
+                graph_folder=os.path.join(run_results_path, orchestrator.TP_GRAPHS_DIR_NAME), columns=orchestrator.TP_COLUMNS
+            )
+        measure(results, "throughput", measure_throughput, log_file)
+        measure(results, "pipeline", lambda: run_pipeline_case(workspace_path, origin_path, branches, scale), log_file)
+    return results
+
+def merge_repeats(repeats):
+    """Keep the best time and the lowest memory peak of every case over the repeated runs."""
+    merged = {}
+    for results in repeats:
+        for name, values in results.items():
+            best = merged.setdefault(name, dict(values))
+            for metric, value in values.items():
+                best[metric] = min(best[metric], value)
+    return merged
+
+def find_regressions(results, baseline_results, tolerance):
+    """Return a message for every case that got slower or used more memory than its baseline allows."""
+    regressions = []
+    for name, values in results.items():
+        baseline_values = baseline_results.get(name)
+        if not baseline_values:
+            continue
+        for metric, slack in (("seconds", REGRESSION_MIN_SECONDS), ("peak_mb", REGRESSION_MIN_MB)):
+            if metric not in values or metric not in baseline_values:
+                continue
+            limit = baseline_values[metric] * (1 + tolerance) + slack
+            if values[metric] > limit:
+                regressions.append(f"{name}: {metric} {values[metric]:.2f} > {limit:.2f} (baseline {baseline_values[metric]:.2f})")
+    return regressions
+
+def print_results(scale_name, results, baseline_results):
+    print(f"Results at scale '{scale_name}':")
+    print(f"{'Case':<52} {'Time (s)':>9} {'Baseline':>9} {'Change':>8} {'Peak (MB)':>10} {'Baseline':>9}")
+    for name, values in results.items():
+        baseline_values = baseline_results.get(name, {})
+        baseline_seconds = baseline_values.get("seconds")
+        change = f"{(values['seconds'] / baseline_seconds - 1) * 100:+.0f}%" if baseline_seconds else ""
+        print(
+            f"{name:<52} {values['seconds']:>9.2f} {baseline_seconds if baseline_seconds is not None else float('nan'):>9.2f} {change:>8} "
+            f"{values.get('peak_mb', float('nan')):>10.1f} {baseline_values.get('peak_mb', float('nan')):>9.1f}"
+        )
+    child_peak_rss = orchestrator.get_resource_usage()["child_peak_rss"]
+    if child_peak_rss:
+        print(f"Peak RSS of the child processes so far: {child_peak_rss / 1024 ** 2:.1f} MB")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the orchestration overhead of DownloadRepoAndRunTest.py against local stand-ins for git, the build and SuperPMI.")
+    parser.add_argument("-scale", nargs="+", choices=sorted(SCALES), default=["small"],
+                        help="Scales to run (default: small).")
+    for name in SCALES["small"]:
+        parser.add_argument(f"-{name}", type=int,
+                            help=f"Override the '{name}' of the scales. Runs with overrides are not compared with the baseline.")
+    parser.add_argument("-repeat", type=int, default=1,
+                        help="Run every scale this many times and keep the best results (default: 1).")
+    parser.add_argument("-tolerance", type=float,
+                        help=f"Allowed slowdown or memory growth against the baseline, as a fraction (default: the baseline's, or {REGRESSION_TOLERANCE}).")
+    parser.add_argument("-baseline", default=BASELINE_PATH,
+                        help="Baseline file (default: baseline.json next to this script).")
+    parser.add_argument("--update_baseline", action="store_true",
+                        help="Store the results of the scales as the new baseline instead of comparing them.")
+    parser.add_argument("-json", help="Also write the results to this JSON file.")
+    parser.add_argument("-workspace", help="Folder for the stand-ins and outputs, kept after the run (default: a temporary folder that is removed).")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if os.name == "nt":
+        print("The benchmarks need a POSIX shell for the build.cmd stand-ins and a runnable mcs.exe stand-in.")
+        sys.exit(1)
+
+    baseline = {"tolerance": REGRESSION_TOLERANCE, "scales": {}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+    tolerance = args.tolerance if args.tolerance is not None else baseline.get("tolerance", REGRESSION_TOLERANCE)
+    overrides = {name: getattr(args, name) for name in SCALES["small"] if getattr(args, name) is not None}
+
+    # superpmi.py is run as 'python'; make that the interpreter running the benchmarks
+    workspace_root = os.path.abspath(args.workspace) if args.workspace else tempfile.mkdtemp(prefix="apx_bench_")
+    bin_path = os.path.join(workspace_root, "bin")
+    os.makedirs(bin_path, exist_ok=True)
+    if not os.path.exists(os.path.join(bin_path, "python")):
+        os.symlink(sys.executable, os.path.join(bin_path, "python"))
+    os.environ["PATH"] = bin_path + os.pathsep + os.environ["PATH"]
+
+    all_results = {}
+    regressions = []
+    compared = False
+    try:
+        for scale_name in args.scale:
+            scale = dict(SCALES[scale_name], **overrides)
+            repeats = []
+            for repeat in range(args.repeat):
+                workspace_path = os.path.join(workspace_root, f"{scale_name}_{repeat + 1}")
+                if os.path.exists(workspace_path):
+                    shutil.rmtree(workspace_path)
+                os.makedirs(workspace_path)
+                print(f"Running the benchmarks at scale '{scale_name}' ({repeat + 1}/{args.repeat}) in '{workspace_path}'...")
+                repeats.append(run_benchmarks(workspace_path, scale))
+            results = merge_repeats(repeats)
+            all_results[scale_name] = {"scale": scale, "cases": results}
+
+            baseline_scale = baseline["scales"].get(scale_name, {})
+            comparable = not overrides and baseline_scale.get("scale") == scale
+            print_results(scale_name, results, baseline_scale.get("cases", {}) if comparable else {})
+            if args.update_baseline:
+                continue
+            if overrides:
+                print("Not comparing with the baseline: the scale was overridden.")
+            elif not comparable:
+                print(f"No baseline for scale '{scale_name}'. Store one with --update_baseline.")
+            else:
+                compared = True
+                regressions.extend(f"[{scale_name}] {message}" for message in find_regressions(results, baseline_scale["cases"], tolerance))
+    finally:
+        if not args.workspace:
+            shutil.rmtree(workspace_root, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(all_results, json_file, indent=2)
+        print(f"Results saved at '{args.json}'.")
+
+    if args.update_baseline:
+        if overrides:
+            print("Not updating the baseline with overridden scales.")
+            sys.exit(1)
+        baseline["tolerance"] = tolerance
+        baseline["scales"].update(all_results)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2)
+        print(f"Baseline updated at '{args.baseline}'.")
+    elif regressions:
+        print(f"{len(regressions)} regressions against the baseline (tolerance {tolerance:.0%}):")
+        for message in regressions:
+            print(f"    {message}")
+        sys.exit(1)
+    elif compared:
+        print("No regressions against the baseline.")
@@ -0,0 +1,59 @@
+import os
+import sys
+import subprocess
+import random
+
+# Stand-in for the runtime's build.cmd and src\tests\build.cmd, run by the build.cmd shims of the
+# benchmark repository. The test build ('generatelayoutonly') writes a synthetic Core_Root with
+# BENCH_CORE_ROOT_FILES files of BENCH_CORE_ROOT_FILE_KB kilobytes each, a clrjit.dll that differs
+# per commit, an mcs.exe that prints the JIT-EE version and a superpmi.exe running fake_superpmi.py.
+# The JIT build ('clr.jit') writes clrjit.dll to artifacts/bin/coreclr. The other builds do nothing.
+
+JIT_EE_VERSION = "bench-0000-0000-0000-000000000000"
+
+def get_commit_sha(repo_root):
+    result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_root, capture_output=True, text=True, check=True)
+    return result.stdout.strip()
+
+def write_core_root(repo_root, file_count, file_kb):
+    """Write the synthetic Core_Root where get_core_root_path expects the build of repo_root."""
+    core_root_path = os.path.join(repo_root, "artifacts", "tests", "coreclr", "windows.x64.Checked", "Tests", "Core_Root")
+    os.makedirs(core_root_path, exist_ok=True)
+    commit_sha = get_commit_sha(repo_root)
+    rng = random.Random(file_count)
+    block = rng.randbytes(file_kb * 1024)
+    for index in range(file_count):
+        # Most files are the same in every build, like the framework assemblies of a real Core_Root
+        with open(os.path.join(core_root_path, f"System.Bench{index:05d}.dll"), "wb") as output_file:
+            output_file.write(block[index % 251:] + block[:index % 251])
+    with open(os.path.join(core_root_path, "clrjit.dll"), "wb") as jit_file:
+        jit_file.write(f"fake jit built from {commit_sha}\n".encode("utf-8") + block)
+    mcs_path = os.path.join(core_root_path, "mcs.exe")
+    with open(mcs_path, "w") as mcs_file:
+        mcs_file.write(f"#!{sys.executable}\nprint({JIT_EE_VERSION!r})\n")
+    os.chmod(mcs_path, 0o755)
+    superpmi_path = os.path.join(core_root_path, "superpmi.exe")
+    with open(superpmi_path, "w") as superpmi_file:
+        superpmi_file.write(f"#!/bin/sh\nexec \"{sys.executable}\" \"{os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_superpmi.py')}\" exe \"$@\"\n")
+    os.chmod(superpmi_path, 0o755)
+    print(f"Wrote a synthetic Core_Root with {file_count} files at '{core_root_path}'.")
+
+def write_jit(repo_root):
+    """Write the clrjit.dll of the JIT build where patch_core_root_jit expects it."""
+    binaries_path = os.path.join(repo_root, "artifacts", "bin", "coreclr", "windows.x64.Checked")
+    os.makedirs(binaries_path, exist_ok=True)
+    with open(os.path.join(binaries_path, "clrjit.dll"), "wb") as jit_file:
+        jit_file.write(f"fake jit built from {get_commit_sha(repo_root)}\n".encode("utf-8"))
+    print(f"Wrote a fake JIT to '{binaries_path}'.")
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["clr.jit"]:
+        write_jit(os.getcwd())
+    elif "generatelayoutonly" in sys.argv[1:]:
+        write_core_root(
+            os.getcwd(),
+            int(os.environ.get("BENCH_CORE_ROOT_FILES", "100")),
+            int(os.environ.get("BENCH_CORE_ROOT_FILE_KB", "16")),
+        )
+    else:
+        print(f"Fake build {' '.join(sys.argv[1:])}: nothing to do.")
@@ -0,0 +1,196 @@
+import argparse
+import csv
+import os
+import random
+import sys
+import zlib
+
+# Stand-in for src\coreclr\scripts\superpmi.py, committed to the benchmark repository, and for the
+# superpmi.exe of the synthetic Core_Root ('exe' mode). 'download' writes BENCH_COLLECTIONS
+# collections of BENCH_MCH_KB kilobytes. 'asmdiffs' replays BENCH_METHODS method contexts per
+# collection (limited by -filter and -compile) and writes the per-collection details CSV, per-method
+# details and the asm dumps of up to BENCH_DUMPS changed methods per collection. 'exe' replays one
+# collection with one JIT. The instruction counts only depend on the collection, context and options.
+
+SPMI_TARGET = "windows.x64"
+
+def get_scale(name, default):
+    return int(os.environ.get(f"BENCH_{name}", default))
+
+def get_default_spmi_location():
+    """Return artifacts/spmi of the repository holding this script (src/coreclr/scripts/superpmi.py)."""
+    repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+    return os.path.join(repo_root, "artifacts", "spmi")
+
+def get_collection_names():
+    names = ["benchmarks.run", "libraries.pmi", "libraries_tests.run", "coreclr_tests.run", "aspnet.run", "realworld.run"]
+    count = get_scale("COLLECTIONS", 4)
+    return [f"{names[i % len(names)]}{'' if i < len(names) else i // len(names)}.{SPMI_TARGET}.checked.mch" for i in range(count)]
+
+def parse_compile_ranges(value, method_count):
+    """Return the sorted method contexts selected by a -compile argument such as '1-50,1001-1050'."""
+    if not value:
+        return range(1, method_count + 1)
+    contexts = set()
+    for part in value.split(","):
+        start, _, end = part.partition("-")
+        contexts.update(range(int(start), min(int(end or start), method_count) + 1))
+    return sorted(contexts)
+
+def download(args):
+    """Write the collections to <spmi_location>/mch/<jit_ee_version>.windows.x64, like 'superpmi.py download'."""
+    folder_path = os.path.join(args.spmi_location or get_default_spmi_location(), "mch", f"{args.jit_ee_version}.{SPMI_TARGET}")
+    os.makedirs(folder_path, exist_ok=True)
+    data = random.Random(0).randbytes(get_scale("MCH_KB", 64) * 1024)
+    for name in get_collection_names():
+        with open(os.path.join(folder_path, name), "wb") as mch_file:
+            mch_file.write(data)
+    print(f"Downloaded {len(get_collection_names())} collections to '{folder_path}'.")
+
+def get_method_name(context):
+    return f"Bench.Namespace{context % 97}.Type{context % 13}:Method{context}(int,long):int"
+
+def get_instructions(collection, context, jit_options):
+    """Return the instruction count of a method compiled with jit_options; every option set changes about one method in ten."""
+    instructions = 5 + zlib.crc32(f"{collection}:{context}".encode("utf-8")) % 396
+    change = zlib.crc32(f"{collection}:{context}:{' '.join(sorted(jit_options))}".encode("utf-8"))
+    return instructions + (change // 10 % 10 - 6 if change % 10 == 0 else 0)
+
+def write_listing(asm_file, method, context, instructions):
+    asm_file.write(f"; Assembly listing for method {method} (FullOpts)\n")
+    for index in range(instructions):
+        asm_file.write(f"G_M{context}_IG{index // 8:02d}:\n" if index % 8 == 0 else "")
+        asm_file.write(f"       mov      rax, qword ptr [rcx+0x{index * 8:02X}]\n")
+    asm_file.write(f"; Total bytes of code {instructions * 4}\n")
+
+def write_asm(path, method, context, instructions):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as asm_file:
+        write_listing(asm_file, method, context, instructions)
+
+def asmdiffs(args):
+    """Replay the selected method contexts of every collection and write the outputs of 'superpmi.py asmdiffs -details'."""
+    spmi_location = args.spmi_location or get_default_spmi_location()
+    if args.mch_files and os.path.isdir(args.mch_files):
+        collections = sorted(name for name in os.listdir(args.mch_files) if name.endswith(".mch"))
+    else:
+        collections = get_collection_names()
+    if args.filter:
+        collections = [name for name in collections if any(value.lower() in name.lower() for value in args.filter)]
+
+    method_count = get_scale("METHODS", 2000)
+    dump_count = get_scale("DUMPS", 50)
+    contexts = parse_compile_ranges(args.compile, method_count)
+    base_jit_options = args.base_jit_option or []
+    diff_jit_options = args.diff_jit_option or []
+    options = " ".join(sorted(diff_jit_options))
+    details_path = os.path.join(spmi_location, "details")
+    asm_path = os.path.join(spmi_location, "asm.asmdiffs")
+    os.makedirs(details_path, exist_ok=True)
+    os.makedirs(asm_path, exist_ok=True)
+
+    summary_rows = []
+    for collection in collections:
+        base_total = diff_total = changed_base_total = dumps = 0
+        with open(os.path.join(details_path, f"{collection}.csv"), "w", newline="") as details_file:
+            writer = csv.writer(details_file)
+            writer.writerow(["Context", "Method full name", "Collection", "Base instructions", "Diff instructions"])
+            for context in contexts:
+                base = get_instructions(collection, context, base_jit_options)
+                diff = get_instructions(collection, context, diff_jit_options)
+                method = get_method_name(context)
+                writer.writerow([context, method, collection, base, diff])
+                base_total += base
+                diff_total += diff
+                if diff != base:
+                    changed_base_total += base
+                    if dumps < dump_count:
+                        write_asm(os.path.join(asm_path, collection, "base", f"{context}.dasm"), method, context, base)
+                        write_asm(os.path.join(asm_path, collection, "diff", f"{context}.dasm"), method, context, diff)
+                        dumps += 1
+        difference = diff_total - base_total
+        summary_rows.append([
+            collection, base_total, diff_total, difference,
+            difference * 100 / base_total if base_total else 0,
+            difference * 100 / changed_base_total if changed_base_total else 0,
+        ])
+
+    with open(os.path.join(asm_path, "summary.md"), "w") as summary_file:
+        summary_file.write(f"# Fake asm diffs of {options}\n\n")
+        for row in summary_rows:
+            summary_file.write(f"* {row[0]}: {row[3]:+d} instructions\n")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.details)), exist_ok=True)
+    with open(args.details, "w", newline="") as details_file:
+        writer = csv.writer(details_file)
+        writer.writerow([
+            "Collection", "Base Instruction Count", "Diff Instruction Count", "Instruction Count Difference",
+            "% Instruction Count Difference", "% Instruction Count Difference (Ignoring Zero diffs)",
+        ])
+        writer.writerows(summary_rows)
+    print(f"Replayed {len(contexts)} contexts of {len(collections)} collections with '{options}'.")
+
+def replay(arguments):
+    """Replay one collection with one JIT like superpmi.exe '[-details FILE] [-p [N]] [-c RANGES] [-jitoption K=V]... JIT MCH'."""
+    details = compile_ranges = None
+    jit_options = []
+    positional = []
+    index = 0
+    while index < len(arguments):
+        argument = arguments[index]
+        if argument == "-p":
+            index += 2 if index + 1 < len(arguments) and arguments[index + 1].isdigit() else 1
+            continue
+        if argument in ("-details", "-c", "-jitoption"):
+            value = arguments[index + 1]
+            if argument == "-details":
+                details = value
+            elif argument == "-c":
+                compile_ranges = value
+            else:
+                jit_options.append(value)
+            index += 2
+            continue
+        positional.append(argument)
+        index += 1
+    _, mch_path = positional
+    collection = os.path.basename(mch_path)
+    stdout_file = next((option.split("=", 1)[1] for option in jit_options if option.startswith("JitStdOutFile=")), None)
+    jit_options = [option for option in jit_options if not option.startswith(("JitStdOutFile=", "JitDisasm"))]
+    contexts = parse_compile_ranges(compile_ranges, get_scale("METHODS", 2000))
+
+    if details:
+        with open(details, "w", newline="") as details_file:
+            writer = csv.writer(details_file)
+            writer.writerow(["Context", "Context size", "Method full name", "Tier name", "Base result", "Base instructions", "Base bytes of code"])
+            for context in contexts:
+                instructions = get_instructions(collection, context, jit_options)
+                writer.writerow([context, 1024, get_method_name(context), "Tier0", "Success", instructions, instructions * 4])
+    if stdout_file:
+        with open(stdout_file, "w") as asm_file:
+            for context in contexts:
+                write_listing(asm_file, get_method_name(context), context, get_instructions(collection, context, jit_options))
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["exe"]:
+        replay(sys.argv[2:])
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description="Fake superpmi.py for the benchmarks.")
+    parser.add_argument("mode", choices=["asmdiffs", "download"])
+    parser.add_argument("-details")
+    parser.add_argument("-base_jit_path")
+    parser.add_argument("-diff_jit_path")
+    parser.add_argument("-core_root")
+    parser.add_argument("-base_jit_option", action="append")
+    parser.add_argument("-diff_jit_option", action="append")
+    parser.add_argument("-mch_files")
+    parser.add_argument("-spmi_location")
+    parser.add_argument("-parallelism")
+    parser.add_argument("-jit_ee_version")
+    parser.add_argument("-filter", nargs="+")
+    parser.add_argument("-compile")
+    args = parser.parse_args()
+    if args.mode == "download":
+        download(args)
+    else:
+        asmdiffs(args)